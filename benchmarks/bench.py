@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+# Benchmarks of the p4aspaces launch path which need no docker daemon:
+# a fake "docker" executable (benchmarks/bin/docker) is put on PATH, and
+# the Engine API benchmarks run against p4aspaces.dockerapi_fake. All
+# settings & caches go to a throwaway HOME & temp folder. Usage:
+#
+#     python3 benchmarks/bench.py --output before.json
+#     (... change something ...)
+#     python3 benchmarks/bench.py --output after.json
+#     python3 benchmarks/compare.py before.json after.json
+
+import argparse
+import contextlib
+import fnmatch
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+FAKE_BIN_DIR = os.path.join(BENCH_DIR, "bin")
+
+def setup_environment(base_dir):
+    # Must run before p4aspaces is imported, since some defaults (like
+    # the gradle cache folder) are computed from the temp dir at import:
+    home = os.path.join(base_dir, "home")
+    tmp = os.path.join(base_dir, "tmp")
+    os.makedirs(home)
+    os.makedirs(tmp)
+    os.environ["HOME"] = home
+    os.environ["TMPDIR"] = tmp
+    os.environ["PATH"] = FAKE_BIN_DIR + os.pathsep + \
+        os.environ.get("PATH", "")
+    os.environ["PYTHONPATH"] = SRC_DIR + os.pathsep + \
+        os.environ.get("PYTHONPATH", "")
+    # No daemon at this socket, so the docker CLI (our fake) gets used:
+    os.environ["DOCKER_HOST"] = "unix://" + os.path.join(base_dir,
+        "no-docker.sock")
+    os.environ.pop("DOCKER_BUILDKIT", None)
+    tempfile.tempdir = None
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    # Don't ask the network which commit the p4a/buildozer branches
+    # (or releases) are, or for the test apps:
+    import p4aspaces.gitrefs as gitrefs
+    import p4aspaces.testapps as testapps
+    gitrefs.set_resolver(lambda repo, name: "0" * 40)
+    gitrefs.set_release_resolver(lambda package: "0.1")
+    testapps.set_provider(lambda source, folder: None)
+
+def measure(func, repeat, number=1):
+    # Returns the per-call times of repeat runs of number calls each,
+    # after one warm-up call:
+    func()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+def summarize(times):
+    result = {
+        "unit": "s",
+        "runs": len(times),
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+    return result
+
+def run_python(code):
+    subprocess.check_call([sys.executable, "-c", code],
+        stdout=subprocess.DEVNULL)
+
+# Every group yields (name, function, calls per measured run). They are
+# generators, so setup & teardown around their benchmarks stays in place.
+
+# Startup: interpreter alone, importing p4aspaces.main, and a full
+# dispatch of a cheap action in a fresh process:
+def bench_startup():
+    yield ("startup.python", lambda: run_python("pass"), 1)
+    yield ("startup.import_main",
+        lambda: run_python("import p4aspaces.main"), 1)
+    yield ("startup.dispatch_list_envs", lambda: run_python(
+        "from p4aspaces.main import main\n" +
+        "try:\n    main(['list-envs'])\nexcept SystemExit:\n    pass"), 1)
+    yield ("startup.dispatch_print_dockerfile", lambda: run_python(
+        "from p4aspaces.main import main\n" +
+        "try:\n    main(['print-dockerfile', 'p4a-py3-api28ndk21'])\n" +
+        "except SystemExit:\n    pass"), 1)
+    yield ("startup.dispatch_help", lambda: run_python(
+        "from p4aspaces.main import main\n" +
+        "try:\n    main(['shell', '--help'])\nexcept SystemExit:\n    pass"),
+        1)
+
+def bench_environments():
+    import p4aspaces.buildenv as buildenv
+    import p4aspaces.dockeropt as dockeropt
+    yield ("envs.get_environments", buildenv.get_environments, 10)
+    yield ("envs.get_environment",
+        lambda: buildenv.get_environment("p4a-py3-api28ndk21"), 10)
+    for env in buildenv.get_environments():
+        for (variant, kwargs) in [("", dict()),
+                (".buildkit", {"buildkit": True})]:
+            yield ("dockerfile." + env.name + variant,
+                lambda env=env, kwargs=kwargs: env.get_docker_file(**kwargs),
+                10)
+        docker_file = env.get_docker_file()
+        yield ("dockerfile." + env.name + ".optimize",
+            lambda docker_file=docker_file: dockeropt.optimize(docker_file),
+            10)
+
+def settings_worker(threads, increments):
+    import threading
+    from p4aspaces.settings import SettingsStore
+    store = SettingsStore()
+    def work():
+        for i in range(increments):
+            with store.transaction() as values:
+                values["bench_counter"] = \
+                    values.get("bench_counter", 0) + 1
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def bench_settings():
+    from p4aspaces.settings import settings
+    settings.set("bench_value", {"a": [1, 2, 3]})
+    yield ("settings.get",
+        lambda: settings.get("bench_value", type=dict), 100)
+    counter = [0]
+    def set_value():
+        counter[0] += 1
+        settings.set("bench_value", {"a": [counter[0]]})
+    yield ("settings.set", set_value, 20)
+
+    # 4 processes with 4 threads each incrementing one counter, which
+    # must not lose any update:
+    (processes, threads, increments) = (4, 4, 25)
+    def contention():
+        settings.set("bench_counter", 0)
+        workers = [multiprocessing.Process(target=settings_worker,
+            args=(threads, increments)) for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        expected = processes * threads * increments
+        if settings.get("bench_counter") != expected:
+            raise RuntimeError("settings lost updates: " +
+                str(settings.get("bench_counter")) + " instead of " +
+                str(expected))
+    yield ("settings.contention_4x4x25", contention, 1)
+
+def bench_launch():
+    import p4aspaces.buildenv as buildenv
+    from p4aspaces.dockerapi_fake import FakeDockerServer
+    from p4aspaces.settings import settings
+    env = [e for e in buildenv.get_environments()
+        if e.name == "p4a-py3-api28ndk21"][0]
+    workspace = tempfile.mkdtemp(prefix="bench-workspace-")
+
+    def launch(**kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            exit_code = env.launch_shell(launch_cmd="testbuild",
+                workspace=workspace, user_id_or_name="1000", **kwargs)
+        if exit_code != 0:
+            raise RuntimeError("launch failed with exit code " +
+                str(exit_code))
+
+    try:
+        # Docker CLI (the fake executable), existing image or rebuild:
+        settings.set("use_buildkit", False)
+        yield ("launch.cli", lambda: launch(), 1)
+        yield ("launch.cli_noninteractive",
+            lambda: launch(interactive=False, log_prefix="[bench] "), 1)
+        yield ("launch.cli_build",
+            lambda: launch(clean_image_rebuild=True), 1)
+        settings.set("use_buildkit", True)
+        yield ("launch.cli_buildkit_build",
+            lambda: launch(clean_image_rebuild=True), 1)
+        settings.set("use_buildkit", False)
+
+        # Engine API against the in-memory fake daemon:
+        old_host = os.environ["DOCKER_HOST"]
+        server = FakeDockerServer(os.path.join(
+            tempfile.gettempdir(), "fake-docker.sock"))
+        server.start()
+        try:
+            os.environ["DOCKER_HOST"] = server.url
+            yield ("launch.api_noninteractive",
+                lambda: launch(interactive=False, log_prefix="[bench] "),
+                1)
+            yield ("launch.api_build",
+                lambda: launch(interactive=False, log_prefix="[bench] ",
+                    clean_image_rebuild=True), 1)
+        finally:
+            os.environ["DOCKER_HOST"] = old_host
+            server.stop()
+    finally:
+        settings.set("use_buildkit", "auto")
+        shutil.rmtree(workspace, ignore_errors=True)
+
+GROUPS = [bench_startup, bench_environments, bench_settings, bench_launch]
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode(
+            "utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def main(args):
+    argparser = argparse.ArgumentParser(
+        description="Run the p4aspaces benchmarks (no docker daemon " +
+        "needed) and write the results as JSON")
+    argparser.add_argument("--output", default=None, dest="output",
+        help="file to write the JSON results to (default: stdout only " +
+        "shows the table)")
+    argparser.add_argument("--repeat", default=7, type=int,
+        dest="repeat", help="measured runs per benchmark (default: 7)")
+    argparser.add_argument("--filter", default="*", dest="filter",
+        help="only run benchmarks whose name matches this glob " +
+        "pattern, e.g. 'launch.*'")
+    args = argparser.parse_args(args)
+
+    base_dir = tempfile.mkdtemp(prefix="p4aspaces-bench-")
+    old_environ = dict(os.environ)
+    results = dict()
+    try:
+        setup_environment(base_dir)
+        for group in GROUPS:
+            for (name, func, number) in group():
+                if not fnmatch.fnmatch(name, args.filter):
+                    continue
+                results[name] = summarize(measure(func, args.repeat,
+                    number=number))
+                print("%-50s %10.3f ms  (median %.3f ms)" % (name,
+                    results[name]["min"] * 1000.0,
+                    results[name]["median"] * 1000.0), flush=True)
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environ)
+        tempfile.tempdir = None
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    output = {
+        "meta": {
+            "revision": git_revision(),
+            "time": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeat": args.repeat,
+        },
+        "benchmarks": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(json.dumps(output, indent=2, sort_keys=True))
+        print("Results written to " + args.output)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+# Compares two result files of benchmarks/bench.py, e.g. of two commits.
+# Exits with 1 if --fail-above is given and a benchmark got slower by
+# more than that fraction.
+
+import argparse
+import json
+import sys
+
+def load(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.loads(f.read())
+
+def main(args):
+    argparser = argparse.ArgumentParser(
+        description="Compare two benchmark result files")
+    argparser.add_argument("before", help="results of the baseline")
+    argparser.add_argument("after", help="results to compare")
+    argparser.add_argument("--metric", default="min", dest="metric",
+        choices=["min", "median", "mean"],
+        help="statistic to compare (default: min, the least noisy)")
+    argparser.add_argument("--fail-above", default=None, type=float,
+        dest="fail_above",
+        help="exit with an error if any benchmark got slower by more " +
+        "than this fraction, e.g. 0.1 for 10%%")
+    args = argparser.parse_args(args)
+
+    before = load(args.before)
+    after = load(args.after)
+    print("before: " + str(before["meta"].get("revision")) +
+        "\nafter:  " + str(after["meta"].get("revision")) + "\n")
+    print("%-50s %11s %11s %8s" % ("BENCHMARK", "BEFORE", "AFTER",
+        "CHANGE"))
+    regressions = []
+    names = sorted(set(before["benchmarks"].keys()) |
+        set(after["benchmarks"].keys()))
+    for name in names:
+        if name not in before["benchmarks"] or \
+                name not in after["benchmarks"]:
+            print("%-50s %s" % (name, "(only in " + ("after" if
+                name in after["benchmarks"] else "before") + ")"))
+            continue
+        old = before["benchmarks"][name][args.metric]
+        new = after["benchmarks"][name][args.metric]
+        change = (new - old) / old if old > 0 else 0.0
+        print("%-50s %9.3fms %9.3fms %+7.1f%%" % (name, old * 1000.0,
+            new * 1000.0, change * 100.0))
+        if args.fail_above is not None and change > args.fail_above:
+            regressions.append(name)
+    if len(regressions) > 0:
+        print("\nSlower by more than " + ("%.0f%%" %
+            (args.fail_above * 100.0)) + ": " + ", ".join(regressions),
+            file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
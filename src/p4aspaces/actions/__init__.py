@@ -20,34 +20,105 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 '''
 
-def actions():
-    from p4aspaces.actions.launch_cmd import launch_cmd
-    from p4aspaces.actions.launch_shell import launch_shell
-    from p4aspaces.actions.list_envs import list_envs
-    from p4aspaces.actions.print_dockerfile import print_dockerfile
+import importlib
+
+# The registry of all actions. Action modules import a lot (docker API
+# client, argparse setup, ...), so each one is only imported when its
+# action actually runs, and the registry itself is built once:
+_actions = None
+
+def lazy_action(module_name, function_name):
+    def run(args):
+        module = importlib.import_module(module_name)
+        return getattr(module, function_name)(args)
+    return run
 
+def actions():
+    global _actions
+    if _actions is not None:
+        return _actions
     actions = {
         "shell": {
             "description": "Launch a shell in a given build/testing " +
                 "environment, " +
                 "use \"list-envs\" for a full list of choices",
-            "function": launch_shell,
+            "function": lazy_action("p4aspaces.actions.launch_shell",
+                "launch_shell"),
         },
         "cmd": {
             "description": "Run a command in a given build/testing " +
                 "environment.",
-            "function": launch_cmd,
+            "function": lazy_action("p4aspaces.actions.launch_cmd",
+                "launch_cmd"),
+        },
+        "build-profile": {
+            "description": "Show the slowest steps of the last image " +
+                "build of an environment, as recorded in a Chrome " +
+                "trace-event file",
+            "function": lazy_action("p4aspaces.actions.build_profile",
+                "build_profile"),
+        },
+        "ccache": {
+            "description": "Show statistics of, prune or clear the " +
+                "compiler cache shared by the environments, or " +
+                "configure its size limit and namespaces",
+            "function": lazy_action("p4aspaces.actions.ccache",
+                "ccache_action"),
+        },
+        "export": {
+            "description": "Write the images of environments to one " +
+                "compressed bundle file, for use on machines " +
+                "without network access",
+            "function": lazy_action("p4aspaces.actions.bundle",
+                "export_action"),
+        },
+        "import": {
+            "description": "Load the images of a bundle written by " +
+                "\"export\", skipping the ones and the layers " +
+                "which exist already",
+            "function": lazy_action("p4aspaces.actions.bundle",
+                "import_action"),
+        },
+        "gc": {
+            "description": "Remove containers and temporary folders " +
+                "left behind by crashed launches, and evict the least " +
+                "recently used environment images above a disk budget",
+            "function": lazy_action("p4aspaces.actions.garbage_collect",
+                "gc_action"),
         },
         "list-envs": {
             "description": "List all available build/testing environments",
-            "function": list_envs,
+            "function": lazy_action("p4aspaces.actions.list_envs",
+                "list_envs"),
+        },
+        "matrix": {
+            "description": "Run a command in several build/testing " +
+                "environments in parallel, and print a summary " +
+                "of the results",
+            "function": lazy_action("p4aspaces.actions.matrix",
+                "matrix"),
+        },
+        "pool": {
+            "description": "Show or remove the idle pre-started " +
+                "containers kept around by the --pool option",
+            "function": lazy_action("p4aspaces.actions.pool",
+                "pool_action"),
         },
         "print-dockerfile": {
             "description": "Print out the combined Dockerfile which " +
                 "p4a-build-spaces will use internally for creating " +
                 "this environment",
-            "function": print_dockerfile,
+            "function": lazy_action("p4aspaces.actions.print_dockerfile",
+                "print_dockerfile"),
+        },
+        "serve": {
+            "description": "Run a job queue server with an HTTP API on " +
+                "a unix socket or localhost port, which runs builds " +
+                "without a terminal and keeps their logs and artifacts",
+            "function": lazy_action("p4aspaces.actions.serve",
+                "serve"),
         }
     }
-    return actions
+    _actions = actions
+    return _actions
 
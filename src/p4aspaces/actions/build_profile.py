@@ -0,0 +1,80 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import argparse
+import os
+import sys
+
+from p4aspaces.actions import actions
+import p4aspaces.buildprofile as buildprofile
+import p4aspaces.envindex as envindex
+
+def build_profile(args):
+    argparser = argparse.ArgumentParser(
+        description="action \"build-profile\": " +
+        str(actions()["build-profile"]["description"]))
+    argparser.add_argument("environment",
+        help="the environment whose last build should be shown")
+    argparser.add_argument("--top",
+        default=15, type=int, dest="top",
+        help="number of slowest steps to print (default: 15)")
+    argparser.add_argument("--trace-path",
+        default=False, action="store_true", dest="trace_path",
+        help="only print the path of the trace JSON file, e.g. to " +
+        "open it in chrome://tracing or https://ui.perfetto.dev")
+    args = argparser.parse_args(args)
+
+    if not envindex.is_environment(args.environment):
+        print("p4aspaces: error: " +
+            "no such environment found: '" + str(args.environment) + "'",
+            file=sys.stderr, flush=True)
+        sys.exit(1)
+    path = buildprofile.profile_path(args.environment)
+    if args.trace_path:
+        print(path)
+        sys.exit(0)
+    if not os.path.exists(path):
+        print("p4aspaces: error: no build profile for environment " +
+            "\"" + args.environment + "\" yet. It is recorded " +
+            "whenever the image gets (re)built, e.g. with " +
+            "--force-rebuild.", file=sys.stderr, flush=True)
+        sys.exit(1)
+    trace = buildprofile.load_trace(path)
+    events = trace.get("traceEvents", [])
+    total = sum([event["dur"] for event in events])
+    cached = len([event for event in events if event["cat"] == "cached"])
+    built = len([event for event in events if event["cat"] == "built"])
+    print("Image: " + str(trace.get("otherData", {}).get("image")))
+    print("Steps: " + str(len(events)) + " (" + str(built) +
+        " built, " + str(cached) + " cached), total " +
+        ("%.1fs" % (total / 1000000.0)))
+    print("")
+    print("%9s  %-8s  %s" % ("DURATION", "CACHE", "STEP"))
+    for event in sorted(events, key=lambda e: -e["dur"])[:args.top]:
+        name = " ".join(event["name"].split())
+        if len(name) > 60:
+            name = name[:57] + "..."
+        print("%8.1fs  %-8s  %s" % (event["dur"] / 1000000.0,
+            event["cat"], name))
+    print("")
+    print("Full trace: " + path)
+    sys.exit(0)
@@ -0,0 +1,123 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import argparse
+import fnmatch
+import os
+import sys
+
+from p4aspaces.actions import actions
+from p4aspaces.actions.launch_shell_or_cmd import check_docker_available
+import p4aspaces.buildenv as buildenv
+import p4aspaces.bundle as bundle
+import p4aspaces.ccache as ccache
+
+def export_action(args):
+    argparser = argparse.ArgumentParser(
+        description="action \"export\": " +
+        str(actions()["export"]["description"]))
+    argparser.add_argument("envs",
+        nargs="+",
+        help="Environments to export, as names or glob patterns " +
+        "like 'p4a-py3-*'. All local images of them are included")
+    argparser.add_argument("--output", "-o",
+        default="p4aspaces-bundle.tar.zst", dest="output",
+        help="Bundle file to write (default: p4aspaces-bundle.tar.zst)")
+    argparser.add_argument("--compression",
+        default="zstd", choices=bundle.COMPRESSIONS, dest="compression",
+        help="Compression of the bundle (default: zstd)")
+    argparser.add_argument("--level",
+        default=10, type=int, dest="level",
+        help="Compression level (default: 10)")
+    args = argparser.parse_args(args)
+
+    env_names = buildenv.get_environment_names()
+    chosen_names = []
+    for pattern in args.envs:
+        matches = fnmatch.filter(env_names, pattern)
+        if len(matches) == 0:
+            print("p4aspaces: error: no environment matching: '" +
+                str(pattern) + "'", file=sys.stderr, flush=True)
+            sys.exit(1)
+        chosen_names += [name for name in matches
+                         if name not in chosen_names]
+    check_docker_available()
+
+    def progress(total):
+        print("\rWritten " + ccache.format_size(total) + " of image " +
+            "data...", end="", file=sys.stderr, flush=True)
+    try:
+        metadata = bundle.export_bundle(chosen_names, args.output,
+            compression=args.compression, level=args.level,
+            on_progress=progress)
+    except bundle.BundleError as e:
+        print("\np4aspaces: error: " + str(e),
+            file=sys.stderr, flush=True)
+        sys.exit(1)
+    layers = set()
+    for image_layers in metadata["images"].values():
+        layers |= set(image_layers)
+    print("", file=sys.stderr)
+    for name in chosen_names:
+        if name not in metadata["environments"]:
+            print("p4aspaces: warning: skipped \"" + name + "\", " +
+                "which has no image yet", file=sys.stderr, flush=True)
+    print("Exported " + str(len(metadata["images"])) + " images (" +
+        str(len(layers)) + " distinct layers) to " + args.output +
+        ", " + ccache.format_size(os.path.getsize(args.output)) + ".")
+    sys.exit(0)
+
+def import_action(args):
+    argparser = argparse.ArgumentParser(
+        description="action \"import\": " +
+        str(actions()["import"]["description"]))
+    argparser.add_argument("bundle",
+        help="Bundle file written by 'p4aspaces export'")
+    argparser.add_argument("--all-layers",
+        default=False, action="store_true", dest="all_layers",
+        help="Pass all layers to docker, instead of leaving out the " +
+        "ones which already exist locally")
+    args = argparser.parse_args(args)
+    if not os.path.exists(args.bundle):
+        print("p4aspaces: error: no such file: " + str(args.bundle),
+            file=sys.stderr, flush=True)
+        sys.exit(1)
+    check_docker_available()
+
+    try:
+        stats = bundle.import_bundle(args.bundle,
+            skip_layers=(not args.all_layers),
+            on_output=lambda text: print(text, end="", flush=True))
+    except bundle.BundleError as e:
+        print("p4aspaces: error: " + str(e),
+            file=sys.stderr, flush=True)
+        sys.exit(1)
+    if stats["already_present"] == stats["images"]:
+        print("All " + str(stats["images"]) + " images are present " +
+            "already, nothing to load.")
+    else:
+        print("Imported " + str(stats["images"] -
+            stats["already_present"]) + " images, " +
+            str(stats["skipped_layers"]) + " layers (" +
+            ccache.format_size(stats["skipped_bytes"]) + ") were " +
+            "present already.")
+    sys.exit(0)
@@ -0,0 +1,94 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import argparse
+import sys
+
+from p4aspaces.actions import actions
+import p4aspaces.ccache as ccache
+from p4aspaces.settings import settings
+
+def ccache_action(args):
+    argparser = argparse.ArgumentParser(
+        description="action \"ccache\": " +
+        str(actions()["ccache"]["description"]))
+    argparser.add_argument("command",
+        choices=["stats", "prune", "clear", "config"],
+        help="'stats' shows the cache size, 'prune' removes the least " +
+        "recently used files until the cache is below the maximum size, " +
+        "'clear' removes everything, 'config' shows or changes the " +
+        "settings")
+    argparser.add_argument("--max-size",
+        default=None, dest="max_size",
+        help="Maximum cache size like '10G'. With 'prune', prune to " +
+        "this size once, with 'config', store it as the new default " +
+        "(currently: " + str(ccache.get_max_size()) + ")")
+    argparser.add_argument("--namespace",
+        default=None, dest="namespace", choices=ccache.NAMESPACES,
+        help="With 'config': use one shared cache for all environments, " +
+        "or a separate one per environment or per NDK")
+    argparser.add_argument("--name",
+        default=None, dest="name",
+        help="With 'clear': only clear the cache of this environment " +
+        "or NDK namespace (as listed by 'stats')")
+    args = argparser.parse_args(args)
+
+    if args.max_size is not None:
+        try:
+            ccache.parse_size(args.max_size)
+        except ValueError as e:
+            print("p4aspaces: error: " + str(e),
+                file=sys.stderr, flush=True)
+            sys.exit(1)
+
+    if args.command == "stats":
+        stats = ccache.stats()
+        print("ccache folder: " + ccache.ccache_root())
+        print("namespaces: " + ccache.get_namespace() +
+            ", maximum size: " + str(ccache.get_max_size()))
+        total = 0
+        for name in sorted(stats.keys()):
+            (count, size) = stats[name]
+            total += size
+            print("  " + name + ": " + str(count) + " files, " +
+                ccache.format_size(size))
+        print("total: " + ccache.format_size(total))
+    elif args.command == "prune":
+        (removed, freed) = ccache.prune(max_size=args.max_size)
+        print("Removed " + str(removed) + " files, freed " +
+            ccache.format_size(freed) + ".")
+    elif args.command == "clear":
+        try:
+            ccache.clear(name=args.name)
+        except ValueError as e:
+            print("p4aspaces: error: " + str(e),
+                file=sys.stderr, flush=True)
+            sys.exit(1)
+        print("Cleared.")
+    elif args.command == "config":
+        if args.max_size is not None:
+            settings.set("ccache_max_size", args.max_size)
+        if args.namespace is not None:
+            settings.set("ccache_namespace", args.namespace)
+        print("max size: " + str(ccache.get_max_size()))
+        print("namespaces: " + ccache.get_namespace())
+    sys.exit(0)
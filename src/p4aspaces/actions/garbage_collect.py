@@ -0,0 +1,107 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import argparse
+import sys
+import time
+
+from p4aspaces.actions import actions
+from p4aspaces.actions.launch_shell_or_cmd import check_docker_available
+import p4aspaces.ccache as ccache
+import p4aspaces.cleanup as cleanup
+import p4aspaces.dockerapi as dockerapi
+import p4aspaces.hosts as hosts
+from p4aspaces.settings import settings
+
+def gc_action(args):
+    argparser = argparse.ArgumentParser(
+        description="action \"gc\": " +
+        str(actions()["gc"]["description"]))
+    argparser.add_argument("command",
+        nargs="?", default="run", choices=["run", "status", "config"],
+        help="'run' (the default) removes orphaned containers and " +
+        "folders and evicts images above the disk budget, 'status' " +
+        "lists the environment images by last use, 'config' shows or " +
+        "changes the settings")
+    argparser.add_argument("--disk-budget",
+        default=None, dest="disk_budget",
+        help="Disk space all environment images may use, like '50G'. " +
+        "With 'run', evict down to this size once, with 'config', " +
+        "store it as the default ('none' to disable eviction)")
+    argparser.add_argument("--auto",
+        default=None, choices=["on", "off"], dest="auto",
+        help="With 'config': run a garbage collection pass after " +
+        "every launch")
+    argparser.add_argument("--dry-run",
+        default=False, action="store_true", dest="dry_run",
+        help="With 'run': only show what would be removed")
+    args = argparser.parse_args(args)
+
+    budget = None
+    if args.disk_budget is not None and args.disk_budget != "none":
+        try:
+            budget = ccache.parse_size(args.disk_budget)
+        except ValueError as e:
+            print("p4aspaces: error: " + str(e),
+                file=sys.stderr, flush=True)
+            sys.exit(1)
+
+    if args.command == "config":
+        if args.disk_budget is not None:
+            settings.set("gc_disk_budget", None
+                if args.disk_budget == "none" else args.disk_budget)
+        if args.auto is not None:
+            settings.set("gc_auto", args.auto == "on")
+        print("disk budget: " + str(settings.get("gc_disk_budget",
+            default=None) or "none"))
+        print("automatic: " + ("on" if settings.get("gc_auto",
+            default=False) else "off"))
+        sys.exit(0)
+
+    check_docker_available()
+    if budget is None:
+        budget = cleanup.get_disk_budget()
+    for host in (hosts.get_hosts() or [None]):
+        dockerapi.set_current_host(host)
+        if host is not None:
+            print("Docker host " + host + ":")
+        if args.command == "status":
+            images = cleanup.environment_images()
+            total = 0
+            for image in images:
+                total += image["size"]
+                print("  " + ", ".join(image["tags"]) + "\n     " +
+                    ccache.format_size(image["size"]) + ", last used " +
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(
+                    image["last_used"])))
+            print("total: " + ccache.format_size(total) +
+                ", disk budget: " + (ccache.format_size(budget)
+                if budget is not None else "none"))
+            continue
+        result = cleanup.collect(budget=budget, dry_run=args.dry_run,
+            on_message=print)
+        print(("Would remove " if args.dry_run else "Removed ") +
+            str(len(result["containers"])) + " containers, " +
+            str(len(result["temp_dirs"])) + " folders and " +
+            str(len(result["images"])) + " images (" +
+            ccache.format_size(result["freed"]) + " of evicted images).")
+    sys.exit(0)
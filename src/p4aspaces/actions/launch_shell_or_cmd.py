@@ -21,11 +21,23 @@ THE SOFTWARE.
 '''
 
 import argparse
+import os
 import subprocess
 import sys
+import time
 
 from p4aspaces.actions import actions
+import p4aspaces.artifacts as artifacts
 import p4aspaces.buildenv as buildenv
+import p4aspaces.cleanup as cleanup
+import p4aspaces.dockerapi as dockerapi
+import p4aspaces.hosts as hosts
+import p4aspaces.mounts as mounts
+import p4aspaces.resources as resources
+import p4aspaces.targets as targets
+from p4aspaces.settings import settings
+
+DOCKER_CHECK_MAX_AGE = 60
 
 def process_uname_arg(arg, complain_about_root=True):
     uname_or_id = arg
@@ -52,6 +64,10 @@ def process_uname_arg(arg, complain_about_root=True):
             print("COULDN'T RESOLVE USER ID: " + str(uname_or_id))
 
     if complain_about_root:
+        if not sys.stdin.isatty():
+            print("p4aspaces: error: no terminal to ask for the user, " +
+                "use the --map-to-user option.", file=sys.stderr, flush=True)
+            sys.exit(1)
         while True:
             print("Please specify a user on your host to "+
                 "use for permissions (to avoid running " +
@@ -72,6 +88,44 @@ def process_uname_arg(arg, complain_about_root=True):
     else:
         return "1"
 
+def check_docker_available(docker_host=None):
+    # With several docker hosts, one which is reachable is enough:
+    if docker_host is None and len(hosts.get_hosts()) > 0:
+        docker_host = "auto"
+    if docker_host is not None:
+        candidates = [docker_host]
+        if docker_host == "auto":
+            candidates = hosts.get_hosts()
+        if len([host for host in candidates if
+                hosts.running_containers(host) is not None]) > 0:
+            return
+        print("p4aspaces: error: no reachable docker host among: " +
+            ", ".join(candidates) + "\n       (the 'docker_hosts' " +
+            "setting lists the ones used with --docker-host auto)",
+            file=sys.stderr, flush=True)
+        sys.exit(1)
+    if dockerapi.get_client() is not None:
+        return
+    # Without API access, "docker ps" is the test, which is slow enough
+    # to remember a success for a minute:
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    last_check = settings.get("docker_check", type=dict)
+    if last_check.get("host", None) == docker_host and \
+            abs(time.time() - last_check.get("time", 0)) < \
+            DOCKER_CHECK_MAX_AGE:
+        return
+    try:
+        output = subprocess.check_output(["docker", "ps"],
+            stderr=subprocess.STDOUT)
+    except (subprocess.CalledProcessError,
+            FileNotFoundError) as e:
+        print("p4aspaces: error: `docker ps` test command failed. " +
+            "\n       Is docker running, and do we have access?",
+            file=sys.stderr, flush=True)
+        sys.exit(1)
+    settings.set("docker_check", {"host": docker_host,
+        "time": time.time()})
+
 def launch_shell_or_cmd(args, shell=False):
     if shell:
         argparser = argparse.ArgumentParser(
@@ -94,9 +148,12 @@ def launch_shell_or_cmd(args, shell=False):
         dest="maptouser")
     argparser.add_argument("--force-redownload-p4a",
         default=False, action="store_true",
-        help="Force docker to rebuild from the p4a download step " +
-        "(previous step remain cached), to ensure the newest version " +
-        "as present in the repo", dest="force_p4a_redownload")
+        help="Check for the newest commit of the p4a and buildozer " +
+        "branches right away, instead of using the commit looked up " +
+        "in the last few minutes (the p4a download step is rebuilt " +
+        "whenever the commit changed). For archive urls, force docker " +
+        "to rebuild from the p4a download step (previous steps remain " +
+        "cached)", dest="force_p4a_redownload")
     argparser.add_argument("--force-rebuild",
         default=False, action="store_true",
         help="Force docker to rebuild entire image from scratch, " +
@@ -112,16 +169,83 @@ def launch_shell_or_cmd(args, shell=False):
             "will be no access to files outside of the container",
             default=None, dest="buildozer_dir", nargs="?")
     if not shell:
-        argparser.add_argument("command", nargs=1,
-            help="The command to run, defaults to 'bash'. If you want to " +
+        argparser.add_argument("command", nargs="?",
+            help="The command to run. If you want to " +
             "just build the demo app, replace with 'testbuild' (which will " +
             "automatically write it's result to the --output target)",
-            default="bash")
+            default=None)
+        argparser.add_argument("--target",
+            default=None, action="append", dest="targets",
+            help="Instead of a command, build the test app for " +
+            "'bootstrap:arch[:requirements]', like 'sdl2:arm64-v8a' or " +
+            "'webview:armeabi-v7a:flask,python3'. Several bootstraps and " +
+            "archs can be given separated by commas, and --target can " +
+            "be given multiple times. All targets build at once in " +
+            "containers of their own, with the CPUs split between them, " +
+            "and the results of each are placed in a " +
+            "<bootstrap>-<arch> folder of --output (or the current " +
+            "directory)")
         argparser.add_argument("--output",
             help="Path where to place any .apk encountered after the " +
-            "build inside the build environments internal ~/output folder",
+            "build inside the build environments internal ~/output " +
+            "folder. If this is a directory (or ends with a slash), all " +
+            "files matching the --artifact patterns are placed there " +
+            "instead, along with a manifest.json of their sizes and " +
+            "SHA-256 hashes",
             default=None, nargs="?",
             dest="output_file")
+        argparser.add_argument("--artifact",
+            default=None, action="append", dest="artifact_patterns",
+            help="Pattern of files to collect from ~/output when " +
+            "--output is a directory, can be given multiple times. " +
+            "Defaults to the 'artifact_patterns' setting, or " +
+            ", ".join(["'" + p + "'" for p in artifacts.DEFAULT_PATTERNS]))
+    argparser.add_argument("--mount-mode",
+        default=None, dest="mount_mode", choices=mounts.MOUNT_MODES,
+        help="How to mount the workspace and caches: 'Z' relabels them " +
+        "for SELinux on every launch, 'z' uses a shared label, " +
+        "'nolabel' disables SELinux confinement for the container " +
+        "instead of relabeling, 'volume' delta-syncs --workspace and " +
+        "--buildozer_dir into persistent docker volumes and back after " +
+        "exit. Defaults to the 'mount_mode' setting, or '" +
+        mounts.DEFAULT_MOUNT_MODE + "'")
+    argparser.add_argument("--docker-host",
+        default=None, dest="docker_host",
+        help="Docker daemon to launch on, as DOCKER_HOST-style url like " +
+        "'tcp://buildhost:2375' or 'ssh://user@buildhost', or 'auto' to " +
+        "pick the least loaded one of the 'docker_hosts' setting " +
+        "(preferring hosts which have the image already). Defaults to " +
+        "'auto' if that setting is not empty. On remote hosts, the " +
+        "caches are kept in docker volumes, --workspace and " +
+        "--buildozer_dir are copied in, and changes to them are not " +
+        "copied back (only ~/output is)")
+    argparser.add_argument("--resources",
+        default=None, dest="resource_profile",
+        help="Resource profile of the container: 'auto' gives it the " +
+        "docker host's cores and 3/4 of its memory, divided among the " +
+        "launches running there at once, 'small' at most 2 cores and " +
+        "4G of that, '<cores>:<memory>' (like '16:32G') exactly that, " +
+        "and 'none' sets no limits. The native compiles, gradle " +
+        "workers and JVM heap are sized to fit. Defaults to the " +
+        "'resource_profile' setting, or '" + resources.DEFAULT_PROFILE +
+        "'")
+    argparser.add_argument("--gradle-daemon",
+        default=False, action="store_true",
+        help="Keep the gradle daemon enabled, which speeds up repeated " +
+        "builds in a long-lived shell (the gradle and maven caches " +
+        "are always kept between runs)", dest="gradle_daemon")
+    argparser.add_argument("--ccache-debug",
+        default=False, action="store_true",
+        help="Enable ccache debug logging to cache.debug.txt in the " +
+        "ccache folder (slows down native compiles)",
+        dest="ccache_debug")
+    argparser.add_argument("--pool",
+        default=None, type=int, dest="pool_size",
+        help="Keep this many pre-started idle containers per " +
+        "environment image around, so the next launch with the same " +
+        "options attaches to one instantly (use 'p4aspaces pool drain' " +
+        "to remove them). Defaults to the 'pool_size' setting, or 0 " +
+        "(disabled)")
     argparser.add_argument("--p4a",
         default=None, nargs="?",
         help="Specify p4a release archive to use " +
@@ -140,39 +264,48 @@ def launch_shell_or_cmd(args, shell=False):
     if shell:
         args.command = "bash"
         args.output_file = None
-    else:
-        if len(args.command) > 0:
-            args.command = args.command[0]
+        args.artifact_patterns = None
+    elif args.targets is not None:
+        if args.command is not None:
+            print("p4aspaces: error: --target builds the test apps, " +
+                "it can't be used with a command.",
+                file=sys.stderr, flush=True)
+            sys.exit(1)
+        try:
+            args.targets = targets.parse_targets(args.targets)
+        except ValueError as e:
+            print("p4aspaces: error: " + str(e),
+                file=sys.stderr, flush=True)
+            sys.exit(1)
+    elif args.command is None:
+        print("p4aspaces: error: the command to run is required " +
+            "(or use --target).", file=sys.stderr, flush=True)
+        sys.exit(1)
     if len(args.env) > 0:
         args.env = args.env[0]
 
-    # List environments:
-    envs = buildenv.get_environments()
+    # Choose environment:
+    env = buildenv.get_environment(args.env)
+    if env is None:
+        print("p4aspaces: error: Not a known environment. Aborting.",
+              file=sys.stderr, flush=True)
+        sys.exit(1)
 
-    # Test docker availability:
     try:
-        output = subprocess.check_output(["docker", "ps"],
-            stderr=subprocess.STDOUT)
-    except (subprocess.CalledProcessError,
-            FileNotFoundError) as e:
-        print("p4aspaces: error: `docker ps` test command failed. " +
-            "\n       Is docker running, and do we have access?",
-            file=sys.stderr, flush=True)
+        args.resource_profile = resources.get_profile(
+            args.resource_profile)
+    except ValueError as e:
+        print("p4aspaces: error: " + str(e), file=sys.stderr, flush=True)
         sys.exit(1)
 
+    # Test docker availability:
+    check_docker_available(args.docker_host)
+
     # Choose user:
     if type(args.maptouser) == list:
         args.maptouser = args.maptouser[0]
     uname_or_id = process_uname_arg(args.maptouser)
 
-    # Choose environment:
-    env_name = args.env
-    if len([env for env in envs if env.name == env_name]) == 0:
-        print("p4aspaces: error: Not a known environment. Aborting.",
-              file=sys.stderr, flush=True)
-        sys.exit(1)
-    env = [env for env in envs if env.name == env_name][0]
-
     # Choose download target:
     dl_target_p4a = "master"
     dl_target_buildozer = "stable"
@@ -181,9 +314,18 @@ def launch_shell_or_cmd(args, shell=False):
     if args.buildozer_url is not None:
         dl_target_buildozer = args.buildozer_url
 
+    # Choose pool size:
+    pool_size = args.pool_size
+    if pool_size is None:
+        pool_size = settings.get("pool_size", type=int)
+
     # Launch it:
     env.p4a_target = dl_target_p4a
     env.buildozer_target = dl_target_buildozer
+    if not shell and args.targets is not None:
+        exit_code = launch_targets(env, args, uname_or_id)
+        cleanup.auto_collect()
+        sys.exit(exit_code)
     env.launch_shell(
         force_p4a_refetch=args.force_p4a_redownload,
         output_file=args.output_file,
@@ -191,5 +333,73 @@ def launch_shell_or_cmd(args, shell=False):
         workspace=args.workspace,
         buildozer_dir=args.buildozer_dir,
         user_id_or_name=uname_or_id,
-        clean_image_rebuild=args.clean_image_rebuild)
+        clean_image_rebuild=args.clean_image_rebuild,
+        gradle_daemon=args.gradle_daemon,
+        ccache_debug=args.ccache_debug,
+        pool_size=pool_size,
+        artifact_patterns=args.artifact_patterns,
+        mount_mode=args.mount_mode,
+        docker_host=args.docker_host,
+        resource_profile=args.resource_profile,
+        interactive=sys.stdin.isatty())
+    cleanup.auto_collect()
+
+def launch_targets(env, args, uname_or_id):
+    # Runs the test app build of every target at once, each in its own
+    # container of the same image (sharing the compiler cache) and on
+    # its own share of the CPUs. Returns 0 if all of them succeeded.
+    from p4aspaces.actions.matrix import run_parallel, print_summary
+    output_dir = os.path.abspath(args.output_file or ".")
+    if os.path.exists(output_dir) and not os.path.isdir(output_dir):
+        print("p4aspaces: error: --output must be a directory with " +
+            "--target.", file=sys.stderr, flush=True)
+        sys.exit(1)
+    os.makedirs(output_dir, exist_ok=True)
+    cpusets = targets.split_cpus(len(args.targets))
+    if args.force_p4a_redownload:
+        # (Once up front, so all targets agree on the p4a download)
+        env.get_docker_file(force_p4a_refetch=True)
+    mount_mode = mounts.get_mount_mode(args.mount_mode)
+    if mount_mode == "volume":
+        # (Parallel runs would sync the same workspace volume back)
+        mount_mode = "Z"
+
+    def make_job(target, cpuset):
+        name = targets.target_name(target)
+        target_output = os.path.join(output_dir, name)
+        def job():
+            exit_code = env.launch_shell(
+                output_file=target_output + os.path.sep,
+                launch_cmd=targets.target_command(target),
+                workspace=args.workspace,
+                buildozer_dir=args.buildozer_dir,
+                user_id_or_name=uname_or_id,
+                clean_image_rebuild=args.clean_image_rebuild,
+                ccache_debug=args.ccache_debug,
+                artifact_patterns=args.artifact_patterns,
+                mount_mode=mount_mode,
+                docker_host=args.docker_host,
+                interactive=False,
+                log_prefix="[" + name + "] ",
+                cpuset=cpuset,
+                resource_profile=args.resource_profile,
+                concurrency=-(-len(args.targets) //
+                    hosts.host_count(args.docker_host)))
+            # (Only an explicit 0 counts as success)
+            if exit_code == 0:
+                return 0
+            return exit_code if isinstance(exit_code, int) else 1
+        return (name, job)
 
+    results = run_parallel([make_job(target, cpuset) for (target, cpuset)
+        in zip(args.targets, cpusets)], max_workers=len(args.targets))
+    for result in results:
+        apks = artifacts.find_artifacts(os.path.join(output_dir,
+            result["name"]), patterns=["*.apk", "*.aab"])
+        if len(apks) > 0:
+            result["apk"] = os.path.join(output_dir, result["name"],
+                apks[0])
+    print_summary(results)
+    if all([result["exit_code"] == 0 for result in results]):
+        return 0
+    return 1
@@ -24,7 +24,7 @@ import argparse
 import sys
 
 from p4aspaces.actions import actions
-import p4aspaces.buildenv as buildenv
+import p4aspaces.envindex as envindex
 
 def list_envs(args):
     argparser = argparse.ArgumentParser(
@@ -33,13 +33,13 @@ def list_envs(args):
     args = argparser.parse_args(args)
 
     # List environments:
-    envs = buildenv.get_environments()
+    env_names = envindex.get_environment_names()
     print("Available environments:")
-    for env in envs:
-        print("  " + env.name + "\n     " + env.description)
+    for env_name in env_names:
+        print("  " + env_name + "\n     " +
+            envindex.read_description(env_name))
     print("")
     print("Launch shell with:\n" +
-        "  p4aspaces shell " +
-        sorted([env.name for env in envs])[0])
+        "  p4aspaces shell " + env_names[0])
     sys.exit(0)
 
@@ -0,0 +1,221 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import argparse
+import concurrent.futures
+import fnmatch
+import os
+import sys
+import time
+
+from p4aspaces.actions import actions
+from p4aspaces.actions.launch_shell_or_cmd import \
+    check_docker_available, process_uname_arg
+import p4aspaces.buildenv as buildenv
+import p4aspaces.cleanup as cleanup
+import p4aspaces.hosts as hosts
+import p4aspaces.mounts as mounts
+import p4aspaces.resources as resources
+
+def run_parallel(jobs, max_workers):
+    # Run (name, function) jobs in a bounded worker pool. Returns a
+    # list of result dicts with the exit code and duration of each job:
+    def run_job(name, func):
+        start = time.monotonic()
+        try:
+            exit_code = func()
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            with buildenv.output_lock:
+                print("[" + name + "] p4aspaces: error: " + str(e),
+                    file=sys.stderr, flush=True)
+            exit_code = 1
+        # (Only an explicit 0 counts as success, a job which didn't
+        # report its exit code failed)
+        if not isinstance(exit_code, int):
+            exit_code = 1
+        return {"name": name,
+                "exit_code": exit_code,
+                "duration": time.monotonic() - start}
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(run_job, name, func)
+                   for (name, func) in jobs]
+        return [future.result() for future in futures]
+
+def print_summary(results):
+    rows = [["NAME", "RESULT", "EXIT", "DURATION", "APK"]]
+    for result in results:
+        rows.append([
+            result["name"],
+            "ok" if result["exit_code"] == 0 else "FAILED",
+            str(result["exit_code"]),
+            "%dm%02ds" % divmod(int(result["duration"]), 60),
+            result.get("apk", None) or "-",
+        ])
+    widths = [max([len(row[i]) for row in rows])
+              for i in range(len(rows[0]))]
+    print("")
+    for row in rows:
+        print("  ".join([row[i].ljust(widths[i])
+                         for i in range(len(row))]).rstrip())
+
+def matrix(args):
+    argparser = argparse.ArgumentParser(
+        description="action \"matrix\": " +
+        str(actions()["matrix"]["description"]))
+    argparser.add_argument("envs", nargs="+",
+        help="Environment names or glob patterns (like 'p4a-py3-*') " +
+        "of the environments to run the command in. Use " +
+        "'p4aspaces list-envs' to list available environments")
+    argparser.add_argument("--command",
+        default="testbuild", dest="command",
+        help="The command to run in each environment, defaults to " +
+        "'testbuild'")
+    argparser.add_argument("--jobs", "-j",
+        default=None, type=int, dest="jobs",
+        help="How many environments to run at once, defaults to " +
+        "all of them (at most 4 per docker host)")
+    argparser.add_argument("--output-dir",
+        default=None, dest="output_dir",
+        help="Directory where to place the .apk of each environment, " +
+        "as <environment name>.apk")
+    argparser.add_argument("--map-to-user",
+        default="interactive_prompt", nargs=1,
+        help="The unprivileged user which to run as, see " +
+        "'p4aspaces cmd --help'",
+        dest="maptouser")
+    argparser.add_argument("--workspace",
+        help="Specify a workspace directory to be mounted into all " +
+        "build environments at ~/workspace",
+        default=None, dest="workspace", nargs="?")
+    argparser.add_argument("--mount-mode",
+        default=None, dest="mount_mode",
+        choices=[mode for mode in mounts.MOUNT_MODES if mode != "volume"],
+        help="How to mount the workspace and caches, see " +
+        "'p4aspaces cmd --help' ('volume' is not available here, since " +
+        "parallel runs would sync the same workspace volume back)")
+    argparser.add_argument("--docker-host",
+        default=None, dest="docker_host",
+        help="Docker daemon to run on, or 'auto' to spread the runs " +
+        "over the hosts of the 'docker_hosts' setting, see " +
+        "'p4aspaces cmd --help'")
+    argparser.add_argument("--resources",
+        default=None, dest="resource_profile",
+        help="Resource profile of the containers, see " +
+        "'p4aspaces cmd --help'. With 'auto', the runs divide the " +
+        "host between them")
+    argparser.add_argument("--force-rebuild",
+        default=False, action="store_true",
+        help="Force docker to rebuild all images from scratch, " +
+        "without using any caching", dest="clean_image_rebuild")
+    argparser.add_argument("--p4a",
+        default=None, nargs="?",
+        help="Specify p4a release archive or branch to use, " +
+        "see 'p4aspaces cmd --help'", dest="p4a_url")
+    argparser.add_argument("--buildozer",
+        default=None, nargs="?",
+        help="Specify buildozer release archive or branch to use, " +
+        "see 'p4aspaces cmd --help'", dest="buildozer_url")
+    args = argparser.parse_args(args)
+
+    # Choose environments:
+    env_names = buildenv.get_environment_names()
+    chosen_names = []
+    for pattern in args.envs:
+        matches = fnmatch.filter(env_names, pattern)
+        if len(matches) == 0:
+            print("p4aspaces: error: no environment matching: '" +
+                str(pattern) + "'", file=sys.stderr, flush=True)
+            sys.exit(1)
+        chosen_names += [name for name in matches
+                         if name not in chosen_names]
+
+    # Test docker availability:
+    check_docker_available(args.docker_host)
+
+    # Choose user (once, before anything runs in parallel):
+    if type(args.maptouser) == list:
+        args.maptouser = args.maptouser[0]
+    uname_or_id = process_uname_arg(args.maptouser)
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    mount_mode = mounts.get_mount_mode(args.mount_mode)
+    if mount_mode == "volume":
+        mount_mode = "Z"
+
+    try:
+        resource_profile = resources.get_profile(args.resource_profile)
+    except ValueError as e:
+        print("p4aspaces: error: " + str(e), file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    # Choose how many run at once:
+    host_count = hosts.host_count(args.docker_host)
+    jobs = args.jobs
+    if jobs is None:
+        jobs = min(4 * host_count, len(chosen_names))
+    per_host = -(-min(jobs, len(chosen_names)) // host_count)
+
+    def make_job(env_name):
+        env = buildenv.get_environment(env_name,
+            p4a_target=(args.p4a_url or "master"),
+            buildozer_target=(args.buildozer_url or "stable"))
+        output_file = None
+        if args.output_dir is not None:
+            output_file = os.path.join(os.path.abspath(
+                args.output_dir), env_name + ".apk")
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        def job():
+            return env.launch_shell(
+                output_file=output_file,
+                launch_cmd=args.command,
+                workspace=args.workspace,
+                user_id_or_name=uname_or_id,
+                clean_image_rebuild=args.clean_image_rebuild,
+                interactive=False,
+                log_prefix="[" + env_name + "] ",
+                mount_mode=mount_mode,
+                docker_host=args.docker_host,
+                resource_profile=resource_profile,
+                concurrency=per_host)
+        return (env_name, job)
+
+    # Run all environments:
+    results = run_parallel([make_job(name) for name in chosen_names],
+        max_workers=jobs)
+    for result in results:
+        if args.output_dir is not None:
+            apk_path = os.path.join(os.path.abspath(
+                args.output_dir), result["name"] + ".apk")
+            if os.path.exists(apk_path):
+                result["apk"] = apk_path
+    print_summary(results)
+    cleanup.auto_collect()
+    if len([r for r in results if r["exit_code"] != 0]) > 0:
+        sys.exit(1)
+    sys.exit(0)
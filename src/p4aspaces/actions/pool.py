@@ -0,0 +1,49 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import argparse
+import sys
+
+from p4aspaces.actions import actions
+import p4aspaces.pool as pool
+
+def pool_action(args):
+    argparser = argparse.ArgumentParser(
+        description="action \"pool\": " +
+        str(actions()["pool"]["description"]))
+    argparser.add_argument("command", choices=["status", "drain"],
+        help="'status' lists the idle pre-started containers, " +
+        "'drain' stops and removes all of them")
+    args = argparser.parse_args(args)
+
+    pooled = pool.list_pooled()
+    if args.command == "status":
+        if len(pooled) == 0:
+            print("No idle pooled containers.")
+        for (name, key, image, folder) in pooled:
+            print("  " + name + "\n     image: " + image +
+                ", pool: " + key)
+        sys.exit(0)
+    for (name, key, image, folder) in pooled:
+        print("Removing " + name + "...")
+        pool.remove_pooled(name, folder)
+    sys.exit(0)
@@ -3,8 +3,8 @@ import argparse
 import sys
 
 from p4aspaces.actions import actions
-from p4aspaces.actions.launch_shell_or_cmd import process_uname_arg
 import p4aspaces.buildenv as buildenv
+import p4aspaces.dockeropt as dockeropt
 
 def print_dockerfile(args):
     argparser = argparse.ArgumentParser(
@@ -14,31 +14,41 @@ def print_dockerfile(args):
         "of which to print the combined Dockerfile")
     argparser.add_argument("--map-to-user",
         default="root", nargs=1,\
-        help="The unprivileged user which the Dockerfile should use."
-        " If none is specified, defaults to unsafe root",
+        help="Ignored, only kept for compatibility: the image is the " +
+        "same for all users now, the user is chosen when launching",
         dest="maptouser")
+    argparser.add_argument("--buildkit",
+        default=False, action="store_true",
+        help="Print the BuildKit variant with cache mounts for apt " +
+        "and pip downloads, as used when BuildKit is available",
+        dest="buildkit")
+    argparser.add_argument("--raw",
+        default=False, action="store_true",
+        help="Print the Dockerfile as rendered from the templates, " +
+        "without merging RUN instructions and apt cleanups",
+        dest="raw")
+    argparser.add_argument("--optimize",
+        default=False, action="store_true",
+        help="Merge RUN instructions and apt cleanups even if the " +
+        "optimize_dockerfile setting is off (default: only then)",
+        dest="optimize")
     args = argparser.parse_args(args)
 
-    # Get user:
-    if type(args.maptouser) == list:
-        args.maptouser = args.maptouser[0]
-    uname_or_uid = process_uname_arg(
-        args.maptouser,
-        complain_about_root=False
-    )
-
     # Get environment:
-    envs = buildenv.get_environments()
-    env = None
-    for _env in envs:
-        if _env.name == args.env:
-            env = _env
-            break
+    env = buildenv.get_environment(args.env)
     if env is None:
         print("p4aspaces: error: " +
             "no such environment found: '" + str(args.env) + "'",
             file=sys.stderr, flush=True)
         sys.exit(1)
-    print(env.get_docker_file(add_workspace=True,
-        user_id_or_name=uname_or_uid))
+    # (Only with the refs earlier launches resolved, so this neither
+    # goes online nor changes the settings)
+    docker_file = env.get_docker_file(add_workspace=True,
+        buildkit=args.buildkit,
+        targets=env.resolve_targets(cached_only=True))
+    if not args.raw and (args.optimize or dockeropt.enabled()):
+        (docker_file, report) = dockeropt.optimize(docker_file)
+        print(dockeropt.format_report(report), file=sys.stderr,
+            flush=True)
+    print(docker_file)
     sys.exit(0)
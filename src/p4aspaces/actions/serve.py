@@ -0,0 +1,116 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import argparse
+import os
+import sys
+
+from p4aspaces.actions import actions
+from p4aspaces.actions.launch_shell_or_cmd import \
+    check_docker_available, process_uname_arg
+import p4aspaces.server as server
+
+def serve(args):
+    argparser = argparse.ArgumentParser(
+        description="action \"serve\": " +
+        str(actions()["serve"]["description"]))
+    argparser.add_argument("--socket",
+        default=None, dest="socket",
+        help="Unix socket to listen on (default: " +
+        "serve.sock in the p4a-build-spaces settings folder)")
+    argparser.add_argument("--port",
+        default=None, type=int, dest="port",
+        help="Listen on this localhost TCP port instead of a unix " +
+        "socket. Requests then need the token from serve.token in " +
+        "the settings folder, as \"Authorization: Bearer <token>\"")
+    argparser.add_argument("--jobs", "-j",
+        default=2, type=int, dest="jobs",
+        help="How many jobs to run at once (default: 2)")
+    argparser.add_argument("--map-to-user",
+        default=None, dest="maptouser",
+        help="The unprivileged user jobs run as unless they specify " +
+        "one, see 'p4aspaces cmd --help' (default: the user running " +
+        "the server)")
+    argparser.add_argument("--allow-user",
+        default=[], action="append", dest="allowusers",
+        help="Also allow jobs to ask for this user (repeatable). " +
+        "Jobs asking for any other user than the default are rejected")
+    argparser.add_argument("--workspace-root",
+        default=[], action="append", dest="workspaceroots",
+        help="Allow workspaces and buildozer folders inside this " +
+        "folder (repeatable). Without it, jobs can't use a workspace")
+    argparser.add_argument("--verbose",
+        default=False, action="store_true", dest="verbose",
+        help="Log every request")
+    args = argparser.parse_args(args)
+
+    check_docker_available()
+    default_user = os.getuid()
+    if args.maptouser is not None:
+        default_user = process_uname_arg(args.maptouser,
+            complain_about_root=False)
+        if not isinstance(default_user, int):
+            print("p4aspaces: error: unknown user in --map-to-user: " +
+                args.maptouser, file=sys.stderr, flush=True)
+            sys.exit(1)
+
+    allowed_users = []
+    for user in args.allowusers:
+        uid = process_uname_arg(user, complain_about_root=False)
+        if not isinstance(uid, int):
+            print("p4aspaces: error: unknown user in --allow-user: " +
+                user, file=sys.stderr, flush=True)
+            sys.exit(1)
+        allowed_users.append(uid)
+    for root in args.workspaceroots:
+        if not os.path.isdir(root):
+            print("p4aspaces: error: workspace root is not a folder: " +
+                root, file=sys.stderr, flush=True)
+            sys.exit(1)
+
+    jobs = server.JobQueue(max_running=args.jobs,
+        default_user=default_user, allowed_users=allowed_users,
+        workspace_roots=args.workspaceroots)
+    if args.port is not None:
+        httpd = server.JobServer(("127.0.0.1", args.port), jobs,
+            server.get_token(), verbose=args.verbose)
+        address = "http://127.0.0.1:" + str(args.port) + \
+            " (token in " + server.token_path() + ")"
+    else:
+        socket_path = args.socket or server.default_socket_path()
+        httpd = server.UnixJobServer(socket_path, jobs,
+            verbose=args.verbose)
+        address = "unix socket " + socket_path
+    jobs.start()
+    print("Serving on " + address + " with " + str(jobs.max_running) +
+        " parallel jobs, " + str(len(jobs.pending)) + " queued.",
+        flush=True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        jobs.stop()
+        httpd.server_close()
+        if args.port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    sys.exit(0)
@@ -0,0 +1,157 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import errno
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import time
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from .settings import settings
+
+# Collects build results from the container's ~/output folder. If the
+# --output target is a directory, every file matching the configured
+# patterns is moved there together with a manifest.json. Files are moved
+# by rename if possible, otherwise hardlinked, reflinked or copied in the
+# kernel with copy_file_range, and only copied byte by byte as a last
+# resort, since release builds can be big.
+DEFAULT_PATTERNS = ["*.apk", "*.aab", "*.log"]
+MANIFEST_NAME = "manifest.json"
+FICLONE = 0x40049409  # linux ioctl for reflinks (btrfs, xfs)
+
+def get_patterns():
+    patterns = settings.get("artifact_patterns", default=None)
+    if not isinstance(patterns, list) or len(patterns) == 0:
+        return list(DEFAULT_PATTERNS)
+    return [str(pattern) for pattern in patterns]
+
+def find_artifacts(output_dir, patterns=None):
+    # Relative paths of all files below output_dir matching a pattern:
+    if patterns is None:
+        patterns = get_patterns()
+    result = []
+    for (dirpath, dirnames, filenames) in os.walk(output_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            full_path = os.path.join(dirpath, filename)
+            if os.path.islink(full_path):
+                continue
+            rel_path = os.path.relpath(full_path, output_dir)
+            if any([fnmatch.fnmatch(filename, pattern) or
+                    fnmatch.fnmatch(rel_path, pattern)
+                    for pattern in patterns]):
+                result.append(rel_path)
+    return result
+
+def copy_file_range(source, target):
+    with open(source, "rb") as fsrc, open(target, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        if not hasattr(os, "copy_file_range"):
+            raise OSError(errno.ENOSYS, "copy_file_range not available")
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                min(remaining, 1024 * 1024 * 1024))
+            if copied == 0:
+                break
+            remaining -= copied
+    return "copy_file_range"
+
+def move_file(source, target):
+    # Moves source to target as cheaply as possible. Returns the method
+    # used. (The source folder gets removed afterwards, so a hardlink
+    # or reflink is as good as a move.)
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.rename(source, target)
+        return "rename"
+    except OSError:
+        pass
+    try:
+        os.link(source, target)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        return copy_file_range(source, target)
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+    shutil.copyfile(source, target)
+    return "copy"
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def collect(output_dir, target, patterns=None, info=None):
+    # If target is a directory (or ends with a slash), move all matching
+    # artifacts there and write a manifest. Otherwise move the first .apk
+    # to the target file, like earlier versions did. Returns the list of
+    # manifest entries.
+    if target.endswith(os.path.sep) or os.path.isdir(target):
+        os.makedirs(target, exist_ok=True)
+        entries = []
+        for rel_path in find_artifacts(output_dir, patterns=patterns):
+            if rel_path == MANIFEST_NAME:
+                continue
+            target_path = os.path.join(target, rel_path)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            method = move_file(os.path.join(output_dir, rel_path),
+                target_path)
+            entries.append({
+                "path": rel_path.replace(os.path.sep, "/"),
+                "size": os.path.getsize(target_path),
+                "sha256": sha256_file(target_path),
+                "method": method,
+            })
+        manifest = dict(info or dict())
+        manifest["created"] = time.time()
+        manifest["artifacts"] = entries
+        manifest_path = os.path.join(target, MANIFEST_NAME)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps(manifest, indent=2, sort_keys=True))
+        os.replace(manifest_path + ".tmp", manifest_path)
+        return entries
+    for rel_path in find_artifacts(output_dir, patterns=["*.apk"]):
+        method = move_file(os.path.join(output_dir, rel_path), target)
+        return [{"path": os.path.basename(target),
+            "size": os.path.getsize(target), "method": method}]
+    return []
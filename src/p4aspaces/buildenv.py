@@ -20,16 +20,87 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 '''
 
+import hashlib
 import os
+from . import artifacts
+from . import buildprofile
+from . import ccache
+from . import cleanup
+from . import dockerapi
+from . import dockeropt
+from . import envindex
+from .envindex import get_environments_dir, get_environment_names, \
+    is_environment
+from . import gitrefs
+from . import hosts
+from . import mounts
+from . import resources
+from . import testapps
+from .pool import ContainerPool
 from .settings import settings
 import shlex
 import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
 import uuid
 import urllib.parse
 
+output_lock = threading.Lock()
+build_locks = dict()
+build_locks_lock = threading.Lock()
+build_counts = dict()
+
+def shell_quote(value):
+    return "'" + str(value).replace("'", "'\"'\"'") + "'"
+
+def call_logged(cmd, cwd=None, log_prefix=None, buildkit=False,
+        on_output=None):
+    # Like subprocess.call(), but if log_prefix is given, prefix every
+    # output line with it (used when running several launches at once).
+    # If on_output is given, all output text is passed to it instead:
+    env = None
+    if buildkit:
+        env = dict(os.environ)
+        env["DOCKER_BUILDKIT"] = "1"
+    if log_prefix is None and on_output is None:
+        return subprocess.call(cmd, cwd=cwd, env=env)
+    if on_output is None:
+        on_output = OutputPrinter(log_prefix)
+    process = subprocess.Popen(cmd, cwd=cwd, env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(process.stdout.readline, b""):
+        on_output(line.decode("utf-8", "replace"))
+    process.stdout.close()
+    on_output.flush()
+    return process.wait()
+
+class OutputPrinter(object):
+    # Prints streamed output text chunks, with log_prefix in front of
+    # every line if given (see call_logged()):
+    def __init__(self, log_prefix=None):
+        self.log_prefix = log_prefix
+        self.buf = ""
+
+    def __call__(self, text):
+        if self.log_prefix is None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            return
+        self.buf += text
+        while "\n" in self.buf:
+            (line, _, self.buf) = self.buf.partition("\n")
+            with output_lock:
+                print(self.log_prefix + line.rstrip(), flush=True)
+
+    def flush(self):
+        if len(self.buf) > 0:
+            self("\n")
+
 class BuildEnvironment(object):
     def __init__(self,
             folder_path,
@@ -45,56 +116,120 @@ class BuildEnvironment(object):
         self.envs_dir = envs_base_dir
         self.p4a_target = p4a_target
         self.buildozer_target = buildozer_target
-        self.description = open(
-            os.path.join(self.path, "short_description.txt"),
-            "r",
-            encoding="utf-8"
-        ).read().strip().partition("\n")[0]
+        self._description = None
 
-    def get_docker_file(self,
-            force_p4a_refetch=False,
-            launch_cmd="bash",
-            start_dir="/home/userhome",
-            add_workspace=False,
-            user_id_or_name="root"):
-        image_name = "p4atestenv-" + str(self.name)
+    @property
+    def description(self):
+        # (Read on first use, most commands don't need it)
+        if self._description is None:
+            self._description = envindex.read_description(self.name,
+                envs_dir=os.path.dirname(self.path))
+        return self._description
 
-        # Obtain p4a build uuid (to control docker caching):
-        env_settings = settings.get("environments", type=dict)
-        if not self.name in env_settings:
-            env_settings[self.name] = dict()
-        if not "last_build_p4a_uuid" in env_settings[self.name] or \
-                force_p4a_refetch:
-            build_p4a_uuid = str(uuid.uuid4())
-        else:
-            build_p4a_uuid = env_settings[self.name]["last_build_p4a_uuid"]
-        env_settings[self.name]["last_build_p4a_uuid"] = build_p4a_uuid
-        settings.set("environments", env_settings)
+    @property
+    def ndk_id(self):
+        # Name of the NDK this environment downloads, e.g.
+        # "android-ndk-r17c-linux-x86_64" (used for ccache namespaces):
+        with open(os.path.join(self.path, "Dockerfile"), "r") as f:
+            for line in f.read().splitlines():
+                (instruction, _, value) = line.strip().partition(" ")
+                (key, _, value) = value.partition("=")
+                if instruction == "ENV" and key in ["NDK_DL",
+                        "CRYSTAX_FILE"]:
+                    value = os.path.basename(value.strip().strip("\""))
+                    if value.endswith(".zip"):
+                        value = value[:-len(".zip")]
+                    return value
+        return self.name
 
+    def resolve_targets(self, force_p4a_refetch=False, cached_only=False):
+        # Returns a dict with the pip install targets of p4a & buildozer
+        # ("p4a", "buildozer"), the comment which makes the install layer
+        # change when they do ("p4a_comment"), and the TestAppSource of
+        # the test apps ("testapps"). With cached_only=True, only what
+        # earlier launches resolved is used, and the settings are left
+        # alone:
         dl_target_p4a = self.p4a_target
         dl_target_buildozer = self.buildozer_target
         def process_dl_target(package_name, dl_target, repo, default=None):
-            if dl_target is None or len(dl_target_p4a.strip()) == 0:
+            # Returns the pip install target, and the commit it is pinned
+            # to (branches and tags get resolved to their current commit,
+            # so the install layer changes exactly when upstream moved):
+            if dl_target is None or len(dl_target.strip()) == 0:
                 dl_target = default
-            elif dl_target == "stable":
-                dl_target = package_name
+            if dl_target == "stable":
+                return (package_name, None)
             elif dl_target.find("/") < 0 and \
                     dl_target.find("\\") < 0:  # probably a branch
-                dl_target = repo + "/" +\
-                    "archive/" + urllib.parse.quote(dl_target) + ".zip"
-            else:
-                dl_target = str(dl_target).strip()
-            return dl_target
-        dl_target_p4a = process_dl_target(
+                commit = gitrefs.resolve(repo, dl_target,
+                    refresh=force_p4a_refetch, cached_only=cached_only)
+                return (repo + "/" + "archive/" + urllib.parse.quote(
+                    commit or dl_target) + ".zip", commit)
+            return (str(dl_target).strip(), None)
+        (dl_target_p4a, p4a_commit) = process_dl_target(
             "python-for-android", dl_target_p4a,
-            "https://github.com/kivy/python-for-android",
-            default=("https://github.com/kivy/python-for-android/"
-                     "archive/master.zip"))
-        dl_target_buildozer = process_dl_target(
+            testapps.P4A_REPO,
+            default="master")
+        (dl_target_buildozer, buildozer_commit) = process_dl_target(
             "buildozer", dl_target_buildozer,
             "https://github.com/kivy/buildozer",
-            default="buildozer")
+            default="stable")
+        p4a_version = None
+        if dl_target_p4a == "python-for-android":
+            # The pypi release gets pinned to its version, and its test
+            # apps to the commit of that release:
+            p4a_version = gitrefs.resolve_release("python-for-android",
+                refresh=force_p4a_refetch, cached_only=cached_only)
+            if p4a_version is not None:
+                dl_target_p4a = "python-for-android==" + p4a_version
+                p4a_commit = gitrefs.resolve_version(testapps.P4A_REPO,
+                    p4a_version, refresh=force_p4a_refetch,
+                    cached_only=cached_only)
+
+        if p4a_commit is not None:
+            p4a_comment = "p4a " + str(p4a_version or self.p4a_target or
+                "master") + " at " + p4a_commit
+        else:
+            # Not pinned to a commit (e.g. an archive url, or resolving
+            # failed), so use a p4a build uuid to control docker caching.
+            # Only write the settings if a new one is needed:
+            build_p4a_uuid = settings.get("environments", type=dict).get(
+                self.name, dict()).get("last_build_p4a_uuid", None)
+            if build_p4a_uuid is None and cached_only:
+                # (Never built, the next launch picks a new one)
+                build_p4a_uuid = str(uuid.uuid4())
+            elif build_p4a_uuid is None or force_p4a_refetch:
+                with settings.transaction() as store:
+                    env_settings = store.setdefault("environments", dict())
+                    env_settings.setdefault(self.name, dict())
+                    build_p4a_uuid = env_settings[self.name].get(
+                        "last_build_p4a_uuid", None)
+                    if build_p4a_uuid is None or force_p4a_refetch:
+                        build_p4a_uuid = str(uuid.uuid4())
+                    env_settings[self.name]["last_build_p4a_uuid"] = \
+                        build_p4a_uuid
+            p4a_comment = "p4a build " + str(build_p4a_uuid)
+        return {"p4a": dl_target_p4a, "buildozer": dl_target_buildozer,
+            "p4a_comment": p4a_comment,
+            "testapps": testapps.get_source(dl_target_p4a,
+                commit=p4a_commit, key=p4a_comment,
+                refresh=force_p4a_refetch, cached_only=cached_only)}
+
+    def get_docker_file(self,
+            force_p4a_refetch=False,
+            start_dir="/home/userhome",
+            add_workspace=False,
+            buildkit=False,
+            targets=None):
+        # targets are the resolve_targets() results to use, if they were
+        # resolved already:
+        if targets is None:
+            targets = self.resolve_targets(
+                force_p4a_refetch=force_p4a_refetch)
 
+        with open(os.path.join(self.envs_dir, "shared_base.txt"),
+                  "r") as f:
+            shared_base_instructions = f.read().strip()
         with open(os.path.join(self.envs_dir, "setup_user_env.txt"),
                   "r") as f:
             setup_user_env_instructions = f.read().strip()
@@ -108,45 +243,45 @@ class BuildEnvironment(object):
             t = f.read()
             install_shared_instructions_user = \
                 install_shared_instructions_user.replace(
-                "{P4A_URL}", "'" + str(
-                dl_target_p4a.replace("'", "'\"'\"'")) + "'").replace(
-                "{P4A_COMMENT}", " # " +
-                "p4a build " + str(build_p4a_uuid)).replace(
-                "{BUILDOZER_URL}", "'" + str(
-                dl_target_buildozer.replace("'", "'\"'\"'")) + "'"
+                "{P4A_URL}", shell_quote(targets["p4a"])).replace(
+                "{P4A_COMMENT}", " # " + targets["p4a_comment"]).replace(
+                "{BUILDOZER_URL}", shell_quote(targets["buildozer"])
                 )
             setup_user_env_instructions = \
                 setup_user_env_instructions.replace(
                 "{INSTALL_SHARED_PACKAGES_USER}",
-                install_shared_instructions_user)
+                install_shared_instructions_user).replace(
+                "{TESTAPPS_SOURCE}", targets["testapps"].describe())
             t = t.replace(
+                "{SHARED_BASE}", shared_base_instructions).replace(
                 "{SETUP_USER_ENV}", setup_user_env_instructions).replace(
                 "{INSTALL_SHARED_PACKAGES}", install_shared_instructions)
-            t = t.replace(
-                "{LAUNCH_CMD}",
-                launch_cmd.replace("\\", "\\\\").replace(
-                "\"", "\\\"").replace("\n", "\\n").replace(
-                "\r", "\\r").replace("'", "'\"'\"'"))
-            if user_id_or_name == "root" or str(user_id_or_name) == "0":
-                t = t.replace("{PREPARE_USER}", "ENV HOME /home/userhome\n" +
-                    "ENV BUILDUSERNAME root")
-                t = t.replace("{DROP_TO_USER}", "")
+
+            # BuildKit cache mounts for apt and pip downloads (which the
+            # built-in frontend supports, so no "# syntax" line, which
+            # would pull the frontend image on every build):
+            if buildkit:
+                t = t.replace("{APT_KEEP_CACHE}",
+                    "RUN rm -f /etc/apt/apt.conf.d/docker-clean && " +
+                    "echo 'Binary::apt::APT::Keep-Downloaded-Packages " +
+                    "\"true\";' > /etc/apt/apt.conf.d/keep-cache")
+                t = t.replace("{CACHE_APT}",
+                    "--mount=type=cache,target=/var/cache/apt," +
+                    "sharing=locked " +
+                    "--mount=type=cache,target=/var/lib/apt/lists," +
+                    "sharing=locked ")
+                t = t.replace("{CACHE_PIP}",
+                    "--mount=type=cache,target=/root/.cache/pip ")
+                # (HOME points to the user's home folder by then, so
+                # pip needs to be told to use the same cache as root:)
+                t = t.replace("{CACHE_PIP_USER}",
+                    "--mount=type=cache,target=/root/.cache/pip " +
+                    "export PIP_CACHE_DIR=/root/.cache/pip && ")
             else:
-                uid = 1000
-                uname = "builduser"
-                try:
-                    uid = int(user_id_or_name)
-                except (TypeError, ValueError):
-                    uid = 1000
-                    uname = user_id_or_name
-                t = t.replace("{PREPARE_USER}",
-                    "RUN useradd -b /home -d /home/userhome/ -u " +
-                        str(uid) + " " + str(uname) + "\n" +
-                    "RUN chown -R " + str(uname) + " /home/userhome\n" +
-                    "ENV BUILDUSERNAME " + str(uname) + "\n" +
-                    "ENV HOME " + "/home/userhome")
-                t = t.replace("{DROP_TO_USER}",
-                    "USER " + str(uname))
+                t = t.replace("{APT_KEEP_CACHE}", "").replace(
+                    "{CACHE_APT}", "").replace(
+                    "{CACHE_PIP}", "").replace(
+                    "{CACHE_PIP_USER}", "")
 
             t = t.replace(
                 "{START_DIR}", start_dir).replace(
@@ -154,6 +289,47 @@ class BuildEnvironment(object):
                     "VOLUME /home/userhome/workspace/")
             return t
 
+    def get_image_tag(self, docker_file):
+        # Content-addressed image name, e.g. "p4atestenv-<name>:<hash>",
+        # so launches rendering the same Dockerfile share one image:
+        digest = hashlib.sha256(
+            docker_file.encode("utf-8")).hexdigest()[:16]
+        return "p4atestenv-" + str(self.name) + ":" + digest
+
+    @staticmethod
+    def buildkit_available():
+        # Whether to build with BuildKit: the "use_buildkit" setting can
+        # force it on or off, otherwise we check for the buildx plugin
+        # (and remember the result for a day, to keep launches fast):
+        use_buildkit = settings.get("use_buildkit", default="auto")
+        if use_buildkit != "auto":
+            return bool(use_buildkit)
+        check = settings.get("buildkit_check", type=dict)
+        if time.time() - check.get("time", 0) < 24 * 60 * 60:
+            return check.get("available", False)
+        try:
+            available = (subprocess.call(["docker", "buildx", "version"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL) == 0)
+        except FileNotFoundError:
+            available = False
+        settings.set("buildkit_check", {"time": time.time(),
+            "available": available})
+        return available
+
+    @staticmethod
+    def image_exists(image_tag):
+        client = dockerapi.get_client()
+        if client is not None:
+            return client.image_exists(image_tag)
+        try:
+            return subprocess.call(dockerapi.docker_command() +
+                ["image", "inspect", image_tag],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL) == 0
+        except FileNotFoundError:
+            return False
+
     def launch_shell(self,
             force_p4a_refetch=False,
             launch_cmd="bash",
@@ -162,103 +338,444 @@ class BuildEnvironment(object):
             buildozer_dir=None,
             clean_image_rebuild=False,
             user_id_or_name="root",
-            ccache_dir=os.path.join(tempfile.gettempdir(), "p4a-ccache")
+            ccache_dir=None,
+            ccache_debug=False,
+            gradle_dir=None,
+            gradle_daemon=False,
+            interactive=True,
+            log_prefix=None,
+            pool_size=0,
+            artifact_patterns=None,
+            mount_mode=None,
+            docker_host=None,
+            on_output=None,
+            cpuset=None,
+            resource_profile=None,
+            concurrency=1
             ):
+        # on_output receives all build and container output instead of
+        # it being printed, if given (interactive must be False then).
+        # cpuset limits a local container to the given CPUs.
+        # concurrency is the number of launches the caller runs at once
+        # (see resources.py).
         # Build container:
         image_name = "p4atestenv-" + str(self.name)
         container_name = image_name + "-" +\
             str(uuid.uuid4()).replace("-", "")
-        temp_d = tempfile.mkdtemp(prefix="p4a-testing-space-")
+        temp_d = tempfile.mkdtemp(prefix=cleanup.TEMP_PREFIX)
+        cleanup.write_owner(temp_d)
+        output_dir = os.path.join(temp_d, "output")
+        pooled_folder = None
+        fill_thread = None
+        mount_plan = None
+        host = None
+        previous_host = dockerapi.get_current_host()
         try:
-            os.mkdir(os.path.join(temp_d, "output"))
+            os.mkdir(output_dir)
+            buildkit = self.buildkit_available()
+            targets = self.resolve_targets(
+                force_p4a_refetch=force_p4a_refetch)
+            docker_file = self.get_docker_file(
+                buildkit=buildkit,
+                targets=targets,
+                start_dir=("/home/userhome/" if workspace is None else \
+                                    "/home/userhome/workspace/"),
+                add_workspace=(workspace is not None),
+            )
+            optimize_report = None
+            if dockeropt.enabled():
+                (docker_file, optimize_report) = \
+                    dockeropt.optimize(docker_file)
             with open(os.path.join(temp_d, "Dockerfile"), "w") as f:
-                f.write(self.get_docker_file(
-                    force_p4a_refetch=force_p4a_refetch,
-                    launch_cmd=launch_cmd,
-                    user_id_or_name=user_id_or_name,
-                    start_dir=("/home/userhome/" if workspace is None else \
-                                        "/home/userhome/workspace/"),
-                    add_workspace=(workspace is not None),
-                ))
-            
-            # Build container:
-            no_cache_opts = []
-            if clean_image_rebuild:
-                no_cache_opts.append("--no-cache")
-            cmd = ["docker", "build"] + no_cache_opts + [
-                "-t", image_name, "--file", os.path.join(
-                temp_d, "Dockerfile"), "."]
-            if subprocess.call(cmd, cwd=temp_d) != 0:
-                print("p4spaces: error: build failed.",
-                    file=sys.stderr)
-                sys.exit(1)
+                f.write(docker_file)
+
+            # Choose the docker host (see hosts.py), and build the
+            # container there, unless an image for this exact Dockerfile
+            # already exists on it:
+            image_tag = self.get_image_tag(docker_file)
+            host = hosts.choose_host(docker_host, image_tag,
+                container_name)
+            if host is not None:
+                dockerapi.set_current_host(host)
+                if log_prefix is None:
+                    print("Launching on docker host " + host + "...",
+                        file=sys.stderr, flush=True)
+            remote = not hosts.is_local(host)
+            client = dockerapi.get_client()
+            # Launches of the same image from several threads (like
+            # "cmd --target") wait for a single build of it:
+            build_key = (host, image_tag)
+            with build_locks_lock:
+                build_lock = build_locks.setdefault(build_key,
+                    threading.Lock())
+                builds_before = build_counts.get(build_key, 0)
+            with build_lock:
+                # (A build by another launch while we waited counts as
+                # our --force-rebuild, too)
+                rebuild = clean_image_rebuild and \
+                    build_counts.get(build_key, 0) == builds_before
+                if rebuild or not self.image_exists(image_tag):
+                    if optimize_report is not None and \
+                            on_output is not None:
+                        on_output(dockeropt.format_report(
+                            optimize_report) + "\n")
+                    elif optimize_report is not None:
+                        with output_lock:
+                            print((log_prefix or "") +
+                                dockeropt.format_report(optimize_report),
+                                file=sys.stderr, flush=True)
+                    # The test apps are part of the build context:
+                    try:
+                        testapps.prepare(targets["testapps"], temp_d)
+                    except testapps.TestAppsError as e:
+                        print("p4aspaces: error: getting the test apps " +
+                            "failed: " + str(e), file=sys.stderr,
+                            flush=True)
+                        sys.exit(1)
+                    profiler = buildprofile.BuildProfiler(
+                        on_output or OutputPrinter(log_prefix))
+                    if client is not None and not buildkit:
+                        build_ok = client.build(temp_d, image_tag,
+                            nocache=rebuild, on_output=profiler,
+                            labels={cleanup.IMAGE_LABEL: self.name})
+                        profiler.flush()
+                    else:
+                        build_opts = []
+                        if rebuild:
+                            build_opts.append("--no-cache")
+                        if buildkit:
+                            build_opts.append("--progress=plain")
+                        build_opts += ["--label",
+                            cleanup.IMAGE_LABEL + "=" + self.name]
+                        cmd = dockerapi.docker_command() + ["build"] + \
+                            build_opts + [
+                            "-t", image_tag, "--file", os.path.join(
+                            temp_d, "Dockerfile"), "."]
+                        build_ok = (call_logged(cmd, cwd=temp_d,
+                            buildkit=buildkit, on_output=profiler) == 0)
+                    profiler.write_trace(buildprofile.profile_path(
+                        self.name), image_tag=image_tag)
+                    if not build_ok:
+                        print("p4spaces: error: build failed.",
+                            file=sys.stderr)
+                        sys.exit(1)
+                    build_counts[build_key] = \
+                        build_counts.get(build_key, 0) + 1
+            cleanup.record_image_use(image_tag)
 
             # Ensure output directory is writable:
-            os.system("chmod 777 '" +
-                os.path.join(temp_d, "output").replace("'", "'\"'\"'")
-                + "'")
+            os.chmod(output_dir, 0o777)
 
             # Ensure ccache directory exists & is writable:
-            os.makedirs(shlex.quote(ccache_dir), exist_ok=True)
-            os.makedirs(shlex.quote(
-                os.path.join(ccache_dir, "contents")), exist_ok=True)
-            os.makedirs(shlex.quote(
-                os.path.join(ccache_dir, "pip-build-dir")), exist_ok=True)
-            try:
-                uid = int(user_id_or_name)
-            except (TypeError, ValueError):
-                uid = 1000
-            os.system("chown -R " + str(uid) + " -- " + shlex.quote(ccache_dir))
-            os.system("chmod a-rx -- " + shlex.quote(ccache_dir))
-            os.system("chmod u+rx -- " + shlex.quote(ccache_dir))
+            if ccache_dir is None:
+                ccache_dir = ccache.get_ccache_dir(self)
+            # (Only the top-level folders need fixing up, everything
+            # inside them gets created by the container user.)
+            (uid, gid) = get_user_ids(user_id_or_name)
+            for path in [ccache_dir, os.path.join(ccache_dir, "contents"),
+                    os.path.join(ccache_dir, "pip-build-dir")]:
+                os.makedirs(path, exist_ok=True)
+                try:
+                    if os.stat(path).st_uid != uid:
+                        os.chown(path, uid, gid)
+                except PermissionError:
+                    pass
+            # Only accessible for the owner:
+            mode = os.stat(ccache_dir).st_mode & 0o7777
+            if (mode & ~0o055) | 0o500 != mode:
+                try:
+                    os.chmod(ccache_dir, (mode & ~0o055) | 0o500)
+                except PermissionError:
+                    pass
+
+            # Ensure gradle & maven cache directories exist, and are
+            # owned by the user (one folder per user, like with ccache):
+            if gradle_dir is None:
+                gradle_dir = os.path.join(tempfile.gettempdir(),
+                    "p4a-gradle-" + str(uid))
+            for path in [gradle_dir, os.path.join(gradle_dir, "gradle"),
+                    os.path.join(gradle_dir, "m2")]:
+                os.makedirs(path, exist_ok=True)
+                try:
+                    if os.stat(path).st_uid != uid:
+                        os.chown(path, uid, gid)
+                except PermissionError:
+                    pass
+            mode = os.stat(gradle_dir).st_mode & 0o7777
+            if (mode & ~0o077) | 0o700 != mode:
+                try:
+                    os.chmod(gradle_dir, (mode & ~0o077) | 0o700)
+                except PermissionError:
+                    pass
 
             # Launch shell:
-            workspace_volume_args = []
-            if workspace != None:
-                workspace_volume_args += ["-v",
-                    os.path.abspath(workspace) +
-                    ":/home/userhome/workspace:rw,Z"]
-            buildozer_dir_volume_args = []
-            if buildozer_dir != None:
-                buildozer_dir_volume_args += ["-v",
-                    os.path.abspath(buildozer_dir) +
-                    ":/home/userhome/.buildozer:rw,Z"]
-            cmd = ["docker", "run",
-                "--name", container_name, "-ti",
-                "-v", os.path.join(temp_d, "output") +
-                ":/home/userhome/output:rw,Z",
-                "-v", ccache_dir + ":/ccache/:rw,Z"] +\
-                workspace_volume_args +\
-                buildozer_dir_volume_args + [
-                image_name
-            ]
-            subprocess.call(cmd)
+            mount_plan = mounts.MountPlan(mount_mode, image_tag)
+            output_bind = output_dir + ":/home/userhome/output" + \
+                mounts.bind_options(mount_plan.mode)
+            uploads = []
+            if remote:
+                # Host folders can't be mounted on a remote docker host:
+                # the caches live in volumes there instead, and the
+                # workspace gets copied in before the container starts.
+                binds = hosts.cache_volumes(ccache_dir, uid)
+                if workspace != None:
+                    uploads.append((workspace, "/home/userhome/workspace"))
+                if buildozer_dir != None:
+                    uploads.append((buildozer_dir,
+                        "/home/userhome/.buildozer"))
+            else:
+                binds = [
+                    mount_plan.bind(ccache_dir, "/ccache/"),
+                    mount_plan.bind(os.path.join(gradle_dir, "gradle"),
+                        "/home/userhome/.gradle"),
+                    mount_plan.bind(os.path.join(gradle_dir, "m2"),
+                        "/home/userhome/.m2")]
+                if workspace != None:
+                    binds.append(mount_plan.bind(workspace,
+                        "/home/userhome/workspace", sync_large=True))
+                if buildozer_dir != None:
+                    binds.append(mount_plan.bind(buildozer_dir,
+                        "/home/userhome/.buildozer", sync_large=True))
+            environment = ["CCACHE_MAXSIZE=" + str(ccache.get_max_size()),
+                "P4AS_UID=" + str(uid), "P4AS_GID=" + str(gid)]
+            if gradle_daemon:
+                environment.append("P4AS_GRADLE_DAEMON=true")
+            if ccache_debug:
+                environment += ["CCACHE_DEBUG=1",
+                    "CCACHE_LOGFILE=/ccache/contents/cache.debug.txt"]
+            volume_args = mount_plan.run_args()
+            for bind in binds:
+                volume_args += ["-v", bind]
+            for variable in environment:
+                volume_args += ["-e", variable]
+            # (The limits depend on the current load, so they are kept
+            # out of the pool key, and applied to pooled containers when
+            # they are claimed)
+            pool_args = list(volume_args)
+            limits = resources.get_limits(resource_profile,
+                concurrency=concurrency)
+            limits_environment = resources.environment(limits)
+            environment += limits_environment
+            for variable in limits_environment:
+                volume_args += ["-e", variable]
+            volume_args += resources.run_args(limits)
+            cpu_args = []
+            if cpuset is not None and not remote:
+                cpu_args = ["--cpuset-cpus", cpuset]
+
+            # Claim a pre-started container from the pool if enabled,
+            # and have the pool start a replacement in the background:
+            command = shlex.split(launch_cmd)
+            pool = None
+            if pool_size > 0 and not remote and cpuset is None:
+                pool = ContainerPool(image_tag, pool_args,
+                    size=pool_size, user=(uid, gid),
+                    output_options=mounts.bind_options(mount_plan.mode))
+                pooled_folder = pool.claim(container_name,
+                    limits=limits)
+                if pooled_folder is not None:
+                    cleanup.write_owner(pooled_folder)
+                # (Refilled while the command runs)
+                fill_thread = threading.Thread(target=fill_pool,
+                    args=(pool, host), daemon=True)
+                fill_thread.start()
+            if pooled_folder is not None:
+                output_dir = os.path.join(pooled_folder, "output")
+                exit_code = call_logged(pool.exec_command(container_name,
+                    command, interactive=interactive,
+                    environment=limits_environment),
+                    log_prefix=log_prefix,
+                    on_output=on_output)
+            elif remote:
+                exit_code = run_remote(image_tag, container_name, command,
+                    binds, environment, uploads, output_dir, (uid, gid),
+                    interactive=interactive, log_prefix=log_prefix,
+                    on_output=on_output, limits=limits)
+            elif client is not None and not interactive:
+                printer = on_output or OutputPrinter(log_prefix)
+                exit_code = client.run(image_tag, name=container_name,
+                    cmd=command, binds=[output_bind] + binds, env=environment,
+                    labels={cleanup.OWNER_LABEL: cleanup.owner_id()},
+                    on_output=printer,
+                    security_opt=mounts.security_options(mount_plan.mode),
+                    cpuset=cpuset,
+                    nano_cpus=(limits[0] * 1e9 if limits else None),
+                    memory=(limits[1] if limits else None))
+                printer.flush()
+            else:
+                cmd = dockerapi.docker_command() + ["run",
+                    "--name", container_name,
+                    "--label", cleanup.OWNER_LABEL + "=" +
+                    cleanup.owner_id()] +\
+                    (["-ti"] if interactive else []) + [
+                    "-v", output_bind] +\
+                    volume_args + cpu_args + [
+                    image_tag
+                ] + command
+                exit_code = call_logged(cmd, log_prefix=log_prefix,
+                    on_output=on_output)
             if output_file is not None:
-                for f in os.listdir(os.path.join(temp_d, "output")):
-                    full_path = os.path.join(temp_d, "output", f)
-                    if not os.path.isdir(full_path) and f.endswith(".apk"):
-                        shutil.copyfile(full_path, output_file)
-                        return
+                artifacts.collect(output_dir, output_file,
+                    patterns=artifact_patterns,
+                    info={"environment": self.name, "image": image_tag,
+                        "command": launch_cmd,
+                        "exit_code": exit_code})
+            return exit_code
         finally:
             try:
-                os.system(
-                    "docker kill " + container_name +
-                    " > /dev/null 2>&1")
-                print("Removing container...")
-                os.system("docker rm " + container_name)
+                if log_prefix is None:
+                    print("Removing container...")
+                remove_container(container_name)
+                if mount_plan is not None and len(mount_plan.synced) > 0:
+                    if log_prefix is None:
+                        print("Syncing workspace back...")
+                    if not mount_plan.sync_back():
+                        print("p4aspaces: warning: syncing the " +
+                            "workspace back from its volume failed.",
+                            file=sys.stderr, flush=True)
             finally:
                 shutil.rmtree(temp_d)
+                if pooled_folder is not None:
+                    shutil.rmtree(pooled_folder, ignore_errors=True)
+                if fill_thread is not None:
+                    fill_thread.join()
+                if host is not None:
+                    hosts.release(host, container_name)
+                dockerapi.set_current_host(previous_host)
+
+def fill_pool(pool, host):
+    # (In a thread of its own, which needs to be told the docker host)
+    dockerapi.set_current_host(host)
+    pool.fill()
+
+def folder_tar(host_path, name, user):
+    # A temporary file with a tar of the host folder as name/, owned by
+    # the given (uid, gid):
+    def owned(info):
+        (info.uid, info.gid) = user
+        info.uname = info.gname = ""
+        return info
+    f = tempfile.TemporaryFile()
+    with tarfile.open(fileobj=f, mode="w") as tar:
+        tar.add(os.path.abspath(host_path), arcname=name, filter=owned)
+    f.seek(0)
+    return f
+
+def extract_output(stream, output_dir):
+    # Extracts the tar of the container's ~/output folder (which has
+    # output/ as its top folder) into output_dir:
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            parts = member.name.split("/")
+            if parts[0] != "output" or ".." in parts or \
+                    not (member.isfile() or member.isdir()):
+                continue
+            member.name = "/".join(parts[1:]) or "."
+            member.mode |= 0o600
+            tar.extract(member, path=output_dir)
+
+def run_remote(image_tag, container_name, command, binds, environment,
+        uploads, output_dir, user, interactive=False, log_prefix=None,
+        on_output=None, limits=None):
+    # Runs the container on a docker host which can't see our folders:
+    # the uploads (host folder, container folder) are copied in before
+    # it starts, and its ~/output is copied into output_dir after it
+    # exited. Returns the exit code.
+    client = dockerapi.get_client()
+    if client is not None and not interactive:
+        client.create_container(image_tag, name=container_name,
+            cmd=command, binds=binds, env=environment,
+            labels={cleanup.OWNER_LABEL: cleanup.owner_id()},
+            nano_cpus=(limits[0] * 1e9 if limits else None),
+            memory=(limits[1] if limits else None))
+        for (host_path, container_path) in uploads:
+            with folder_tar(host_path, os.path.basename(container_path),
+                    user) as f:
+                client.put_archive(container_name,
+                    os.path.dirname(container_path), f)
+        client.start(container_name)
+        printer = on_output or OutputPrinter(log_prefix)
+        client.follow_logs(container_name, printer)
+        printer.flush()
+        exit_code = client.wait(container_name)
+        with client.get_archive(container_name,
+                "/home/userhome/output") as response:
+            extract_output(response, output_dir)
+        return exit_code
+    cmd = dockerapi.docker_command() + ["create",
+        "--name", container_name, "--label",
+        cleanup.OWNER_LABEL + "=" + cleanup.owner_id()] + \
+        (["-ti"] if interactive else [])
+    for bind in binds:
+        cmd += ["-v", bind]
+    for variable in environment:
+        cmd += ["-e", variable]
+    cmd += resources.run_args(limits)
+    if subprocess.call(cmd + [image_tag] + command,
+            stdout=subprocess.DEVNULL) != 0:
+        print("p4aspaces: error: creating the container failed.",
+            file=sys.stderr, flush=True)
+        return 1
+    for (host_path, container_path) in uploads:
+        # ("-a" keeps the owner, which is the user we map to)
+        if subprocess.call(dockerapi.docker_command() + ["cp", "-a",
+                os.path.join(os.path.abspath(host_path), "."),
+                container_name + ":" + container_path]) != 0:
+            print("p4aspaces: error: copying " + str(host_path) +
+                " to the docker host failed.", file=sys.stderr, flush=True)
+            return 1
+    exit_code = call_logged(dockerapi.docker_command() + ["start", "-a"] +
+        (["-i"] if interactive else []) + [container_name],
+        log_prefix=log_prefix, on_output=on_output)
+    subprocess.call(dockerapi.docker_command() + ["cp",
+        container_name + ":/home/userhome/output/.", output_dir],
+        stdout=subprocess.DEVNULL)
+    return exit_code
+
+def get_user_ids(user_id_or_name):
+    # The (uid, gid) the container runs as. Names which aren't numeric
+    # ids were resolved on the host already, so they map to 1000:
+    if user_id_or_name == "root" or str(user_id_or_name) == "0":
+        return (0, 0)
+    try:
+        uid = int(user_id_or_name)
+    except (TypeError, ValueError):
+        uid = 1000
+    try:
+        import pwd
+        gid = pwd.getpwuid(uid).pw_gid
+    except (ImportError, KeyError):
+        gid = uid
+    return (uid, gid)
+
+def remove_container(container_name):
+    # Kill & remove the container, if it exists:
+    client = dockerapi.get_client()
+    if client is not None:
+        try:
+            client.remove(container_name, force=True)
+        except dockerapi.DockerAPIError as e:
+            if e.status != 404:
+                raise
+        return
+    subprocess.call(dockerapi.docker_command() + ["rm", "-f",
+        container_name],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def get_environment(name, p4a_target="master",
+        buildozer_target="stable"):
+    # The environment with the given name, or None, without looking at
+    # any of the others:
+    if not is_environment(name):
+        return None
+    envs_dir = get_environments_dir()
+    return BuildEnvironment(os.path.join(envs_dir, name), envs_dir,
+        p4a_target=p4a_target, buildozer_target=buildozer_target)
 
 def get_environments(for_p4a_target="master"):
-    envs_dir = os.path.abspath(os.path.join(
-        os.path.dirname(__file__), "environments"))
-    env_names = [p for p in os.listdir(envs_dir) if (
-        os.path.isdir(os.path.join(envs_dir, p)) and
-        os.path.exists(os.path.join(envs_dir, p,
-                                    "short_description.txt")) and
-        not p.startswith("."))]
+    envs_dir = get_environments_dir()
     result = [BuildEnvironment(os.path.join(envs_dir, env_name),
                                envs_dir,
                                p4a_target=for_p4a_target) \
-              for env_name in sorted(env_names)]
+              for env_name in get_environment_names()]
     return result
@@ -0,0 +1,148 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import json
+import os
+import re
+import time
+
+from .settings import settings
+
+# Parses "docker build" output as it streams by into per-instruction
+# timings, for both the classic builder ("Step 3/40 : RUN ...") and
+# BuildKit's plain progress output ("#7 [ 3/40] RUN ...", "#7 CACHED",
+# "#7 DONE 12.3s"), and writes them as a Chrome trace-event file
+# (viewable in chrome://tracing or https://ui.perfetto.dev).
+CLASSIC_STEP = re.compile(r"^Step (\d+)/\d+ : (.*)$")
+BUILDKIT_STEP = re.compile(r"^#(\d+) (\[[^\]]+\] .*)$")
+BUILDKIT_CACHED = re.compile(r"^#(\d+) CACHED\s*$")
+BUILDKIT_DONE = re.compile(r"^#(\d+) (DONE ([0-9.]+)s|ERROR.*)\s*$")
+
+def profile_path(env_name):
+    return os.path.join(settings.settings_folder(),
+        "build-profiles", env_name + ".json")
+
+class BuildProfiler(object):
+    def __init__(self, on_output=None):
+        # on_output receives all output text unchanged (e.g. to print it):
+        self.on_output = on_output
+        self.buf = ""
+        self.start_time = time.monotonic()
+        self.steps = []
+        self.current = None
+        self.buildkit_steps = dict()
+
+    def __call__(self, text):
+        if self.on_output is not None:
+            self.on_output(text)
+        self.buf += text
+        while "\n" in self.buf:
+            (line, _, self.buf) = self.buf.partition("\n")
+            self.parse_line(line.rstrip("\r"))
+
+    def flush(self):
+        if len(self.buf) > 0:
+            self.parse_line(self.buf)
+            self.buf = ""
+        self.finish_step()
+        for step in self.buildkit_steps.values():
+            if step["end"] is None:
+                step["end"] = time.monotonic()
+        if self.on_output is not None and \
+                hasattr(self.on_output, "flush"):
+            self.on_output.flush()
+
+    def finish_step(self):
+        if self.current is not None:
+            self.current["end"] = time.monotonic()
+            self.current = None
+
+    def parse_line(self, line):
+        now = time.monotonic()
+        match = CLASSIC_STEP.match(line)
+        if match:
+            self.finish_step()
+            self.current = {"id": int(match.group(1)),
+                "name": match.group(2).strip(), "start": now,
+                "end": None, "cached": None}
+            self.steps.append(self.current)
+            return
+        if self.current is not None:
+            if line.startswith(" ---> Using cache"):
+                self.current["cached"] = True
+            elif line.startswith(" ---> Running in"):
+                self.current["cached"] = False
+            elif line.startswith("Successfully built"):
+                self.finish_step()
+            return
+        match = BUILDKIT_STEP.match(line)
+        if match:
+            step_id = int(match.group(1))
+            if step_id not in self.buildkit_steps:
+                step = {"id": step_id, "name": match.group(2).strip(),
+                    "start": now, "end": None, "cached": False}
+                self.buildkit_steps[step_id] = step
+                self.steps.append(step)
+            return
+        match = BUILDKIT_CACHED.match(line)
+        if match and int(match.group(1)) in self.buildkit_steps:
+            step = self.buildkit_steps[int(match.group(1))]
+            step["cached"] = True
+            step["end"] = now
+            return
+        match = BUILDKIT_DONE.match(line)
+        if match and int(match.group(1)) in self.buildkit_steps:
+            step = self.buildkit_steps[int(match.group(1))]
+            if step["end"] is None:
+                step["end"] = now
+                if match.group(3) is not None:
+                    # Prefer BuildKit's own, more precise duration:
+                    step["start"] = now - float(match.group(3))
+
+    def trace_events(self):
+        events = []
+        # BuildKit durations can reach back before the first output line:
+        origin = min([self.start_time] +
+            [step["start"] for step in self.steps])
+        for step in self.steps:
+            end = step["end"] if step["end"] is not None \
+                else time.monotonic()
+            cached = {True: "cached", False: "built",
+                None: "metadata"}[step["cached"]]
+            events.append({"name": step["name"], "cat": cached,
+                "ph": "X", "pid": 1, "tid": 1,
+                "ts": int((step["start"] - origin) * 1000000),
+                "dur": int(max(0.0, end - step["start"]) * 1000000),
+                "args": {"step": step["id"], "cached": step["cached"]}})
+        return events
+
+    def write_trace(self, path, image_tag=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"traceEvents": self.trace_events(),
+                "displayTimeUnit": "ms",
+                "otherData": {"image": image_tag,
+                    "created": time.time()}}))
+
+def load_trace(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.loads(f.read())
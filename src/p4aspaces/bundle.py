@@ -0,0 +1,365 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+try:
+    import zstandard
+except ImportError:  # optional, the zstd command line tool works too
+    zstandard = None
+
+from . import dockerapi
+from .settings import settings
+
+# Image bundles for moving built environments to machines without
+# network access. A bundle is a header line, a line of JSON metadata,
+# and then the (compressed) output of "docker save" of all images, in
+# which layers shared between environments are stored only once:
+#
+#     P4ASPACES-BUNDLE 1
+#     {"compression": "zstd", "images": {"<tag>": [<layer diff ids>]},
+#      "settings": {...}, ...}
+#     <compressed docker save tar>
+#
+# The layer ids allow the import to drop layers which already exist
+# locally from the stream, before docker load even sees them. The
+# settings are the ones needed to render the exact same Dockerfiles
+# (and hence image tags) offline, like the resolved p4a commits.
+MAGIC = b"P4ASPACES-BUNDLE 1\n"
+COMPRESSIONS = ["zstd", "gzip", "none"]
+CHUNK_SIZE = 1024 * 1024
+
+class BundleError(Exception):
+    pass
+
+def zstd_available():
+    return zstandard is not None or shutil.which("zstd") is not None
+
+def chain_ids(diff_ids):
+    # Docker's layer chain ids, which identify a layer together with
+    # all layers below it:
+    result = []
+    for diff_id in diff_ids:
+        if len(result) == 0:
+            result.append(diff_id)
+        else:
+            result.append("sha256:" + hashlib.sha256((result[-1] + " " +
+                diff_id).encode("utf-8")).hexdigest())
+    return result
+
+def list_env_images(env_name):
+    # All local tags of the given environment's image:
+    reference = "p4atestenv-" + env_name
+    client = dockerapi.get_client()
+    if client is not None:
+        tags = []
+        for image in client.list_images(reference=reference):
+            tags += [tag for tag in (image.get("RepoTags") or [])
+                     if tag.startswith(reference + ":")]
+        return sorted(tags)
+    output = subprocess.check_output(["docker", "image", "ls",
+        "--format", "{{.Repository}}:{{.Tag}}", reference]).decode(
+        "utf-8", "replace")
+    return sorted([line.strip() for line in output.splitlines()
+                   if line.strip().startswith(reference + ":")])
+
+def image_layers(names):
+    # Dict of image name -> list of layer diff ids:
+    if len(names) == 0:
+        return dict()
+    client = dockerapi.get_client()
+    if client is not None:
+        return dict([(name, client.inspect_image(name).get(
+            "RootFS", dict()).get("Layers", [])) for name in names])
+    output = subprocess.check_output(["docker", "image", "inspect",
+        "--format", "{{json .RootFS.Layers}}"] + list(names)).decode(
+        "utf-8", "replace")
+    return dict(zip(names, [json.loads(line) or [] for line in
+        output.splitlines() if len(line.strip()) > 0]))
+
+def local_chain_ids():
+    client = dockerapi.get_client()
+    if client is not None:
+        ids = [image["Id"] for image in client.list_images()]
+    else:
+        ids = subprocess.check_output(["docker", "image", "ls", "-q",
+            "--no-trunc"]).decode("utf-8", "replace").split()
+    result = set()
+    for layers in image_layers(sorted(set(ids))).values():
+        result |= set(chain_ids(layers))
+    return result
+
+def exported_settings(env_names):
+    # The settings entries of these environments which affect how their
+    # Dockerfiles are rendered:
+    store = settings.get_store()
+    environments = store.get("environments", dict())
+    return {
+        "resolved_refs": store.get("resolved_refs", dict()),
+        "environments": dict([(name, environments[name])
+            for name in env_names if name in environments]),
+    }
+
+def import_settings(values):
+    with settings.transaction() as store:
+        for (key, entries) in values.items():
+            if key not in ["resolved_refs", "environments"]:
+                continue  # (e.g. the image index of older versions)
+            store.setdefault(key, dict())
+            for (name, value) in entries.items():
+                if key == "resolved_refs" and name in store[key] and \
+                        store[key][name].get("time", 0) >= \
+                        value.get("time", 0):
+                    continue  # ours is newer
+                store[key][name] = value
+
+def open_compressor(compression, f, level):
+    # Returns (writable file object, close function):
+    if compression == "gzip":
+        writer = gzip.GzipFile(fileobj=f, mode="wb",
+            compresslevel=min(9, level))
+        return (writer, writer.close)
+    if compression == "none":
+        return (f, lambda: None)
+    if zstandard is not None:
+        writer = zstandard.ZstdCompressor(level=level,
+            threads=-1).stream_writer(f, closefd=False)
+        return (writer, writer.close)
+    f.flush()
+    process = subprocess.Popen(["zstd", "-q", "-c", "-T0",
+        "-" + str(level)], stdin=subprocess.PIPE, stdout=f)
+    def close():
+        process.stdin.close()
+        if process.wait() != 0:
+            raise BundleError("zstd failed")
+    return (process.stdin, close)
+
+def open_decompressor(compression, f):
+    # f is positioned at the start of the compressed data:
+    if compression == "gzip":
+        return (gzip.GzipFile(fileobj=f, mode="rb"), lambda: None)
+    if compression == "none":
+        return (f, lambda: None)
+    if zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        return (reader, reader.close)
+    os.lseek(f.fileno(), f.tell(), os.SEEK_SET)
+    process = subprocess.Popen(["zstd", "-q", "-d", "-c"],
+        stdin=f, stdout=subprocess.PIPE)
+    def close():
+        process.stdout.close()
+        if process.wait() != 0:
+            raise BundleError("zstd failed")
+    return (process.stdout, close)
+
+def export_bundle(env_names, path, compression="zstd", level=10,
+        on_progress=None):
+    # Writes all local images of the given environments to path.
+    # Returns the metadata written to the bundle's header.
+    if compression == "zstd" and not zstd_available():
+        raise BundleError("zstd compression needs the zstd tool or " +
+            "the zstandard python module, use --compression gzip instead")
+    # (Environments which were never built are left out.)
+    images = []
+    built_env_names = []
+    for env_name in env_names:
+        env_images = list_env_images(env_name)
+        if len(env_images) > 0:
+            built_env_names.append(env_name)
+        images += env_images
+    if len(images) == 0:
+        raise BundleError("no image of these environments found, " +
+            "launch them once to build them")
+    metadata = {
+        "created": time.time(),
+        "compression": compression,
+        "environments": built_env_names,
+        "images": image_layers(images),
+        "settings": exported_settings(built_env_names),
+    }
+    client = dockerapi.get_client()
+    with open(path + ".part", "wb") as f:
+        f.write(MAGIC)
+        f.write(json.dumps(metadata).encode("utf-8") + b"\n")
+        (writer, close) = open_compressor(compression, f, level)
+        if client is not None:
+            source = client.save_images(images)
+            process = None
+        else:
+            process = subprocess.Popen(["docker", "save"] + images,
+                stdout=subprocess.PIPE)
+            source = process.stdout
+        total = 0
+        with source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                total += len(chunk)
+                if on_progress is not None:
+                    on_progress(total)
+        close()
+        if process is not None and process.wait() != 0:
+            raise BundleError("docker save failed")
+    os.replace(path + ".part", path)
+    return metadata
+
+def read_metadata(f):
+    if f.readline() != MAGIC:
+        raise BundleError("not a p4aspaces image bundle")
+    try:
+        return json.loads(f.readline().decode("utf-8"))
+    except ValueError:
+        raise BundleError("damaged bundle header")
+
+def present_images(names):
+    result = []
+    for name in names:
+        client = dockerapi.get_client()
+        if client is not None:
+            if client.image_exists(name):
+                result.append(name)
+        elif subprocess.call(["docker", "image", "inspect", name],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL) == 0:
+            result.append(name)
+    return result
+
+def containerd_image_store():
+    # Docker with the containerd image store checks every blob of a
+    # loaded tar against its digest, so layers can't be left out there:
+    client = dockerapi.get_client()
+    try:
+        if client is not None:
+            info = client.info()
+        else:
+            info = json.loads(subprocess.check_output(["docker", "info",
+                "--format", "{{json .}}"],
+                stderr=subprocess.DEVNULL).decode("utf-8", "replace"))
+    except (OSError, ValueError, subprocess.CalledProcessError,
+            dockerapi.DockerAPIError):
+        return True  # can't tell, so load everything
+    if not isinstance(info, dict):
+        return True
+    for entry in (info.get("DriverStatus") or []):
+        if "io.containerd.snapshotter" in " ".join(
+                [str(value) for value in entry]):
+            return True
+    return False
+
+def skippable_layers(metadata):
+    # Layer blobs (by diff id) the local docker has already, i.e. every
+    # image of the bundle which uses it has the same layer chain locally:
+    local = local_chain_ids()
+    needed = set()
+    available = set()
+    for layers in metadata["images"].values():
+        for (diff_id, chain_id) in zip(layers, chain_ids(layers)):
+            if chain_id in local:
+                available.add(diff_id)
+            else:
+                needed.add(diff_id)
+    return available - needed
+
+def filter_tar(source, target, skip_diff_ids, stats):
+    # Copies the docker save tar from source to target, leaving out the
+    # layer blobs in skip_diff_ids. (Only the OCI layout of newer docker
+    # versions names blobs by their digest, older layouts pass as-is.)
+    skip_names = set(["blobs/sha256/" + diff_id.partition(":")[2]
+                      for diff_id in skip_diff_ids])
+    with tarfile.open(fileobj=source, mode="r|") as tar_in, \
+            tarfile.open(fileobj=target, mode="w|",
+                format=tarfile.PAX_FORMAT) as tar_out:
+        for member in tar_in:
+            if member.name in skip_names and member.isfile():
+                stats["skipped_layers"] += 1
+                stats["skipped_bytes"] += member.size
+                # A placeholder keeps the layout valid, docker doesn't
+                # read layers it has already (except with the containerd
+                # image store, see containerd_image_store()):
+                member.size = 0
+                tar_out.addfile(member, None)
+                continue
+            if member.isfile():
+                tar_out.addfile(member, tar_in.extractfile(member))
+            else:
+                tar_out.addfile(member)
+
+def import_bundle(path, skip_layers=True, on_output=None):
+    # Loads the images of a bundle which aren't present yet. Returns a
+    # dict with what was done.
+    stats = {"images": 0, "already_present": 0, "skipped_layers": 0,
+        "skipped_bytes": 0}
+    with open(path, "rb") as f:
+        metadata = read_metadata(f)
+        images = list(metadata.get("images", dict()).keys())
+        present = present_images(images)
+        stats["images"] = len(images)
+        stats["already_present"] = len(present)
+        if len(present) < len(images):
+            skip = set()
+            if skip_layers and not containerd_image_store():
+                skip = skippable_layers(metadata)
+            (reader, close) = open_decompressor(
+                metadata.get("compression", "zstd"), f)
+            load(reader, skip, stats, on_output)
+            close()
+    import_settings(metadata.get("settings", dict()))
+    return stats
+
+def load(reader, skip, stats, on_output):
+    client = dockerapi.get_client()
+    if client is not None:
+        # Filter in a thread, streaming through a pipe into the request:
+        (read_fd, write_fd) = os.pipe()
+        errors = []
+        def produce():
+            try:
+                with os.fdopen(write_fd, "wb") as target:
+                    filter_tar(reader, target, skip, stats)
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        with os.fdopen(read_fd, "rb") as source:
+            success = client.load_images(source, on_output=on_output)
+        thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+    else:
+        process = subprocess.Popen(["docker", "load"],
+            stdin=subprocess.PIPE)
+        try:
+            filter_tar(reader, process.stdin, skip, stats)
+        finally:
+            process.stdin.close()
+        success = (process.wait() == 0)
+    if not success:
+        raise BundleError("docker load failed")
@@ -0,0 +1,171 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import shutil
+import tempfile
+
+from .settings import settings
+
+# The ccache root folder is shared by all environments by default. With
+# the "ccache_namespace" setting set to "env" or "ndk", every environment
+# (or every NDK) gets its own subfolder below <root>/ns/ instead, since
+# objects built with different NDKs are never reused anyway.
+NAMESPACES = ["shared", "env", "ndk"]
+DEFAULT_MAX_SIZE = "5G"
+
+def ccache_root():
+    return settings.get("ccache_dir",
+        default=os.path.join(tempfile.gettempdir(), "p4a-ccache"))
+
+def get_max_size():
+    return settings.get("ccache_max_size", default=DEFAULT_MAX_SIZE)
+
+def get_namespace():
+    namespace = settings.get("ccache_namespace", default="shared")
+    if namespace not in NAMESPACES:
+        return "shared"
+    return namespace
+
+def parse_size(size):
+    # Parses sizes like "500M", "5G" or "1024" (bytes):
+    size = str(size).strip().upper()
+    if size.endswith("B"):
+        size = size[:-1]
+    factor = 1
+    for (suffix, suffix_factor) in [("K", 1024), ("M", 1024 ** 2),
+            ("G", 1024 ** 3), ("T", 1024 ** 4)]:
+        if size.endswith(suffix):
+            factor = suffix_factor
+            size = size[:-1]
+            break
+    try:
+        return int(float(size) * factor)
+    except ValueError:
+        raise ValueError("invalid size: " + str(size))
+
+def format_size(size):
+    for suffix in ["B", "K", "M", "G"]:
+        if size < 1024:
+            return ("%.1f" % size).rstrip("0").rstrip(".") + suffix
+        size /= 1024.0
+    return ("%.1f" % size) + "T"
+
+def get_ccache_dir(env=None):
+    # Folder to be mounted as /ccache/ for the given BuildEnvironment:
+    namespace = get_namespace()
+    if env is None or namespace == "shared":
+        return ccache_root()
+    name = env.name if namespace == "env" else env.ndk_id
+    return os.path.join(ccache_root(), "ns", name)
+
+def contents_dirs():
+    # (namespace name, folder) of the ccache folders themselves, which
+    # leaves out the pip build folders next to them:
+    root = ccache_root()
+    return [(name, os.path.join(root, "contents") if name == "shared"
+        else os.path.join(root, "ns", name, "contents"))
+        for name in namespace_names()]
+
+def cache_files(path=None):
+    # All (path, size, last use) of cached files. ccache touches objects
+    # on a hit, so the newer of atime & mtime gives us the LRU order:
+    if path is None:
+        result = []
+        for (name, contents_dir) in contents_dirs():
+            result += cache_files(contents_dir)
+        return result
+    result = []
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            if filename in ["ccache.conf", "cache.debug.txt"]:
+                continue
+            full_path = os.path.join(dirpath, filename)
+            try:
+                st = os.lstat(full_path)
+            except OSError:
+                continue
+            result.append((full_path, st.st_size,
+                max(st.st_atime, st.st_mtime)))
+    return result
+
+def stats():
+    # Returns a dict of namespace name -> (file count, total size):
+    result = dict()
+    for (name, contents_dir) in contents_dirs():
+        files = cache_files(contents_dir)
+        if len(files) > 0:
+            result[name] = (len(files),
+                sum([size for (path, size, last_use) in files]))
+    return result
+
+def prune(max_size=None):
+    # Evict least recently used files until the ccache folders are
+    # below max_size. Returns (removed file count, freed bytes):
+    if max_size is None:
+        max_size = get_max_size()
+    max_size = parse_size(max_size)
+    files = cache_files()
+    total = sum([size for (path, size, last_use) in files])
+    removed = 0
+    freed = 0
+    for (path, size, last_use) in sorted(files, key=lambda f: f[2]):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+        freed += size
+    return (removed, freed)
+
+def namespace_names():
+    # "shared", and the namespaces which have a folder below <root>/ns/:
+    ns_dir = os.path.join(ccache_root(), "ns")
+    names = []
+    if os.path.isdir(ns_dir):
+        names = [name for name in os.listdir(ns_dir)
+                 if os.path.isdir(os.path.join(ns_dir, name)) and
+                 not os.path.islink(os.path.join(ns_dir, name))]
+    return ["shared"] + sorted(names)
+
+def clear(name=None):
+    # Remove the cached files of one namespace, or everything. Raises
+    # ValueError for names which aren't an existing namespace:
+    if name is not None and name not in namespace_names():
+        raise ValueError("unknown namespace: " + str(name) +
+            " (existing: " + ", ".join(namespace_names()) + ")")
+    for (namespace, path) in contents_dirs():
+        if name is not None and namespace != name:
+            continue
+        if not os.path.exists(path):
+            continue
+        for entry in os.listdir(path):
+            if entry in ["ccache.conf", "cache.debug.txt"]:
+                continue
+            full_path = os.path.join(path, entry)
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                shutil.rmtree(full_path)
+            else:
+                os.remove(full_path)
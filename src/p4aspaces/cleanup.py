@@ -0,0 +1,366 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import ccache
+from . import dockerapi
+from . import pool
+from .settings import settings
+
+# Garbage collection of what crashed or killed launches leave behind,
+# and of old environment images:
+#
+#  - launch containers ("p4atestenv-<env>-<uuid>") and sync helpers
+#    carry an owner label "<hostname>:<pid>". They are orphaned when
+#    that process is gone, or (without an owner we can check) when they
+#    are not running anymore
+#  - "p4a-testing-space-*" temp folders have an owner file with the
+#    same contents, older ones without it are removed after a day
+#  - pooled containers (see pool.py) are orphaned when they were idle
+#    for too long or their image got rebuilt, and once claimed, when
+#    the owner in their pool folder is gone
+#  - images are evicted least recently used first (by the launch times
+#    recorded in the "image_usage" setting) while all environment
+#    images together are above the "gc_disk_budget" setting. Images
+#    which any container uses are kept. Launch times of images which
+#    are gone are dropped from the setting.
+OWNER_LABEL = "p4aspaces.owner"
+IMAGE_LABEL = "p4aspaces.env"
+OWNER_FILE = "p4aspaces.owner"
+TEMP_PREFIX = "p4a-testing-space-"
+POOL_TEMP_PREFIX = "p4a-pool-"
+CONTAINER_NAME = re.compile(
+    "^(p4atestenv-.+-[0-9a-f]{32}|p4aspaces-sync-[0-9a-f]{32})$")
+STALE_AGE = 24 * 60 * 60
+USAGE_UPDATE_INTERVAL = 60 * 60
+
+def owner_id():
+    return socket.gethostname() + ":" + str(os.getpid())
+
+def write_owner(folder):
+    with open(os.path.join(folder, OWNER_FILE), "w") as f:
+        f.write(owner_id())
+
+def owner_alive(owner):
+    # True/False if the owner process is (not) running, None if that
+    # can't be told from here:
+    (hostname, _, pid) = owner.strip().rpartition(":")
+    if hostname != socket.gethostname():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return None
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def record_image_use(image_tag, force=False):
+    # Remember when the image was last launched (at most once an hour,
+    # to keep launches from writing the settings every time):
+    usage = settings.get("image_usage", type=dict)
+    if not force and time.time() - usage.get(image_tag, 0) < \
+            USAGE_UPDATE_INTERVAL:
+        return
+    with settings.transaction() as store:
+        store.setdefault("image_usage", dict())[image_tag] = time.time()
+
+def prune_image_usage(existing_tags):
+    # Forget the launch times of all other images:
+    usage = settings.get("image_usage", type=dict)
+    stale = [tag for tag in usage.keys() if tag not in existing_tags]
+    if len(stale) == 0:
+        return
+    with settings.transaction() as store:
+        for tag in stale:
+            store.get("image_usage", dict()).pop(tag, None)
+
+def get_disk_budget():
+    budget = settings.get("gc_disk_budget", default=None)
+    if budget is None:
+        return None
+    return ccache.parse_size(budget)
+
+def orphaned_containers():
+    # Returns the names of orphaned containers:
+    client = dockerapi.get_client()
+    containers = []
+    if client is not None:
+        for container in client.list_containers(all=True):
+            containers.append((container["Names"][0].lstrip("/"),
+                container.get("State", ""),
+                (container.get("Labels") or dict()).get(OWNER_LABEL, "")))
+    else:
+        output = subprocess.check_output(dockerapi.docker_command() + [
+            "ps", "-a", "--format", "{{.Names}}\t{{.State}}\t{{.Label \"" +
+            OWNER_LABEL + "\"}}"]).decode("utf-8", "replace")
+        for line in output.splitlines():
+            parts = line.split("\t")
+            if len(parts) == 3:
+                containers.append(tuple(parts))
+    result = []
+    for (name, state, owner) in containers:
+        if not CONTAINER_NAME.match(name):
+            continue
+        alive = owner_alive(owner) if owner else None
+        if alive is False or (alive is None and
+                state in ["exited", "dead"]):
+            result.append(name)
+    return result
+
+def orphaned_pool_containers():
+    # Returns (name, pool folder) of orphaned pooled containers:
+    try:
+        containers = pool.list_pool_containers()
+    except (OSError, dockerapi.DockerAPIError):
+        return []
+    max_idle = pool.get_max_idle()
+    image_ids = dict()
+    result = []
+    for container in containers:
+        labels = container["labels"]
+        folder = labels.get(pool.POOL_FOLDER_LABEL, "")
+        if pool.is_idle_name(container["name"]):
+            image_tag = labels.get(pool.POOL_IMAGE_LABEL, "")
+            if image_tag not in image_ids:
+                image_ids[image_tag] = pool.get_image_id(image_tag)
+            try:
+                created = float(labels.get(pool.POOL_CREATED_LABEL, "0"))
+            except ValueError:
+                created = 0
+            if container["state"] in ["exited", "dead"] or \
+                    time.time() - created > max_idle or \
+                    image_ids[image_tag] != labels.get(
+                    pool.POOL_IMAGE_ID_LABEL, ""):
+                result.append((container["name"], folder))
+            continue
+        try:
+            with open(os.path.join(folder, OWNER_FILE), "r") as f:
+                alive = owner_alive(f.read())
+        except OSError:
+            alive = None
+        if alive is False:
+            result.append((container["name"], folder))
+    return result
+
+def remove_container(name):
+    client = dockerapi.get_client()
+    if client is not None:
+        try:
+            client.remove(name, force=True)
+        except dockerapi.DockerAPIError:
+            pass
+        return
+    subprocess.call(dockerapi.docker_command() + ["rm", "-f", name],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def orphaned_temp_dirs(pooled_dirs=()):
+    # Returns the temp folders of launches (and of pooled containers)
+    # which are gone. Pool folders are only checked if pooled_dirs (the
+    # output dirs of all existing pool containers) isn't None:
+    temp_dir = tempfile.gettempdir()
+    result = []
+    for name in os.listdir(temp_dir):
+        path = os.path.join(temp_dir, name)
+        if not os.path.isdir(path) or os.path.islink(path):
+            continue
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except OSError:
+            continue
+        if name.startswith(TEMP_PREFIX):
+            try:
+                with open(os.path.join(path, OWNER_FILE), "r") as f:
+                    alive = owner_alive(f.read())
+            except OSError:
+                alive = None
+            if alive is False or (alive is None and age > STALE_AGE):
+                result.append(path)
+        elif name.startswith(POOL_TEMP_PREFIX) and \
+                pooled_dirs is not None and path not in pooled_dirs and \
+                age > USAGE_UPDATE_INTERVAL:
+            result.append(path)
+    return result
+
+def environment_images():
+    # Returns dicts with "id", "tags", "size", "last_used" of all images
+    # of environments, most recently used first. (Sizes include layers
+    # shared with other images, so their sum overestimates the space.)
+    usage = settings.get("image_usage", type=dict)
+    client = dockerapi.get_client()
+    images = dict()
+    if client is not None:
+        for image in client.list_images():
+            tags = [tag for tag in (image.get("RepoTags") or [])
+                    if tag.startswith("p4atestenv-")]
+            if len(tags) == 0:
+                continue
+            images[image["Id"]] = {"id": image["Id"], "tags": tags,
+                "size": int(image.get("Size", 0)),
+                "created": int(image.get("Created", 0))}
+    else:
+        output = subprocess.check_output(dockerapi.docker_command() + [
+            "image", "ls", "--no-trunc", "--format",
+            "{{.ID}}\t{{.Repository}}:{{.Tag}}"]).decode("utf-8", "replace")
+        for line in output.splitlines():
+            (image_id, _, tag) = line.partition("\t")
+            if not tag.startswith("p4atestenv-"):
+                continue
+            images.setdefault(image_id, {"id": image_id, "tags": [],
+                "size": 0, "created": 0})["tags"].append(tag)
+        if len(images) > 0:
+            ids = sorted(images.keys())
+            output = subprocess.check_output(dockerapi.docker_command() + [
+                "image", "inspect", "--format", "{{.Size}}"] + ids).decode(
+                "utf-8", "replace")
+            for (image_id, size) in zip(ids, output.split()):
+                images[image_id]["size"] = int(size)
+    for image in images.values():
+        image["last_used"] = max([usage.get(tag, 0)
+            for tag in image["tags"]] + [image["created"]])
+    return sorted(images.values(), key=lambda image: -image["last_used"])
+
+def images_in_use():
+    # Images (as ids and names) of all containers, running or not:
+    client = dockerapi.get_client()
+    if client is not None:
+        result = set()
+        for container in client.list_containers(all=True):
+            result.add(container.get("Image", ""))
+            result.add(container.get("ImageID", ""))
+        return result
+    output = subprocess.check_output(dockerapi.docker_command() + [
+        "ps", "-a", "--no-trunc", "--format", "{{.Image}}"]).decode(
+        "utf-8", "replace")
+    return set(output.split())
+
+def remove_image(name):
+    client = dockerapi.get_client()
+    if client is not None:
+        try:
+            client.remove_image(name)
+            return True
+        except dockerapi.DockerAPIError:
+            return False
+    return subprocess.call(dockerapi.docker_command() + ["image", "rm",
+        name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+def images_to_evict(images, budget, in_use):
+    # The least recently used images to remove to get below budget:
+    total = sum([image["size"] for image in images])
+    result = []
+    for image in reversed(images):
+        if total <= budget:
+            break
+        if image["id"] in in_use or \
+                len([tag for tag in image["tags"] if tag in in_use]) > 0:
+            continue
+        result.append(image)
+        total -= image["size"]
+    return result
+
+def dangling_images():
+    # Untagged leftovers of rebuilds with --force-rebuild:
+    client = dockerapi.get_client()
+    if client is not None:
+        return [image["Id"] for image in client.list_images(
+            dangling=True, labels=[IMAGE_LABEL])]
+    return subprocess.check_output(dockerapi.docker_command() + [
+        "image", "ls", "-q", "--no-trunc", "--filter", "dangling=true",
+        "--filter", "label=" + IMAGE_LABEL]).decode(
+        "utf-8", "replace").split()
+
+def collect(budget=None, dry_run=False, on_message=None):
+    # One garbage collection pass on the current docker host. Returns
+    # a dict with what was (or with dry_run, would be) removed.
+    def message(text):
+        if on_message is not None:
+            on_message(text)
+    result = {"containers": [], "temp_dirs": [], "images": [],
+        "freed": 0}
+    for (name, folder) in orphaned_pool_containers():
+        message("Removing pooled container " + name)
+        result["containers"].append(name)
+        if not dry_run:
+            pool.remove_pooled(name, folder)
+    for name in orphaned_containers():
+        if name in result["containers"]:
+            continue
+        message("Removing orphaned container " + name)
+        result["containers"].append(name)
+        if not dry_run:
+            remove_container(name)
+    for path in orphaned_temp_dirs(pool.pool_folders()):
+        message("Removing orphaned folder " + path)
+        result["temp_dirs"].append(path)
+        if not dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+    for image_id in dangling_images():
+        message("Removing dangling image " + image_id[:19])
+        result["images"].append(image_id)
+        if not dry_run:
+            remove_image(image_id)
+    if budget is None:
+        budget = get_disk_budget()
+    images = environment_images()
+    existing_tags = set()
+    for image in images:
+        existing_tags |= set(image["tags"])
+    if budget is not None:
+        for image in images_to_evict(images, budget, images_in_use()):
+            message("Evicting " + ", ".join(image["tags"]) + " (" +
+                ccache.format_size(image["size"]) + ", last used " +
+                time.strftime("%Y-%m-%d", time.localtime(
+                image["last_used"])) + ")")
+            if dry_run:
+                ok = True
+            else:
+                # (Untag each tag, the last one removes the image)
+                ok = all([remove_image(tag) for tag in image["tags"]])
+            if ok:
+                result["images"].append(image["id"])
+                result["freed"] += image["size"]
+                existing_tags -= set(image["tags"])
+    if not dry_run:
+        prune_image_usage(existing_tags)
+    return result
+
+def auto_collect():
+    # The pass after each launch, if the "gc_auto" setting is on:
+    if not settings.get("gc_auto", default=False):
+        return
+    try:
+        collect()
+    except (OSError, subprocess.CalledProcessError,
+            dockerapi.DockerAPIError) as e:
+        print("p4aspaces: warning: automatic garbage collection " +
+            "failed: " + str(e), file=sys.stderr, flush=True)
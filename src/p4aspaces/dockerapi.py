@@ -0,0 +1,409 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import io
+import json
+import os
+import socket
+import struct
+import tarfile
+import threading
+import urllib.parse
+
+# A small client for the Docker Engine API, used instead of spawning a
+# "docker" process for every operation. It only speaks plain HTTP over
+# the unix socket (or an unencrypted tcp:// DOCKER_HOST). If that isn't
+# available, get_client() returns None and callers use the docker CLI.
+DEFAULT_SOCKET = "/var/run/docker.sock"
+
+# (http.client is only imported once a connection is made, since it is
+# slow to import and commands like "list-envs" never talk to docker.)
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(str(status) + ": " + str(message))
+        self.status = status
+        self.message = message
+
+_connection_classes = dict()
+
+def unix_http_connection(socket_path, timeout=None):
+    if "unix" not in _connection_classes:
+        import http.client
+        class UnixHTTPConnection(http.client.HTTPConnection):
+            def __init__(self, socket_path, timeout=None):
+                super().__init__("localhost", timeout=timeout)
+                self.socket_path = socket_path
+
+            def connect(self):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                if self.timeout is not None:
+                    sock.settimeout(self.timeout)
+                sock.connect(self.socket_path)
+                self.sock = sock
+        _connection_classes["unix"] = UnixHTTPConnection
+    return _connection_classes["unix"](socket_path, timeout=timeout)
+
+class DockerClient(object):
+    def __init__(self, host=None, timeout=None):
+        # host is a DOCKER_HOST-style url like "unix:///var/run/docker.sock"
+        # or "tcp://127.0.0.1:2375":
+        if host is None:
+            host = "unix://" + DEFAULT_SOCKET
+        self.host = host
+        self.timeout = timeout
+        self.connection = None
+
+    def _connect(self):
+        import http.client
+        parsed = urllib.parse.urlparse(self.host)
+        if parsed.scheme == "unix":
+            return unix_http_connection(parsed.path, timeout=self.timeout)
+        elif parsed.scheme in ["tcp", "http"]:
+            return http.client.HTTPConnection(parsed.hostname,
+                parsed.port or 2375, timeout=self.timeout)
+        raise ValueError("unsupported docker host: " + str(self.host))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, method, path, params=None, body=None,
+            headers=None, expect_json=True):
+        # Sends a request over the kept-alive connection. If expect_json
+        # is False, the open response is returned for streaming, and must
+        # be read to the end before the next request.
+        import http.client
+        if params:
+            path += "?" + urllib.parse.urlencode(params)
+        if headers is None:
+            headers = dict()
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        for attempt in [1, 2]:
+            if self.connection is None:
+                self.connection = self._connect()
+            try:
+                self.connection.request(method, path, body=body,
+                    headers=headers)
+                response = self.connection.getresponse()
+                break
+            except (http.client.RemoteDisconnected,
+                    http.client.ImproperConnectionState,
+                    BrokenPipeError, ConnectionResetError):
+                # Kept-alive connection went away, retry once:
+                self.close()
+                if attempt == 2:
+                    raise
+        if response.status >= 400:
+            data = response.read()
+            try:
+                message = json.loads(data.decode("utf-8"))["message"]
+            except (ValueError, KeyError, TypeError):
+                message = data.decode("utf-8", "replace").strip()
+            raise DockerAPIError(response.status, message)
+        if not expect_json:
+            return response
+        data = response.read()
+        if len(data.strip()) == 0:
+            return None
+        return json.loads(data.decode("utf-8"))
+
+    def ping(self):
+        import http.client
+        try:
+            response = self.request("GET", "/_ping", expect_json=False)
+            with response:
+                return response.read().strip() == b"OK"
+        except (OSError, DockerAPIError, http.client.HTTPException):
+            self.close()
+            return False
+
+    def info(self):
+        return self.request("GET", "/info")
+
+    def image_exists(self, name):
+        try:
+            self.request("GET", "/images/" +
+                urllib.parse.quote(name, safe=":/") + "/json")
+            return True
+        except DockerAPIError as e:
+            if e.status == 404:
+                return False
+            raise
+
+    def list_images(self, reference=None, dangling=False, labels=None):
+        filters = dict()
+        if reference:
+            filters["reference"] = [reference]
+        if dangling:
+            filters["dangling"] = ["true"]
+        if labels:
+            filters["label"] = list(labels)
+        params = dict()
+        if filters:
+            params["filters"] = json.dumps(filters)
+        return self.request("GET", "/images/json", params=params)
+
+    def remove_image(self, name, force=False):
+        self.request("DELETE", "/images/" +
+            urllib.parse.quote(name, safe=":/"),
+            params={"force": "1" if force else "0"})
+
+    def inspect_image(self, name):
+        return self.request("GET", "/images/" +
+            urllib.parse.quote(name, safe=":/") + "/json")
+
+    def save_images(self, names):
+        # Returns the open response streaming the "docker save" tar:
+        return self.request("GET", "/images/get",
+            params=[("names", name) for name in names],
+            expect_json=False)
+
+    def load_images(self, fileobj, on_output=None):
+        # Loads a "docker save" tar read from fileobj (sent chunked):
+        response = self.request("POST", "/images/load",
+            params={"quiet": "1"}, body=fileobj,
+            headers={"Content-Type": "application/x-tar"},
+            expect_json=False)
+        success = True
+        with response:
+            for message in iter_json_stream(response):
+                if "error" in message:
+                    success = False
+                    text = str(message["error"]) + "\n"
+                else:
+                    text = message.get("stream", "")
+                if on_output is not None and len(text) > 0:
+                    on_output(text)
+        return success
+
+    def list_containers(self, all=False, labels=None, name=None):
+        filters = dict()
+        if labels:
+            filters["label"] = list(labels)
+        if name:
+            filters["name"] = [name]
+        params = {"all": "1" if all else "0"}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        return self.request("GET", "/containers/json", params=params)
+
+    def kill(self, name):
+        self.request("POST", "/containers/" +
+            urllib.parse.quote(name) + "/kill")
+
+    def remove(self, name, force=False):
+        self.request("DELETE", "/containers/" + urllib.parse.quote(name),
+            params={"force": "1" if force else "0"})
+
+    def rename(self, name, new_name):
+        self.request("POST", "/containers/" +
+            urllib.parse.quote(name) + "/rename",
+            params={"name": new_name})
+
+    def update(self, name, nano_cpus=None, memory=None, memory_swap=None):
+        config = dict()
+        if nano_cpus is not None:
+            config["NanoCpus"] = int(nano_cpus)
+        if memory is not None:
+            config["Memory"] = int(memory)
+        if memory_swap is not None:
+            config["MemorySwap"] = int(memory_swap)
+        self.request("POST", "/containers/" +
+            urllib.parse.quote(name) + "/update", body=config)
+
+    def build(self, context_dir, tag, dockerfile="Dockerfile",
+            nocache=False, on_output=None, labels=None):
+        # Builds an image from context_dir. Returns True on success.
+        # on_output is called with every chunk of build output text.
+        tar_data = io.BytesIO()
+        with tarfile.open(fileobj=tar_data, mode="w") as tar:
+            tar.add(context_dir, arcname=".")
+        params = {"t": tag, "dockerfile": dockerfile, "rm": "1"}
+        if nocache:
+            params["nocache"] = "1"
+        if labels:
+            params["labels"] = json.dumps(labels)
+        response = self.request("POST", "/build", params=params,
+            body=tar_data.getvalue(),
+            headers={"Content-Type": "application/x-tar"},
+            expect_json=False)
+        success = True
+        with response:
+            for message in iter_json_stream(response):
+                if "error" in message:
+                    success = False
+                    text = str(message["error"]) + "\n"
+                else:
+                    text = message.get("stream", "")
+                    if "status" in message:
+                        text += str(message["status"]) + "\n"
+                if on_output is not None and len(text) > 0:
+                    on_output(text)
+        return success
+
+    def create_container(self, image, name=None, cmd=None, binds=None,
+            env=None, labels=None, tty=False, user=None, entrypoint=None,
+            security_opt=None, cpuset=None, nano_cpus=None, memory=None):
+        config = {
+            "Image": image,
+            "Tty": tty,
+            "OpenStdin": False,
+            "AttachStdout": True,
+            "AttachStderr": True,
+            "Env": list(env or []),
+            "Labels": dict(labels or dict()),
+            "HostConfig": {"Binds": list(binds or []),
+                "SecurityOpt": list(security_opt or [])},
+        }
+        if cmd is not None:
+            config["Cmd"] = list(cmd)
+        if user is not None:
+            config["User"] = user
+        if entrypoint is not None:
+            config["Entrypoint"] = list(entrypoint)
+        if cpuset is not None:
+            config["HostConfig"]["CpusetCpus"] = cpuset
+        if nano_cpus is not None:
+            config["HostConfig"]["NanoCpus"] = int(nano_cpus)
+        if memory is not None:
+            config["HostConfig"]["Memory"] = int(memory)
+        params = dict()
+        if name is not None:
+            params["name"] = name
+        return self.request("POST", "/containers/create",
+            params=params, body=config)["Id"]
+
+    def start(self, name):
+        self.request("POST", "/containers/" +
+            urllib.parse.quote(name) + "/start")
+
+    def wait(self, name):
+        result = self.request("POST", "/containers/" +
+            urllib.parse.quote(name) + "/wait")
+        return int(result.get("StatusCode", 1))
+
+    def follow_logs(self, name, on_output):
+        # Streams stdout & stderr of a (non-TTY) container until it exits:
+        response = self.request("GET", "/containers/" +
+            urllib.parse.quote(name) + "/logs",
+            params={"follow": "1", "stdout": "1", "stderr": "1"},
+            expect_json=False)
+        with response:
+            while True:
+                header = response.read(8)
+                if len(header) < 8:
+                    break
+                (stream_type, size) = struct.unpack(">BxxxL", header)
+                data = response.read(size)
+                on_output(data.decode("utf-8", "replace"))
+
+    def put_archive(self, name, path, data):
+        # Extracts the tar data into the folder path of the container:
+        self.request("PUT", "/containers/" + urllib.parse.quote(name) +
+            "/archive", params={"path": path}, body=data,
+            headers={"Content-Type": "application/x-tar"})
+
+    def get_archive(self, name, path):
+        # Returns the open response streaming a tar of the given path:
+        return self.request("GET", "/containers/" +
+            urllib.parse.quote(name) + "/archive", params={"path": path},
+            expect_json=False)
+
+    def run(self, image, name=None, cmd=None, binds=None, env=None,
+            labels=None, on_output=None, user=None, entrypoint=None,
+            security_opt=None, cpuset=None, nano_cpus=None, memory=None):
+        # Like "docker run" without a TTY. Returns the exit code.
+        self.create_container(image, name=name, cmd=cmd, binds=binds,
+            env=env, labels=labels, user=user, entrypoint=entrypoint,
+            security_opt=security_opt, cpuset=cpuset, nano_cpus=nano_cpus,
+            memory=memory)
+        self.start(name)
+        self.follow_logs(name, on_output or (lambda text: None))
+        return self.wait(name)
+
+def iter_json_stream(response):
+    # Yields the JSON objects of a streamed response like the one of
+    # /build, which are not reliably separated by newlines:
+    decoder = json.JSONDecoder()
+    buf = ""
+    while True:
+        chunk = response.read1(65536) if hasattr(response, "read1") \
+            else response.read(65536)
+        if not chunk:
+            break
+        buf += chunk.decode("utf-8", "replace")
+        while True:
+            buf = buf.lstrip()
+            if len(buf) == 0:
+                break
+            try:
+                (obj, end) = decoder.raw_decode(buf)
+            except ValueError:
+                break
+            buf = buf[end:]
+            yield obj
+
+_clients = threading.local()
+
+def set_current_host(host):
+    # Makes get_client() and docker_command() of this thread use the
+    # given docker host (None for the default). Returns the previous one.
+    previous = getattr(_clients, "current_host", None)
+    _clients.current_host = host
+    return previous
+
+def get_current_host():
+    return getattr(_clients, "current_host", None)
+
+def docker_command():
+    # The docker CLI command for the current host:
+    host = get_current_host()
+    if host is None:
+        return ["docker"]
+    return ["docker", "-H", host]
+
+def get_client(host=None):
+    # Returns a per-thread, connection-reusing client for the given (or
+    # the current, or the configured) docker host, or None if the API
+    # isn't reachable:
+    if host is None:
+        host = get_current_host()
+    if host is None:
+        host = os.environ.get("DOCKER_HOST", "unix://" + DEFAULT_SOCKET)
+    if not hasattr(_clients, "clients"):
+        _clients.clients = dict()
+    if host in _clients.clients:
+        return _clients.clients[host]
+    client = None
+    parsed = urllib.parse.urlparse(host)
+    if (parsed.scheme == "unix" and os.access(parsed.path,
+            os.R_OK | os.W_OK)) or (parsed.scheme == "tcp" and
+            os.environ.get("DOCKER_TLS_VERIFY", "") == ""):
+        client = DockerClient(host)
+        if not client.ping():
+            client = None
+    _clients.clients[host] = client
+    return client
@@ -0,0 +1,395 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import hashlib
+import http.server
+import io
+import json
+import os
+import socketserver
+import struct
+import tarfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+# An in-memory stand-in for the docker daemon, speaking the subset of the
+# Engine API that p4aspaces.dockerapi uses, for tests and benchmarks
+# without a real daemon. Builds succeed instantly, and containers "run"
+# by printing their command and exiting with 0. Built images consist of
+# a layer shared by all images and one of their own, which "docker save"
+# writes in the OCI layout. Archives copied into a container are kept
+# (in "Uploads"), and copying a folder out of one returns it with a
+# fake.apk inside. With containerd_store set, it acts like the containerd
+# image store, which checks every blob of a loaded tar. For tests of the
+# client, drop_keepalive closes every connection after its response
+# (without telling the client), build_error makes builds fail, and a
+# container's "Logs" can be set to the (stream, text) frames it prints.
+# Usage:
+#
+#     server = FakeDockerServer("/tmp/fake-docker.sock")
+#     server.start()
+#     os.environ["DOCKER_HOST"] = server.url
+#     ...
+#     server.stop()
+
+class FakeDockerState(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = dict()
+        self.containers = dict()
+        self.requests = []
+        self.connections = 0
+        self.layers = dict()
+        self.loaded_layers = []
+        self.containerd_store = False
+        self.drop_keepalive = False
+        self.build_error = None
+
+class FakeDockerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.state.lock:
+            self.server.state.connections += 1
+
+    def address_string(self):
+        return "fake-docker"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.state.drop_keepalive:
+            self.close_connection = True
+
+    def not_found(self, what):
+        self.send_body(404, {"message": "No such " + what})
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if size == 0:
+                    return body
+        length = int(self.headers.get("Content-Length", "0"))
+        return self.rfile.read(length) if length > 0 else b""
+
+    def add_layer(self, data):
+        state = self.server.state
+        diff_id = "sha256:" + hashlib.sha256(data).hexdigest()
+        state.layers[diff_id] = data
+        return diff_id
+
+    def save_images(self, names):
+        state = self.server.state
+        tar_data = io.BytesIO()
+        def add(tar, name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        with tarfile.open(fileobj=tar_data, mode="w") as tar:
+            manifest = []
+            written = set()
+            for name in names:
+                layers = state.images[name]["RootFS"]["Layers"]
+                for diff_id in layers:
+                    if diff_id not in written:
+                        add(tar, "blobs/sha256/" +
+                            diff_id.partition(":")[2], state.layers[diff_id])
+                        written.add(diff_id)
+                manifest.append({"RepoTags": [name],
+                    "Layers": ["blobs/sha256/" + diff_id.partition(":")[2]
+                               for diff_id in layers]})
+            add(tar, "manifest.json", json.dumps(manifest).encode("utf-8"))
+        return tar_data.getvalue()
+
+    def load_images(self, body):
+        state = self.server.state
+        with tarfile.open(fileobj=io.BytesIO(body), mode="r") as tar:
+            manifest = json.loads(tar.extractfile(
+                "manifest.json").read().decode("utf-8"))
+            for entry in manifest:
+                layers = []
+                for path in entry["Layers"]:
+                    diff_id = "sha256:" + path.rpartition("/")[2]
+                    if diff_id not in state.layers or \
+                            state.containerd_store:
+                        data = tar.extractfile(path).read()
+                        if "sha256:" + hashlib.sha256(data).hexdigest() \
+                                != diff_id:
+                            return "layer missing: " + diff_id
+                        if diff_id not in state.layers:
+                            state.layers[diff_id] = data
+                            state.loaded_layers.append(diff_id)
+                    layers.append(diff_id)
+                for tag in entry["RepoTags"]:
+                    state.images[tag] = {"Id": "sha256:" +
+                        hashlib.sha256(tag.encode("utf-8")).hexdigest(),
+                        "RepoTags": [tag], "RootFS": {"Layers": layers}}
+        return None
+
+    def find_container(self, name):
+        state = self.server.state
+        for (cid, container) in state.containers.items():
+            if cid == name or container["Name"] == name:
+                return container
+        return None
+
+    def handle_any(self, method):
+        parsed = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        parts = [urllib.parse.unquote(p)
+                 for p in parsed.path.strip("/").split("/")]
+        if len(parts) > 0 and parts[0].startswith("v1."):
+            parts = parts[1:]
+        body = self.read_body()
+        state = self.server.state
+        with state.lock:
+            state.requests.append((method, "/".join(parts)))
+
+            if parts == ["_ping"]:
+                return self.send_body(200, "OK", "text/plain")
+            if method == "GET" and parts == ["info"]:
+                if state.containerd_store:
+                    driver = ("overlayfs", [["driver-type",
+                        "io.containerd.snapshotter.v1"]])
+                else:
+                    driver = ("overlay2", [["Backing Filesystem",
+                        "extfs"]])
+                return self.send_body(200, {"NCPU": 64,
+                    "MemTotal": 256 * 1024 ** 3, "Driver": driver[0],
+                    "DriverStatus": driver[1]})
+            if method == "GET" and len(parts) >= 3 and \
+                    parts[0] == "images" and parts[-1] == "json":
+                name = "/".join(parts[1:-1])
+                for image in state.images.values():
+                    if image["Id"] == name:
+                        return self.send_body(200, image)
+                if name not in state.images:
+                    return self.not_found("image: " + name)
+                return self.send_body(200, state.images[name])
+            if method == "GET" and parts == ["images", "json"]:
+                filters = json.loads(params.get("filters", "{}"))
+                result = []
+                for (name, image) in state.images.items():
+                    if not all([name.partition(":")[0] == reference
+                                for reference in
+                                filters.get("reference", [])]):
+                        continue
+                    # (Images are always tagged here, so never dangling)
+                    if filters.get("dangling", []) == ["true"]:
+                        continue
+                    if not all([self.label_matches(image, label)
+                                for label in filters.get("label", [])]):
+                        continue
+                    result.append(image)
+                return self.send_body(200, result)
+            if method == "DELETE" and len(parts) >= 2 and \
+                    parts[0] == "images":
+                name = "/".join(parts[1:])
+                if name not in state.images:
+                    return self.not_found("image: " + name)
+                if params.get("force", "0") != "1" and len([c for c in
+                        state.containers.values()
+                        if c["Image"] == name]) > 0:
+                    return self.send_body(409,
+                        {"message": "image is being used"})
+                del state.images[name]
+                return self.send_body(200, [{"Untagged": name}])
+            if method == "GET" and parts == ["images", "get"]:
+                names = [value for (key, value) in
+                    urllib.parse.parse_qsl(parsed.query) if key == "names"]
+                if not all([name in state.images for name in names]):
+                    return self.not_found("image")
+                return self.send_body(200, self.save_images(names),
+                    "application/x-tar")
+            if method == "POST" and parts == ["images", "load"]:
+                error = self.load_images(body)
+                if error is not None:
+                    return self.send_body(200, {"error": error})
+                return self.send_body(200, {"stream": "Loaded\n"})
+            if method == "POST" and parts == ["build"]:
+                tag = params.get("t", "")
+                state.images[tag] = {"Id": "sha256:" + uuid.uuid4().hex,
+                    "RepoTags": [tag], "Size": len(body),
+                    "Created": int(time.time()),
+                    "Labels": json.loads(params.get("labels", "{}")),
+                    "RootFS": {"Layers": [
+                        self.add_layer(b"base layer" * 1000),
+                        self.add_layer(tag.encode("utf-8") * 1000)]}}
+                lines = [{"stream": "Step 1/1 : FROM scratch\n"},
+                    {"stream": " ---> Using cache\n"},
+                    {"stream": "Successfully tagged " + tag + "\n"}]
+                if state.build_error is not None:
+                    del state.images[tag]
+                    lines[1:] = [{"error": state.build_error}]
+                return self.send_body(200, "\r\n".join(
+                    [json.dumps(line) for line in lines]) + "\r\n")
+            if method == "GET" and parts == ["containers", "json"]:
+                filters = json.loads(params.get("filters", "{}"))
+                result = []
+                for container in state.containers.values():
+                    if params.get("all", "0") != "1" and \
+                            container["State"] != "running":
+                        continue
+                    if not all([self.label_matches(container, label)
+                                for label in filters.get("label", [])]):
+                        continue
+                    if not all([n in container["Name"]
+                                for n in filters.get("name", [])]):
+                        continue
+                    result.append({"Id": container["Id"],
+                        "Names": ["/" + container["Name"]],
+                        "Image": container["Image"],
+                        "Labels": container["Labels"],
+                        "State": container["State"]})
+                return self.send_body(200, result)
+            if method == "POST" and parts == ["containers", "create"]:
+                config = json.loads(body.decode("utf-8"))
+                if config.get("Image") not in state.images:
+                    return self.not_found("image: " +
+                        str(config.get("Image")))
+                cid = uuid.uuid4().hex
+                name = params.get("name", cid[:12])
+                state.containers[cid] = {"Id": cid, "Name": name,
+                    "Image": config["Image"],
+                    "Cmd": config.get("Cmd") or [],
+                    "Labels": config.get("Labels") or dict(),
+                    "HostConfig": config.get("HostConfig") or dict(),
+                    "Uploads": [], "State": "created"}
+                return self.send_body(201, {"Id": cid})
+            if len(parts) >= 2 and parts[0] == "containers":
+                container = self.find_container(parts[1])
+                if container is None:
+                    return self.not_found("container: " + parts[1])
+                action = parts[2] if len(parts) > 2 else None
+                if method == "DELETE" and action is None:
+                    if container["State"] == "running" and \
+                            params.get("force", "0") != "1":
+                        return self.send_body(409,
+                            {"message": "container is running"})
+                    del state.containers[container["Id"]]
+                    return self.send_body(204, b"")
+                if method == "POST" and action == "start":
+                    container["State"] = "exited"
+                    return self.send_body(204, b"")
+                if method == "POST" and action == "kill":
+                    container["State"] = "exited"
+                    return self.send_body(204, b"")
+                if method == "POST" and action == "update":
+                    container.setdefault("HostConfig", dict()).update(
+                        json.loads(body.decode("utf-8") or "{}"))
+                    return self.send_body(200, {"Warnings": []})
+                if method == "POST" and action == "rename":
+                    container["Name"] = params["name"]
+                    return self.send_body(204, b"")
+                if method == "POST" and action == "wait":
+                    return self.send_body(200, {"StatusCode": 0})
+                if method == "PUT" and action == "archive":
+                    container["Uploads"].append((params["path"], body))
+                    return self.send_body(200, b"")
+                if method == "GET" and action == "archive":
+                    name = params["path"].rstrip("/").rpartition("/")[2]
+                    tar_data = io.BytesIO()
+                    with tarfile.open(fileobj=tar_data, mode="w") as tar:
+                        info = tarfile.TarInfo(name)
+                        info.type = tarfile.DIRTYPE
+                        tar.addfile(info)
+                        data = ("fake apk of " + container["Image"]).encode(
+                            "utf-8")
+                        info = tarfile.TarInfo(name + "/fake.apk")
+                        info.size = len(data)
+                        tar.addfile(info, io.BytesIO(data))
+                    return self.send_body(200, tar_data.getvalue(),
+                        "application/x-tar")
+                if method == "GET" and action == "logs":
+                    frames = container.get("Logs", [(1, "ran " +
+                        " ".join(container["Cmd"]) + "\n")])
+                    data = b""
+                    for (stream_type, text) in frames:
+                        text = text.encode("utf-8")
+                        data += struct.pack(">BxxxL", stream_type,
+                            len(text)) + text
+                    return self.send_body(200, data,
+                        "application/vnd.docker.raw-stream")
+            return self.not_found("endpoint: " + parsed.path)
+
+    @staticmethod
+    def label_matches(item, label):
+        (key, has_value, value) = label.partition("=")
+        labels = item.get("Labels") or dict()
+        if key not in labels:
+            return False
+        return not has_value or labels[key] == value
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_PUT(self):
+        self.handle_any("PUT")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+class FakeDockerServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.socket_path = socket_path
+        self.state = FakeDockerState()
+        super().__init__(socket_path, FakeDockerHandler)
+
+    @property
+    def url(self):
+        return "unix://" + self.socket_path
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+            daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
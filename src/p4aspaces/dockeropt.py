@@ -0,0 +1,208 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import re
+
+from .settings import settings
+
+# Post-processing of rendered Dockerfiles, to get fewer & smaller layers:
+#
+#  - adjacent RUN instructions (only comments in between) with the same
+#    flags are merged into one "RUN (a) && (b)", unless they're in exec
+#    form, contain a "#" (cache-busting comments, embedded scripts) or a
+#    here-doc, or are marked with a "# optimize: keep-layer" comment
+#  - "apt update" is dropped where the lists are still fresh in the same
+#    merged RUN, and the lists are removed at the end of it (not needed
+#    with BuildKit cache mounts, which keep them out of the layer). Later
+#    layers which install packages without updating get an update again
+#
+# Instructions other than RUN are never moved across.
+KEEP_LAYER_COMMENT = "# optimize: keep-layer"
+APT_UPDATE = re.compile(r"^apt(-get)? update( --fix-missing| -y| -q+)*$")
+APT_INSTALL = re.compile(r"^(apt|apt-get) (-\S+ )*install( |$)")
+APT_SOURCES_CHANGE = re.compile(
+    r"add-architecture|sources\.list|add-apt-repository")
+APT_CLEANUP = "rm -rf /var/lib/apt/lists/*"
+LAYER_INSTRUCTIONS = ["RUN", "COPY", "ADD"]
+
+def enabled():
+    return bool(settings.get("optimize_dockerfile", default=False))
+
+def parse(text):
+    # Returns a list of (keyword, text) items, where keyword is None for
+    # comments & blank lines. Continuation lines stay part of their item.
+    items = []
+    continued = False
+    for line in text.split("\n"):
+        if continued:
+            items[-1] = (items[-1][0], items[-1][1] + "\n" + line)
+        elif len(line.strip()) == 0 or line.strip().startswith("#"):
+            items.append((None, line))
+        else:
+            items.append((line.split()[0].upper(), line))
+        continued = (items[-1][0] is not None and line.endswith("\\"))
+    return items
+
+def count_layers(text):
+    return len([item for item in parse(text)
+                if item[0] in LAYER_INSTRUCTIONS])
+
+def split_run(text):
+    # "RUN --mount=a --mount=b cmd" -> ("--mount=a --mount=b", "cmd"):
+    rest = text.strip()[len("RUN"):].strip()
+    flags = []
+    while rest.startswith("--"):
+        (flag, _, rest) = rest.partition(" ")
+        flags.append(flag)
+        rest = rest.strip()
+    return (" ".join(flags), rest)
+
+def mergeable(text):
+    (flags, command) = split_run(text)
+    return not command.startswith("[") and "#" not in command and \
+        "<<" not in command
+
+def split_command(command):
+    # Top-level "&&" parts of a command, or None if it is too complicated
+    # to split safely (quotes, subshells, line continuations):
+    if re.search(r"[\"'`()\\\n]", command):
+        return None
+    return [part.strip() for part in command.split("&&")]
+
+class RunGroup(object):
+    def __init__(self, flags):
+        self.flags = flags
+        self.comments = []
+        self.commands = []
+
+    def emit(self, state, report):
+        # Returns the lines of the merged RUN, updating the apt state:
+        parts = []
+        lists_fresh = False
+        for command in self.commands:
+            command_parts = split_command(command)
+            if command_parts is None:
+                parts.append(command)
+                lists_fresh = False
+                continue
+            kept = []
+            for part in command_parts:
+                if APT_UPDATE.match(part):
+                    if lists_fresh:
+                        report["apt_updates_removed"] += 1
+                        continue
+                    lists_fresh = True
+                elif APT_INSTALL.match(part) and not lists_fresh and \
+                        state["lists_removed"]:
+                    kept.append("apt update")
+                    report["apt_updates_added"] += 1
+                    lists_fresh = True
+                elif APT_SOURCES_CHANGE.search(part):
+                    lists_fresh = False
+                kept.append(part)
+            parts.append(" && ".join(kept))
+        if "/var/lib/apt/lists" in self.flags:
+            state["lists_removed"] = False
+        elif any([APT_UPDATE.match(part) or part.startswith("apt update")
+                for part in " && ".join(parts).split(" && ")]):
+            parts.append(APT_CLEANUP)
+            state["lists_removed"] = True
+        flags = (self.flags + " ") if len(self.flags) > 0 else ""
+        if len(parts) == 1:
+            run = "RUN " + flags + parts[0]
+        else:
+            run = "RUN " + flags + " \\\n    && ".join(
+                ["(" + part + ")" for part in parts])
+        return self.comments + [run]
+
+def optimize(text):
+    # Returns the optimized Dockerfile, and a report dict with the layer
+    # counts before & after:
+    report = {"layers_before": count_layers(text),
+        "apt_updates_removed": 0, "apt_updates_added": 0}
+    output = []
+    group = None
+    pending = []
+    keep_next = False
+    stage_states = dict()
+    state = {"lists_removed": False}
+
+    def flush():
+        if group is not None:
+            output.extend(group.emit(state, report))
+
+    for (keyword, item_text) in parse(text):
+        if keyword is None:
+            if item_text.strip() == KEEP_LAYER_COMMENT:
+                keep_next = True
+                continue
+            pending.append(item_text)
+            continue
+        if keyword == "RUN" and mergeable(item_text) and not keep_next:
+            (flags, command) = split_run(item_text)
+            if group is None or group.flags != flags:
+                flush()
+                group = RunGroup(flags)
+            if len(group.commands) > 0:
+                # Comments of merged instructions move above the RUN:
+                pending = [line for line in pending
+                           if len(line.strip()) > 0]
+            group.comments.extend(pending)
+            group.commands.append(command)
+            pending = []
+            continue
+        flush()
+        group = None
+        if keyword == "RUN" and mergeable(item_text) and keep_next:
+            # Stays a layer of its own (the apt state is still tracked):
+            single = RunGroup(split_run(item_text)[0])
+            single.commands.append(split_run(item_text)[1])
+            output.extend(pending + single.emit(state, report))
+            pending = []
+            keep_next = False
+            continue
+        keep_next = False
+        if keyword == "FROM":
+            # Track the apt lists state per build stage:
+            (_, _, from_args) = item_text.strip().partition(" ")
+            from_args = from_args.split()
+            if len(from_args) >= 3 and from_args[-2].upper() == "AS":
+                stage_states[from_args[-1]] = {"lists_removed": False}
+                state = stage_states[from_args[-1]]
+            elif len(from_args) > 0 and from_args[0] in stage_states:
+                state = dict(stage_states[from_args[0]])
+            else:
+                state = {"lists_removed": False}
+        output.extend(pending)
+        pending = []
+        output.append(item_text)
+    flush()
+    output.extend(pending)
+    result = "\n".join(output)
+    report["layers_after"] = count_layers(result)
+    return (result, report)
+
+def format_report(report):
+    return "Dockerfile optimized: " + str(report["layers_before"]) + \
+        " -> " + str(report["layers_after"]) + " layers (" + \
+        str(report["apt_updates_removed"]) + " apt updates removed, " + \
+        str(report["apt_updates_added"]) + " added)"
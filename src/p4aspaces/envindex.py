@@ -0,0 +1,47 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+
+# The environments are the folders in environments/ which have a
+# short_description.txt. This module only looks at the file system, so
+# commands which just need names or descriptions don't have to import
+# buildenv (and with it the docker client).
+
+def get_environments_dir():
+    return os.path.abspath(os.path.join(
+        os.path.dirname(__file__), "environments"))
+
+def is_environment(name):
+    return not name.startswith(".") and "/" not in name and \
+        os.path.exists(os.path.join(get_environments_dir(), name,
+                                    "short_description.txt"))
+
+def get_environment_names():
+    return sorted([p for p in os.listdir(get_environments_dir())
+                   if is_environment(p)])
+
+def read_description(name, envs_dir=None):
+    # First line of the environment's short_description.txt:
+    with open(os.path.join(envs_dir or get_environments_dir(), name,
+            "short_description.txt"), "r", encoding="utf-8") as f:
+        return f.read().strip().partition("\n")[0]
@@ -0,0 +1,157 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import json
+import re
+import subprocess
+import time
+import urllib.parse
+import urllib.request
+
+from .settings import settings
+
+# Resolves branch (or tag) names of the p4a/buildozer repositories to
+# commits, so the Dockerfile can download the archive of that exact
+# commit: the pip install layer is then rebuilt exactly when upstream
+# moved. Resolved commits are cached in the settings for a few minutes
+# to keep launches fast, and reused when offline. The "git_mirrors"
+# setting maps repository urls to local mirrors to ask instead, and
+# set_resolver() swaps out "git ls-remote" altogether (e.g. in tests).
+# The latest pypi release of a package (what "stable" installs) is looked
+# up and cached the same way, see resolve_release(). Failed lookups are
+# remembered for a minute too, so offline launches don't each wait for
+# the timeout, and cached_only=True never goes online at all (e.g. for
+# print-dockerfile).
+DEFAULT_CACHE_TTL = 10 * 60
+DEFAULT_FAILURE_TTL = 60
+
+def is_commit(name):
+    return re.match(r"^[0-9a-f]{40}$", str(name)) is not None
+
+def get_mirror(repo):
+    return settings.get("git_mirrors", type=dict).get(repo, repo)
+
+def ls_remote_resolver(repo, name):
+    # Returns the commit of branch or tag "name", or None:
+    output = subprocess.check_output(["git", "ls-remote",
+        get_mirror(repo), name], stderr=subprocess.DEVNULL,
+        stdin=subprocess.DEVNULL, timeout=30).decode("utf-8", "replace")
+    refs = dict()
+    for line in output.splitlines():
+        (commit, _, ref) = line.strip().partition("\t")
+        refs[ref] = commit
+    for ref in ["refs/heads/" + name, "refs/tags/" + name + "^{}",
+            "refs/tags/" + name]:
+        if ref in refs and is_commit(refs[ref]):
+            return refs[ref]
+    return None
+
+def pypi_release_resolver(package):
+    # Returns the version of the latest release of package on pypi:
+    with urllib.request.urlopen("https://pypi.org/pypi/" +
+            urllib.parse.quote(package) + "/json",
+            timeout=30) as response:
+        return json.loads(response.read().decode("utf-8"))["info"][
+            "version"]
+
+_resolver = ls_remote_resolver
+_release_resolver = pypi_release_resolver
+
+def set_resolver(resolver):
+    # resolver(repo, name) returns a commit id or None:
+    global _resolver
+    _resolver = resolver
+
+def set_release_resolver(resolver):
+    # resolver(package) returns a version or None:
+    global _release_resolver
+    _release_resolver = resolver
+
+def cached_lookup(key, field, lookup, refresh=False, cached_only=False):
+    # The "field" of the "resolved_refs" entry "key", looked up again
+    # with lookup() when it's older than the ttl (or refresh is set):
+    cached = settings.get("resolved_refs", type=dict).get(key, None) or \
+        dict()
+    known = cached.get(field, None)
+    if cached_only:
+        return known
+    ttl = settings.get("ref_cache_ttl", default=DEFAULT_CACHE_TTL)
+    if known is not None and not refresh and \
+            time.time() - cached.get("time", 0) < ttl:
+        return known
+    failure_ttl = settings.get("ref_failure_ttl",
+        default=DEFAULT_FAILURE_TTL)
+    if not refresh and time.time() - cached.get("failed", 0) < failure_ttl:
+        # Failed just now, stay with what we had:
+        return known
+    try:
+        value = lookup()
+    except (OSError, ValueError, KeyError, subprocess.SubprocessError):
+        value = None
+    if value is None:
+        # Offline or unknown, stay with what we had:
+        with settings.transaction() as store:
+            store.setdefault("resolved_refs", dict()).setdefault(key,
+                dict())["failed"] = time.time()
+        return known
+    with settings.transaction() as store:
+        store.setdefault("resolved_refs", dict())[key] = {
+            field: value, "time": time.time()}
+    return value
+
+def resolve(repo, name, refresh=False, cached_only=False):
+    # Commit of the branch/tag "name" in repo, or None if it couldn't be
+    # resolved. With refresh=True, the cached result isn't used:
+    if is_commit(name):
+        return name
+    return cached_lookup(repo + "#" + name, "commit",
+        lambda: _resolver(repo, name), refresh=refresh,
+        cached_only=cached_only)
+
+def resolve_release(package, refresh=False, cached_only=False):
+    # Version of the latest pypi release of package, or None:
+    return cached_lookup("pypi#" + package, "version",
+        lambda: _release_resolver(package), refresh=refresh,
+        cached_only=cached_only)
+
+def release_tags(version):
+    # Tag names the release "version" might have, most likely first:
+    # pypi normalizes "2019.07.08" to "2019.7.8", tags usually keep the
+    # zeros and a "v" in front.
+    parts = str(version).split(".")
+    result = []
+    if all([part.isdigit() for part in parts]):
+        result.append("v" + ".".join([parts[0]] +
+            ["%02d" % int(part) for part in parts[1:]]))
+    for name in ["v" + str(version), str(version)]:
+        if name not in result:
+            result.append(name)
+    return result
+
+def resolve_version(repo, version, refresh=False, cached_only=False):
+    # Commit of the release "version" in repo, or None:
+    for name in release_tags(version):
+        commit = resolve(repo, name, refresh=refresh,
+            cached_only=cached_only)
+        if commit is not None:
+            return commit
+    return None
@@ -0,0 +1,157 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import subprocess
+import sys
+import threading
+import urllib.parse
+
+from . import dockerapi
+from .settings import settings
+
+# Placement of launches on several docker hosts. The "docker_hosts"
+# setting lists DOCKER_HOST-style urls ("unix:///var/run/docker.sock",
+# "tcp://build2:2375", "ssh://user@build3"). With "--docker-host auto"
+# (the default when the setting isn't empty), every launch goes to the
+# host with the lowest load, i.e. running p4atestenv containers plus the
+# launches this process has placed there which didn't start yet. Hosts
+# which have the image already get a bonus, since building it there
+# first takes about as long as waiting for a few other builds.
+AFFINITY_BONUS = 2
+CONTAINER_PREFIX = "p4atestenv-"
+CACHE_VOLUME_PREFIX = "p4aspaces-cache-"
+
+_lock = threading.Lock()
+_pending = dict()
+
+def get_hosts():
+    return list(settings.get("docker_hosts", default=[]) or [])
+
+def host_count(docker_host):
+    # How many hosts launches with this --docker-host are spread over:
+    if docker_host == "auto" or (docker_host is None and
+            len(get_hosts()) > 0):
+        return max(1, len(get_hosts()))
+    return 1
+
+def is_local(host):
+    # Whether host folders can be bind mounted on this docker host:
+    if host is None:
+        return True
+    parsed = urllib.parse.urlparse(host)
+    if parsed.scheme == "unix":
+        return True
+    return parsed.scheme in ["tcp", "http"] and \
+        parsed.hostname in ["localhost", "127.0.0.1", "::1"]
+
+def running_containers(host):
+    # Names of the running p4atestenv containers on the host, or None if
+    # it can't be reached:
+    client = dockerapi.get_client(host)
+    if client is not None:
+        try:
+            return [container["Names"][0].lstrip("/")
+                for container in client.list_containers(
+                name=CONTAINER_PREFIX)]
+        except (OSError, dockerapi.DockerAPIError):
+            return None
+    try:
+        output = subprocess.check_output(["docker", "-H", host, "ps",
+            "--filter", "name=" + CONTAINER_PREFIX,
+            "--format", "{{.Names}}"],
+            stderr=subprocess.DEVNULL, timeout=30)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired,
+            FileNotFoundError):
+        return None
+    return output.decode("utf-8", "replace").split()
+
+def has_image(host, image_tag):
+    client = dockerapi.get_client(host)
+    if client is not None:
+        try:
+            return client.image_exists(image_tag)
+        except (OSError, dockerapi.DockerAPIError):
+            return False
+    return subprocess.call(["docker", "-H", host, "image", "inspect",
+        image_tag], stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL) == 0
+
+def choose_host(docker_host, image_tag, container_name):
+    # Returns the host to launch container_name on, which stays reserved
+    # until release() is called. None means the default docker host.
+    if docker_host is None:
+        if len(get_hosts()) == 0:
+            return None
+        docker_host = "auto"
+    if docker_host != "auto":
+        reserve(docker_host, container_name)
+        return docker_host
+    candidates = get_hosts()
+    if len(candidates) == 0:
+        print("p4aspaces: error: --docker-host auto needs a list of " +
+            "hosts in the 'docker_hosts' setting.",
+            file=sys.stderr, flush=True)
+        sys.exit(1)
+    with _lock:
+        best = None
+        for (index, host) in enumerate(candidates):
+            running = running_containers(host)
+            if running is None:
+                print("p4aspaces: warning: docker host " + host +
+                    " is not reachable, skipping it.",
+                    file=sys.stderr, flush=True)
+                continue
+            load = len(running) + len([name for name in
+                _pending.get(host, []) if name not in running])
+            if has_image(host, image_tag):
+                load -= AFFINITY_BONUS
+            if best is None or load < best[0]:
+                best = (load, host)
+        if best is None:
+            print("p4aspaces: error: none of the docker hosts " +
+                "is reachable.", file=sys.stderr, flush=True)
+            sys.exit(1)
+        _pending.setdefault(best[1], []).append(container_name)
+        return best[1]
+
+def reserve(host, container_name):
+    with _lock:
+        _pending.setdefault(host, []).append(container_name)
+
+def release(host, container_name):
+    with _lock:
+        if container_name in _pending.get(host, []):
+            _pending[host].remove(container_name)
+
+def cache_volumes(ccache_dir, uid):
+    # Binds of the named volumes which hold the compiler, gradle and
+    # maven caches on a remote host (the ccache namespace folder name
+    # keeps the namespaces apart). Every user id gets volumes of its
+    # own, since the entrypoint only hands fresh ones to the user:
+    ccache_name = os.path.basename(os.path.normpath(ccache_dir))
+    suffix = "-" + str(uid)
+    return [CACHE_VOLUME_PREFIX + "ccache-" + ccache_name + suffix +
+            ":/ccache/:rw",
+        CACHE_VOLUME_PREFIX + "gradle" + suffix +
+            ":/home/userhome/.gradle:rw",
+        CACHE_VOLUME_PREFIX + "m2" + suffix + ":/home/userhome/.m2:rw"]
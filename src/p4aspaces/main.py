@@ -23,24 +23,19 @@ THE SOFTWARE.
 '''
 
 import argparse
-import os
-import shutil
-import subprocess
 import sys
-import tempfile
-import uuid
-import urllib.parse
 
 from p4aspaces.actions import actions
 
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    all_actions = actions()
     argparser = argparse.ArgumentParser()
     argparser.add_argument("action",
         nargs=1,
         help="The p4a-build-spaces action out of \"" +
-        "\", \"".join(sorted([aname for aname in actions().keys()])) +
+        "\", \"".join(sorted([aname for aname in all_actions.keys()])) +
         "\"",
         )
     argparser.add_argument("arguments",
@@ -58,20 +53,20 @@ def main(args=None):
     args = argparser.parse_args(args)
     if len(args.action) > 0:
         args.action = args.action[0]
-    if args.action not in actions().keys():
+    if args.action not in all_actions.keys():
         print("p4aspaces: error: not a known action: \"" + str(args.action) +
             "\".", file=sys.stderr, flush=True)
         print("       Available actions are:",
             file=sys.stderr, flush=True)
-        print("        - " + "\n        - ".join(actions().keys()),
+        print("        - " + "\n        - ".join(all_actions.keys()),
             file=sys.stderr, flush=True)
         print("       Get more detailed help on an action like this:",
             file=sys.stderr, flush=True)
         print("          p4aspaces " +
-            str(list(actions().keys())[0]) + " --help",
+            str(list(all_actions.keys())[0]) + " --help",
             file=sys.stderr, flush=True)
         sys.exit(1)
-    actions()[args.action]["function"](args.arguments)
+    all_actions[args.action]["function"](args.arguments)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
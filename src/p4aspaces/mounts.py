@@ -0,0 +1,137 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import hashlib
+import os
+import subprocess
+import sys
+import uuid
+
+from . import cleanup
+from . import dockerapi
+from .settings import settings
+
+# How host folders get mounted into the container. With SELinux, ":Z"
+# makes docker relabel the entire tree on every launch, which takes
+# minutes for a big ~/.buildozer:
+#
+#  - "Z": private relabel (the old default, safe but slow on SELinux)
+#  - "z": shared relabel, so a tree that is already labeled shared is
+#         not relabeled again
+#  - "nolabel": no relabeling, confinement disabled for the container
+#         instead ("--security-opt label=disable")
+#  - "volume": the workspace & buildozer folders are delta-synced with
+#         rsync into persistent named volumes before launch, and synced
+#         back afterwards, so launch time depends on what changed only
+MOUNT_MODES = ["Z", "z", "nolabel", "volume"]
+DEFAULT_MOUNT_MODE = "Z"
+SYNC_VOLUME_PREFIX = "p4aspaces-sync-"
+
+def get_mount_mode(mode=None):
+    if mode is None:
+        mode = settings.get("mount_mode", default=DEFAULT_MOUNT_MODE)
+    if mode not in MOUNT_MODES:
+        return DEFAULT_MOUNT_MODE
+    return mode
+
+def bind_options(mode):
+    # Options appended to the host folder binds:
+    if mode in ["Z", "z"]:
+        return ":rw," + mode
+    return ":rw"
+
+def security_options(mode):
+    if mode in ["nolabel", "volume"]:
+        return ["label=disable"]
+    return []
+
+def sync_volume_name(host_path):
+    return SYNC_VOLUME_PREFIX + hashlib.sha256(os.path.abspath(
+        host_path).encode("utf-8")).hexdigest()[:16]
+
+def sync(image_tag, host_path, volume_name, back=False):
+    # Mirror the host folder into the volume (or back with back=True),
+    # using rsync in a helper container of the environment image. Only
+    # changed files are transferred. Returns True on success.
+    (source, target) = ("/host/", "/volume/")
+    if back:
+        (source, target) = (target, source)
+    cmd = ["-a", "--delete", source, target]
+    binds = [os.path.abspath(host_path) + ":/host:rw",
+        volume_name + ":/volume:rw"]
+    client = dockerapi.get_client()
+    if client is not None:
+        name = "p4aspaces-sync-" + str(uuid.uuid4()).replace("-", "")
+        try:
+            return client.run(image_tag, name=name, cmd=cmd, binds=binds,
+                labels={cleanup.OWNER_LABEL: cleanup.owner_id()},
+                user="root", entrypoint=["rsync"],
+                security_opt=security_options("volume")) == 0
+        finally:
+            try:
+                client.remove(name, force=True)
+            except dockerapi.DockerAPIError:
+                pass
+    run_args = dockerapi.docker_command() + ["run", "--rm",
+        "--user", "root", "--entrypoint", "rsync",
+        "--label", cleanup.OWNER_LABEL + "=" + cleanup.owner_id()]
+    for option in security_options("volume"):
+        run_args += ["--security-opt", option]
+    for bind in binds:
+        run_args += ["-v", bind]
+    return subprocess.call(run_args + [image_tag] + cmd) == 0
+
+class MountPlan(object):
+    def __init__(self, mode, image_tag):
+        self.mode = get_mount_mode(mode)
+        self.image_tag = image_tag
+        self.synced = []
+
+    def bind(self, host_path, container_path, sync_large=False):
+        # Returns the docker bind spec for a host folder. Large folders
+        # (workspace, .buildozer) are synced to a volume in "volume" mode:
+        if self.mode == "volume" and sync_large:
+            volume_name = sync_volume_name(host_path)
+            if not sync(self.image_tag, host_path, volume_name):
+                print("p4aspaces: error: syncing " + str(host_path) +
+                    " into the volume " + volume_name + " failed.",
+                    file=sys.stderr, flush=True)
+                sys.exit(1)
+            self.synced.append((host_path, volume_name))
+            return volume_name + ":" + container_path + ":rw"
+        return os.path.abspath(host_path) + ":" + container_path + \
+            bind_options(self.mode)
+
+    def run_args(self):
+        result = []
+        for option in security_options(self.mode):
+            result += ["--security-opt", option]
+        return result
+
+    def sync_back(self):
+        # Copy changes made inside the container back to the host:
+        ok = True
+        for (host_path, volume_name) in self.synced:
+            if not sync(self.image_tag, host_path, volume_name, back=True):
+                ok = False
+        self.synced = []
+        return ok
@@ -0,0 +1,299 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from . import dockerapi
+from . import resources
+from .settings import settings
+
+# Pooled containers are idle, pre-started containers of an image which
+# already went through the entrypoint (user setup). They are tracked
+# purely through docker labels, and claimed by atomically renaming them
+# with "docker rename", so concurrent p4aspaces invocations never get
+# the same container.
+#
+# Each one has a "p4a-pool-*" folder in the temp dir, with the output/
+# folder it mounts. The launch claiming it puts its owner file there,
+# so "p4aspaces gc" can tell when a claimed container was left behind.
+# Idle ones are removed by gc after the "pool_max_idle" setting (in
+# seconds), or when their image got rebuilt.
+POOL_LABEL = "p4aspaces.pool"
+POOL_IMAGE_LABEL = "p4aspaces.pool.image"
+POOL_IMAGE_ID_LABEL = "p4aspaces.pool.image_id"
+POOL_FOLDER_LABEL = "p4aspaces.pool.output"
+POOL_CREATED_LABEL = "p4aspaces.pool.created"
+LABELS = [POOL_LABEL, POOL_IMAGE_LABEL, POOL_IMAGE_ID_LABEL,
+    POOL_FOLDER_LABEL, POOL_CREATED_LABEL]
+DEFAULT_MAX_IDLE = 24 * 60 * 60
+
+WARM_COMMAND = ["sleep", "infinity"]
+# ("docker exec" doesn't go through the entrypoint, which sets up the
+# shell environment otherwise)
+CLAIMED_COMMAND = ["sh", "-c", ". /tmp/p4aspaces-env.sh && exec \"$@\"",
+    "sh"]
+
+fill_lock = threading.Lock()
+
+def is_idle_name(name):
+    return name.startswith("p4aspool-")
+
+def list_pool_containers(key=None):
+    # Returns dicts with "name", "state" and "labels" of all containers
+    # which came from a pool (optionally only the given one), idle or
+    # claimed (claimed ones got renamed, but keep their labels), in any
+    # state. Raises OSError or DockerAPIError if docker can't be asked.
+    label_filter = POOL_LABEL
+    if key is not None:
+        label_filter += "=" + key
+    client = dockerapi.get_client()
+    if client is not None:
+        return [{"name": container["Names"][0].lstrip("/"),
+            "state": container.get("State", ""),
+            "labels": container.get("Labels") or dict()}
+            for container in client.list_containers(all=True,
+            labels=[label_filter])]
+    try:
+        output = subprocess.check_output(dockerapi.docker_command() + [
+            "ps", "-a", "--filter", "label=" + label_filter,
+            "--format", "\t".join(["{{.Names}}", "{{.State}}"] +
+            ["{{.Label \"" + label + "\"}}" for label in LABELS])],
+            stderr=subprocess.DEVNULL).decode("utf-8", "replace")
+    except subprocess.CalledProcessError as e:
+        raise OSError("docker ps failed: " + str(e))
+    result = []
+    for line in output.splitlines():
+        parts = line.split("\t")
+        if len(parts) == 2 + len(LABELS):
+            result.append({"name": parts[0], "state": parts[1],
+                "labels": dict(zip(LABELS, parts[2:]))})
+    return result
+
+def list_pooled(key=None):
+    # Returns (container name, pool key, image, pool folder) tuples of
+    # all idle pooled containers, optionally only of the given pool:
+    try:
+        containers = list_pool_containers(key)
+    except (OSError, dockerapi.DockerAPIError):
+        return []
+    return [(container["name"], container["labels"].get(POOL_LABEL, ""),
+        container["labels"].get(POOL_IMAGE_LABEL, ""),
+        container["labels"].get(POOL_FOLDER_LABEL, ""))
+        for container in containers
+        if is_idle_name(container["name"]) and
+        container["state"] == "running"]
+
+def pool_folders():
+    # Returns the folders of all containers which came from a pool, idle
+    # or claimed, running or not. None if docker can't be asked:
+    try:
+        containers = list_pool_containers()
+    except (OSError, dockerapi.DockerAPIError):
+        return None
+    return [container["labels"].get(POOL_FOLDER_LABEL, "")
+            for container in containers]
+
+def get_max_idle():
+    return settings.get("pool_max_idle", default=DEFAULT_MAX_IDLE)
+
+def get_image_id(image_tag):
+    # The id of the image the tag currently points to, or None:
+    client = dockerapi.get_client()
+    try:
+        if client is not None:
+            return client.inspect_image(image_tag)["Id"]
+        return subprocess.check_output(dockerapi.docker_command() + [
+            "image", "inspect", "--format", "{{.Id}}", image_tag],
+            stderr=subprocess.DEVNULL).decode("utf-8", "replace").strip()
+    except (OSError, KeyError, subprocess.CalledProcessError,
+            dockerapi.DockerAPIError):
+        return None
+def rename_container(name, new_name):
+    client = dockerapi.get_client()
+    if client is not None:
+        try:
+            client.rename(name, new_name)
+            return True
+        except dockerapi.DockerAPIError:
+            return False
+    return subprocess.call(dockerapi.docker_command() + ["rename",
+        name, new_name],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL) == 0
+
+def remove_pooled(container_name, folder):
+    client = dockerapi.get_client()
+    if client is not None:
+        try:
+            client.remove(container_name, force=True)
+        except dockerapi.DockerAPIError:
+            pass
+    else:
+        subprocess.call(dockerapi.docker_command() + ["rm", "-f",
+            container_name],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if folder and os.path.basename(
+            os.path.normpath(folder)).startswith("p4a-pool-"):
+        shutil.rmtree(folder, ignore_errors=True)
+
+def apply_limits(container_name, limits):
+    # Resource limits depend on the load at claim time, so pooled
+    # containers start without them and get them when claimed:
+    if limits is None:
+        return
+    client = dockerapi.get_client()
+    try:
+        if client is not None:
+            client.update(container_name, nano_cpus=limits[0] * 1e9,
+                memory=limits[1], memory_swap=int(limits[1]) * 2)
+            return
+        subprocess.check_call(dockerapi.docker_command() + ["update"] +
+            resources.update_args(limits) + [container_name],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError,
+            dockerapi.DockerAPIError):
+        print("p4aspaces: warning: setting the resource limits of " +
+            "the pooled container failed.", file=sys.stderr, flush=True)
+
+@contextlib.contextmanager
+def locked_fill():
+    # Serializes filling pools across threads and (through an advisory
+    # lock file) processes:
+    with fill_lock:
+        with open(os.path.join(settings.settings_folder(), "pool.lock"),
+                "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+class ContainerPool(object):
+    def __init__(self, image_tag, run_args, size=1,
+            output_options=":rw,Z", user=(0, 0), image_id=None):
+        # run_args are the extra "docker run" arguments (volumes) all
+        # containers of this pool share, so they are part of the key,
+        # like the image id (so a rebuilt image gets a new pool).
+        # Resource limits aren't, see claim().
+        self.image_tag = image_tag
+        self.image_id = image_id or get_image_id(image_tag) or ""
+        self.run_args = list(run_args)
+        self.size = size
+        self.output_options = output_options
+        self.user = user
+        self.key = hashlib.sha256(json.dumps(
+            [image_tag, self.image_id, output_options] +
+            self.run_args).encode("utf-8")).hexdigest()[:16]
+
+    def claim(self, new_name, limits=None):
+        # Returns the pool folder of the claimed container (with its
+        # output/ folder), which has been renamed to new_name and got the
+        # resource limits (see resources.get_limits()). Returns None if
+        # the pool is empty.
+        for (name, key, image, folder) in list_pooled(self.key):
+            if rename_container(name, new_name):
+                apply_limits(new_name, limits)
+                return folder
+        return None
+
+    def exec_command(self, container_name, command, interactive=True,
+            environment=()):
+        # "docker exec" bypasses the entrypoint which drops privileges,
+        # so the user needs to be given explicitly. environment are
+        # extra variables for the command (like resources.environment()):
+        env_args = []
+        for variable in environment:
+            env_args += ["-e", variable]
+        return dockerapi.docker_command() + ["exec"] +\
+            (["-ti"] if interactive else []) +\
+            ["--user", str(self.user[0]) + ":" + str(self.user[1])] +\
+            env_args + [container_name] + CLAIMED_COMMAND + list(command)
+
+    def fill(self):
+        # Create containers until the pool is full, and start them in
+        # the background. Containers which are created but not started
+        # yet count as well, and concurrent fills wait for each other,
+        # so the pool doesn't get overfilled. Idle containers of an
+        # older image with this tag are removed.
+        with locked_fill():
+            try:
+                containers = list_pool_containers()
+            except (OSError, dockerapi.DockerAPIError):
+                return
+            existing = 0
+            for container in containers:
+                labels = container["labels"]
+                if not is_idle_name(container["name"]):
+                    continue
+                if labels.get(POOL_IMAGE_LABEL, "") == self.image_tag and \
+                        labels.get(POOL_IMAGE_ID_LABEL, "") != \
+                        self.image_id:
+                    remove_pooled(container["name"],
+                        labels.get(POOL_FOLDER_LABEL, ""))
+                elif labels.get(POOL_LABEL, "") == self.key and \
+                        container["state"] in ["created", "running"]:
+                    existing += 1
+            for i in range(max(0, self.size - existing)):
+                folder = tempfile.mkdtemp(prefix="p4a-pool-")
+                output_dir = os.path.join(folder, "output")
+                os.mkdir(output_dir)
+                os.chmod(output_dir, 0o777)
+                name = "p4aspool-" + str(uuid.uuid4()).replace("-", "")
+                if subprocess.call(dockerapi.docker_command() + ["create",
+                        "--name", name,
+                        "--label", POOL_LABEL + "=" + self.key,
+                        "--label", POOL_IMAGE_LABEL + "=" + self.image_tag,
+                        "--label", POOL_IMAGE_ID_LABEL + "=" +
+                        self.image_id,
+                        "--label", POOL_FOLDER_LABEL + "=" + folder,
+                        "--label", POOL_CREATED_LABEL + "=" +
+                        str(int(time.time())),
+                        "-v", output_dir + ":/home/userhome/output" +
+                        self.output_options] +
+                        self.run_args + [self.image_tag] + WARM_COMMAND,
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL) != 0:
+                    shutil.rmtree(folder, ignore_errors=True)
+                    return
+                subprocess.Popen(dockerapi.docker_command() + ["start",
+                    name],
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True)
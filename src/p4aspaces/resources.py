@@ -0,0 +1,184 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import subprocess
+import time
+
+from . import ccache
+from . import dockerapi
+from .hosts import CONTAINER_PREFIX
+from .settings import settings
+
+# Resource limits of launched containers, and the build parallelism
+# which fits them. The profile comes from --resources or the
+# "resource_profile" setting:
+#
+#  - "auto" (the default): all cores and 3/4 of the memory of the
+#    docker host, divided among the launches running on it at once
+#  - "small": like auto, but at most 2 cores and 4G, which leaves a
+#    laptop usable
+#  - "<cores>:<memory>" like "16:32G": exactly that, per launch
+#  - "none": no limits, with gradle's old 2 workers and 1G heap
+#
+# Inside the container, the limits become MAKEFLAGS=-j<cores> and the
+# gradle worker count and JVM heap size, which /tmp/p4aspaces-env.sh
+# puts into GRADLE_OPTS and JAVA_OPTS.
+PROFILES = ["auto", "small", "none"]
+DEFAULT_PROFILE = "auto"
+SMALL_LIMITS = (2, 4 * 1024 ** 3)
+MEMORY_SHARE = 0.75
+MIN_MEMORY = 2 * 1024 ** 3
+MIN_HEAP = 512 * 1024 ** 2
+MAX_HEAP = 8 * 1024 ** 3
+GRADLE_WORKER_MEMORY = 1536 * 1024 ** 2
+HOST_INFO_MAX_AGE = 24 * 60 * 60
+
+def get_profile(profile=None):
+    if profile is None:
+        profile = settings.get("resource_profile",
+            default=DEFAULT_PROFILE)
+    profile = str(profile).strip().lower()
+    parse_profile(profile)
+    return profile
+
+def parse_profile(profile):
+    # Raises ValueError for profiles which are neither a known name nor
+    # "<cores>:<memory>". Returns (cores, memory) for the latter:
+    if profile in PROFILES:
+        return None
+    (cpus, _, memory) = profile.partition(":")
+    try:
+        cpus = float(cpus)
+        memory = ccache.parse_size(memory)
+    except ValueError:
+        raise ValueError("invalid resource profile: '" + profile +
+            "', use " + ", ".join(PROFILES) + " or <cores>:<memory> " +
+            "(like 16:32G)")
+    if cpus <= 0 or memory <= 0:
+        raise ValueError("invalid resource profile: '" + profile + "'")
+    return (cpus, memory)
+
+def host_resources():
+    # (cores, memory) of the current docker host, which for Docker
+    # Desktop is its VM rather than this machine. Remembered for a day:
+    key = dockerapi.get_current_host() or \
+        os.environ.get("DOCKER_HOST", "")
+    known = settings.get("host_resources", type=dict).get(key, None)
+    if isinstance(known, dict) and \
+            abs(time.time() - known.get("time", 0)) < HOST_INFO_MAX_AGE:
+        return (known["cpus"], known["memory"])
+    cpus = None
+    memory = None
+    client = dockerapi.get_client()
+    try:
+        if client is not None:
+            info = client.info()
+            (cpus, memory) = (int(info["NCPU"]), int(info["MemTotal"]))
+        else:
+            output = subprocess.check_output(dockerapi.docker_command() +
+                ["info", "--format", "{{.NCPU}} {{.MemTotal}}"],
+                stderr=subprocess.DEVNULL).decode("utf-8", "replace")
+            (cpus, memory) = [int(value) for value in output.split()]
+    except (OSError, ValueError, KeyError, subprocess.CalledProcessError,
+            dockerapi.DockerAPIError):
+        pass
+    if cpus is None or cpus <= 0 or memory is None or memory <= 0:
+        # (Not worth remembering, the local values are quick to get)
+        return local_resources()
+    with settings.transaction() as store:
+        store.setdefault("host_resources", dict())[key] = {
+            "cpus": cpus, "memory": memory, "time": time.time()}
+    return (cpus, memory)
+
+def local_resources():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        cpus = os.cpu_count() or 1
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        memory = 4 * 1024 ** 3
+    return (cpus, memory)
+
+def running_launches():
+    # Number of p4atestenv containers running on the current docker
+    # host (from any p4aspaces process):
+    client = dockerapi.get_client()
+    try:
+        if client is not None:
+            return len(client.list_containers(name=CONTAINER_PREFIX))
+        output = subprocess.check_output(dockerapi.docker_command() + [
+            "ps", "-q", "--filter", "name=" + CONTAINER_PREFIX],
+            stderr=subprocess.DEVNULL)
+        return len(output.split())
+    except (OSError, subprocess.CalledProcessError,
+            dockerapi.DockerAPIError):
+        return 0
+
+def get_limits(profile=None, concurrency=1):
+    # Returns (cores, memory) for a launch on the current docker host,
+    # or None for no limits. concurrency is how many launches the
+    # caller starts at once, launches running already count as well.
+    profile = get_profile(profile)
+    if profile == "none":
+        return None
+    explicit = parse_profile(profile)
+    if explicit is not None:
+        return explicit
+    (host_cpus, host_memory) = host_resources()
+    share = max(1, concurrency, running_launches() + 1)
+    cpus = max(1.0, float(host_cpus) / share)
+    memory = max(min(MIN_MEMORY, host_memory),
+        int(host_memory * MEMORY_SHARE / share))
+    if profile == "small":
+        cpus = min(cpus, SMALL_LIMITS[0])
+        memory = min(memory, SMALL_LIMITS[1])
+    return (cpus, memory)
+
+def run_args(limits):
+    if limits is None:
+        return []
+    (cpus, memory) = limits
+    return ["--cpus", ("%.2f" % cpus).rstrip("0").rstrip("."),
+        "--memory", str(int(memory))]
+
+def update_args(limits):
+    # "docker update" arguments applying the limits to a container which
+    # was started without them (like a pooled one). The swap limit is
+    # what "docker run" defaults to, twice the memory:
+    if limits is None:
+        return []
+    return run_args(limits) + ["--memory-swap", str(int(limits[1]) * 2)]
+
+def environment(limits):
+    # The variables telling make, gradle and the JVM what they may use:
+    if limits is None:
+        return []
+    (cpus, memory) = limits
+    heap = min(MAX_HEAP, max(MIN_HEAP, memory // 4))
+    workers = max(1, min(int(cpus), (memory - heap) //
+        GRADLE_WORKER_MEMORY))
+    return ["MAKEFLAGS=-j" + str(max(1, int(cpus))),
+        "P4AS_GRADLE_WORKERS=" + str(workers),
+        "P4AS_JVM_HEAP=" + str(heap // 1024 ** 2) + "m"]
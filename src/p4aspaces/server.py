@@ -0,0 +1,493 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import collections
+import hmac
+import http.server
+import json
+import os
+import secrets
+import socketserver
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+
+from . import artifacts
+from . import buildenv
+from . import cleanup
+from . import hosts
+from .settings import settings
+
+# The job queue of "p4aspaces serve", for driving builds from CI without
+# starting p4aspaces (and answering prompts) for every build. Jobs run
+# in worker threads of the one server process, without a TTY, and are
+# persisted in the settings folder as jobs/<id>/job.json along with
+# their log and artifacts, so they survive a restart of the server.
+#
+# HTTP API (JSON, on a unix socket or a localhost port):
+#
+#   POST /jobs                  submit {"env": ..., "command": ...,
+#                               "workspace", "p4a", "buildozer", "user",
+#                               "artifacts": [patterns], "docker_host"}
+#   GET  /jobs                  all jobs
+#   GET  /jobs/<id>             one job
+#   POST /jobs/<id>/cancel      cancel a queued job
+#   GET  /jobs/<id>/log         the output so far, ?follow=1 streams it
+#                               until the job finished
+#   GET  /jobs/<id>/artifacts   the artifact manifest
+#   GET  /jobs/<id>/artifacts/<path>   one artifact file
+#
+# Jobs run as the server's default user (or one of allowed_users), and
+# a workspace must be inside one of the workspace_roots. On a TCP port,
+# every request needs "Authorization: Bearer <token>", with the token
+# from serve.token in the settings folder.
+FINISHED_STATES = ["succeeded", "failed", "cancelled"]
+JOB_FIELDS = ["env", "command", "workspace", "buildozer_dir", "p4a",
+    "buildozer", "user", "artifacts", "docker_host"]
+
+def jobs_folder():
+    return os.path.join(settings.settings_folder(), "jobs")
+
+def default_socket_path():
+    return os.path.join(settings.settings_folder(), "serve.sock")
+
+def token_path():
+    return os.path.join(settings.settings_folder(), "serve.token")
+
+def get_token():
+    # The token for the TCP listener, created on first use and only
+    # readable by the user running the server:
+    path = token_path()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            token = f.read().strip()
+        if len(token) > 0:
+            return token
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    token = secrets.token_hex(32)
+    fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+        0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token + "\n")
+    os.replace(path + ".tmp", path)
+    return token
+
+class JobError(Exception):
+    pass
+
+class JobLog(object):
+    # Appends output text to a job's log file, and wakes up followers:
+    def __init__(self, path, changed):
+        self.path = path
+        self.changed = changed
+
+    def __call__(self, text):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(text)
+        with self.changed:
+            self.changed.notify_all()
+
+    def flush(self):
+        pass
+
+class JobQueue(object):
+    def __init__(self, folder=None, max_running=2, default_user=0,
+            allowed_users=None, workspace_roots=None):
+        self.folder = folder or jobs_folder()
+        self.max_running = max(1, max_running)
+        self.default_user = default_user
+        self.allowed_users = set([default_user] + list(allowed_users or []))
+        self.workspace_roots = [os.path.realpath(root)
+            for root in (workspace_roots or [])]
+        self.changed = threading.Condition()
+        self.jobs = collections.OrderedDict()
+        self.pending = collections.deque()
+        self.stopping = False
+        self.threads = []
+        os.makedirs(self.folder, exist_ok=True)
+        self.load()
+
+    def job_dir(self, job_id):
+        return os.path.join(self.folder, job_id)
+
+    def load(self):
+        # Pick up the jobs of an earlier server process. Queued ones are
+        # queued again, running ones got interrupted:
+        jobs = []
+        for job_id in os.listdir(self.folder):
+            try:
+                with open(os.path.join(self.job_dir(job_id), "job.json"),
+                        "r", encoding="utf-8") as f:
+                    jobs.append(json.loads(f.read()))
+            except (OSError, ValueError):
+                continue
+        for job in sorted(jobs, key=lambda job: job["created"]):
+            if job["state"] == "running":
+                job["state"] = "failed"
+                job["error"] = "interrupted by a restart of the server"
+                self.save(job)
+            self.jobs[job["id"]] = job
+            if job["state"] == "queued":
+                self.pending.append(job["id"])
+
+    def check_folder(self, key, path):
+        # Folders get mounted into the job's container, so only ones
+        # inside the configured roots are accepted:
+        if not isinstance(path, str) or not os.path.isdir(path):
+            raise JobError(key + " is not a folder: " + str(path))
+        path = os.path.realpath(path)
+        for root in self.workspace_roots:
+            if os.path.commonpath([root, path]) == root:
+                return path
+        raise JobError(key + " is not inside a workspace root: " + path)
+
+    def resolve_user(self, user):
+        if user is None:
+            return self.default_user
+        if isinstance(user, bool):
+            raise JobError("unknown user: " + str(user))
+        try:
+            user = int(user)
+        except (TypeError, ValueError):
+            try:
+                import pwd
+                user = pwd.getpwnam(str(user)).pw_uid
+            except (ImportError, KeyError):
+                raise JobError("unknown user: " + str(user))
+        if user not in self.allowed_users:
+            raise JobError("user not allowed: " + str(user))
+        return user
+
+    def save(self, job):
+        path = os.path.join(self.job_dir(job["id"]), "job.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps(job, indent=2, sort_keys=True))
+        os.replace(path + ".tmp", path)
+
+    def submit(self, spec):
+        if not isinstance(spec, dict):
+            raise JobError("expected a JSON object")
+        unknown = [key for key in spec.keys() if key not in JOB_FIELDS]
+        if len(unknown) > 0:
+            raise JobError("unknown fields: " + ", ".join(sorted(unknown)))
+        if not isinstance(spec.get("env", None), str) or \
+                not buildenv.is_environment(spec["env"]):
+            raise JobError("not a known environment: " +
+                str(spec.get("env", None)))
+        folders = dict()
+        for key in ["workspace", "buildozer_dir"]:
+            if spec.get(key, None) is not None:
+                folders[key] = self.check_folder(key, spec[key])
+        user = self.resolve_user(spec.get("user", None))
+        job_id = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        job = {
+            "id": job_id,
+            "env": spec["env"],
+            "command": str(spec.get("command", None) or "testbuild"),
+            "workspace": folders.get("workspace", None),
+            "buildozer_dir": folders.get("buildozer_dir", None),
+            "p4a": spec.get("p4a", None) or "master",
+            "buildozer": spec.get("buildozer", None) or "stable",
+            "user": user,
+            "artifacts": spec.get("artifacts", None),
+            "docker_host": spec.get("docker_host", None),
+            "state": "queued",
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "exit_code": None,
+            "error": None,
+        }
+        os.makedirs(self.job_dir(job_id))
+        with self.changed:
+            self.save(job)
+            self.jobs[job_id] = job
+            self.pending.append(job_id)
+            self.changed.notify_all()
+        return dict(job)
+
+    def get(self, job_id):
+        with self.changed:
+            if job_id not in self.jobs:
+                return None
+            return dict(self.jobs[job_id])
+
+    def list(self):
+        with self.changed:
+            return [dict(job) for job in self.jobs.values()]
+
+    def cancel(self, job_id):
+        # Only queued jobs can be cancelled. Returns the job:
+        with self.changed:
+            job = self.jobs.get(job_id, None)
+            if job is None:
+                return None
+            if job["state"] != "queued":
+                raise JobError("job is " + job["state"] +
+                    ", only queued jobs can be cancelled")
+            self.pending.remove(job_id)
+            job["state"] = "cancelled"
+            job["finished"] = time.time()
+            self.save(job)
+            self.changed.notify_all()
+            return dict(job)
+
+    def start(self):
+        for i in range(self.max_running):
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.changed:
+            self.stopping = True
+            self.changed.notify_all()
+
+    def worker(self):
+        while True:
+            with self.changed:
+                while len(self.pending) == 0 and not self.stopping:
+                    self.changed.wait()
+                if self.stopping:
+                    return
+                job = self.jobs[self.pending.popleft()]
+                job["state"] = "running"
+                job["started"] = time.time()
+                self.save(job)
+            (exit_code, error) = self.run(job)
+            with self.changed:
+                job["exit_code"] = exit_code
+                job["error"] = error
+                job["state"] = ("succeeded" if exit_code == 0 and
+                    error is None else "failed")
+                job["finished"] = time.time()
+                self.save(job)
+                self.changed.notify_all()
+            cleanup.auto_collect()
+
+    def run(self, job):
+        # Returns (exit code, error message):
+        log = JobLog(os.path.join(self.job_dir(job["id"]), "log.txt"),
+            self.changed)
+        env = buildenv.get_environment(job["env"],
+            p4a_target=job["p4a"], buildozer_target=job["buildozer"])
+        try:
+            exit_code = env.launch_shell(
+                output_file=os.path.join(self.job_dir(job["id"]),
+                    "artifacts") + os.path.sep,
+                launch_cmd=job["command"],
+                workspace=job["workspace"],
+                buildozer_dir=job["buildozer_dir"],
+                user_id_or_name=job["user"],
+                interactive=False,
+                log_prefix="[" + job["id"] + "] ",
+                artifact_patterns=job["artifacts"],
+                docker_host=job["docker_host"],
+                concurrency=-(-self.max_running //
+                    hosts.host_count(job["docker_host"])),
+                on_output=log)
+        except SystemExit as e:
+            return (e.code if isinstance(e.code, int) else 1,
+                "launch failed, see the log")
+        except Exception as e:
+            log("".join(traceback.format_exception(type(e), e,
+                e.__traceback__)))
+            return (None, str(e))
+        return (exit_code, None)
+
+    def manifest(self, job_id):
+        path = os.path.join(self.job_dir(job_id), "artifacts",
+            artifacts.MANIFEST_NAME)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {"artifacts": []}
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return str(self.client_address or "local")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, status, body, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, indent=2, sort_keys=True) + "\n"
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_message(self, status, message):
+        self.send_body(status, {"message": message})
+
+    def send_file(self, path, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+    def write_chunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode("ascii") +
+            data + b"\r\n")
+        self.wfile.flush()
+
+    def follow_log(self, job_id):
+        # Streams the log (chunked) until the job has finished:
+        jobs = self.server.jobs
+        path = os.path.join(jobs.job_dir(job_id), "log.txt")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        offset = 0
+        while True:
+            finished = jobs.get(job_id)["state"] in FINISHED_STATES
+            try:
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                data = b""
+            if len(data) > 0:
+                offset += len(data)
+                self.write_chunk(data)
+            elif finished:
+                break
+            else:
+                with jobs.changed:
+                    jobs.changed.wait(1.0)
+        self.write_chunk(b"")
+
+    def authorized(self):
+        token = self.server.token
+        if token is None:
+            return True
+        given = self.headers.get("Authorization", "")
+        if hmac.compare_digest(given.encode("utf-8"),
+                ("Bearer " + token).encode("utf-8")):
+            return True
+        # (the request body is left unread, so don't keep the
+        # connection:)
+        self.close_connection = True
+        self.send_error_message(401, "missing or wrong token")
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        parsed = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(parsed.query))
+        parts = [urllib.parse.unquote(part)
+                 for part in parsed.path.strip("/").split("/")]
+        jobs = self.server.jobs
+        if parts == ["jobs"]:
+            return self.send_body(200, jobs.list())
+        if len(parts) < 2 or parts[0] != "jobs":
+            return self.send_error_message(404, "not found")
+        job = jobs.get(parts[1])
+        if job is None:
+            return self.send_error_message(404, "no such job")
+        if len(parts) == 2:
+            return self.send_body(200, job)
+        if parts[2:] == ["log"]:
+            if params.get("follow", "0") == "1":
+                return self.follow_log(job["id"])
+            path = os.path.join(jobs.job_dir(job["id"]), "log.txt")
+            if not os.path.exists(path):
+                return self.send_body(200, "", "text/plain; charset=utf-8")
+            return self.send_file(path, "text/plain; charset=utf-8")
+        if parts[2:] == ["artifacts"]:
+            return self.send_body(200, jobs.manifest(job["id"]))
+        if len(parts) > 3 and parts[2] == "artifacts":
+            # Only files listed in the manifest can be fetched:
+            rel_path = "/".join(parts[3:])
+            if rel_path not in [entry["path"] for entry in
+                    jobs.manifest(job["id"])["artifacts"]]:
+                return self.send_error_message(404, "no such artifact")
+            return self.send_file(os.path.join(jobs.job_dir(job["id"]),
+                "artifacts", *rel_path.split("/")),
+                "application/octet-stream")
+        return self.send_error_message(404, "not found")
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        parts = urllib.parse.urlparse(self.path).path.strip("/").split("/")
+        length = int(self.headers.get("Content-Length", "0"))
+        body = self.rfile.read(length) if length > 0 else b""
+        jobs = self.server.jobs
+        try:
+            if parts == ["jobs"]:
+                try:
+                    spec = json.loads(body.decode("utf-8"))
+                except ValueError:
+                    raise JobError("invalid JSON")
+                return self.send_body(201, jobs.submit(spec))
+            if len(parts) == 3 and parts[0] == "jobs" and \
+                    parts[2] == "cancel":
+                job = jobs.cancel(parts[1])
+                if job is None:
+                    return self.send_error_message(404, "no such job")
+                return self.send_body(200, job)
+        except JobError as e:
+            return self.send_error_message(400, str(e))
+        return self.send_error_message(404, "not found")
+
+class JobServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs, token, verbose=False):
+        self.jobs = jobs
+        self.token = token
+        self.verbose = verbose
+        super().__init__(address, JobRequestHandler)
+
+class UnixJobServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, jobs, verbose=False):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.jobs = jobs
+        self.token = None
+        self.verbose = verbose
+        super().__init__(socket_path, JobRequestHandler)
+        os.chmod(socket_path, 0o600)
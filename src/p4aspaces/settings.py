@@ -20,37 +20,120 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 '''
 
+import contextlib
+import copy
 import json
 import os
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 class SettingsStore(object):
     UNSPECIFIED_DEFAULT = object()
 
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._transaction_depth = 0
+        self._transaction_store = None
+        self._cached_store = None
+        self._cached_stat = None
+
     @staticmethod
     def settings_folder():
         folder_path = os.path.join(
             os.path.expanduser("~"),
             ".local", "share", "p4a-build-spaces")
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
+        # (Other processes may create it at the same time)
+        os.makedirs(folder_path, exist_ok=True)
         return folder_path
 
+    @classmethod
+    def settings_file(cls):
+        return os.path.join(cls.settings_folder(), "settings.json")
+
     def get_store(self):
-        settings_file = os.path.join(
-            self.__class__.settings_folder(),
-            "settings.json")
-        if not os.path.exists(settings_file):
-            return dict()
-        with open(settings_file, "r", encoding="utf-8") as f:
-            return json.loads(f.read().strip())
+        # The file is only ever replaced atomically (see set_store()),
+        # so a changed inode/mtime/size tells us reliably whether our
+        # cached copy is still current:
+        settings_file = self.__class__.settings_file()
+        with self.lock:
+            if self._transaction_store is not None:
+                # (Nested in a transaction, which hasn't written yet)
+                return copy.deepcopy(self._transaction_store)
+            try:
+                f = open(settings_file, "r", encoding="utf-8")
+            except FileNotFoundError:
+                self._cached_store = None
+                self._cached_stat = None
+                return dict()
+            with f:
+                st = os.fstat(f.fileno())
+                stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+                if self._cached_stat != stat_key:
+                    contents = f.read().strip()
+                    self._cached_store = (json.loads(contents)
+                        if len(contents) > 0 else dict())
+                    self._cached_stat = stat_key
+            return copy.deepcopy(self._cached_store)
 
     def set_store(self, dictionary):
-        settings_file = os.path.join(
-            self.__class__.settings_folder(),
-            "settings.json")
+        settings_file = self.__class__.settings_file()
         serialized = json.dumps(dictionary)
-        with open(settings_file, "w", encoding="utf-8") as f:
-            f.write(serialized)
+        (fd, temp_path) = tempfile.mkstemp(
+            dir=os.path.dirname(settings_file),
+            prefix=".settings.json-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(serialized)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, settings_file)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Read-modify-write of the whole store, serialized against other
+        # threads and (through an advisory lock file) other processes.
+        # The yielded dict is written back if it was changed. Nested
+        # transactions share the store of the outermost one:
+        with self.lock:
+            if self._transaction_depth > 0:
+                self._transaction_depth += 1
+                try:
+                    yield self._transaction_store
+                finally:
+                    self._transaction_depth -= 1
+                return
+            lock_file = None
+            if fcntl is not None:
+                lock_file = open(self.__class__.settings_file() + ".lock",
+                    "a")
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self._transaction_depth += 1
+            try:
+                # (Read again, a file replaced within the same timestamp
+                # tick may reuse the inode and size of the cached one)
+                self._cached_stat = None
+                store = self.get_store()
+                original = copy.deepcopy(store)
+                self._transaction_store = store
+                yield store
+                if store != original:
+                    self.set_store(store)
+            finally:
+                self._transaction_store = None
+                self._transaction_depth -= 1
+                if lock_file is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                    lock_file.close()
 
     def get(self, value, default=UNSPECIFIED_DEFAULT,
             type=object):
@@ -68,10 +151,7 @@ class SettingsStore(object):
         return default
 
     def set(self, value_name, value):
-        store = self.get_store()
-        store[value_name] = value
-        self.set_store(store)
+        with self.transaction() as store:
+            store[value_name] = value
 
 settings = SettingsStore()
-
-
@@ -0,0 +1,106 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import re
+import shlex
+
+# Build targets for running several test app builds of one environment
+# side by side ("p4aspaces cmd <env> --target ..."). Each target is a
+# (bootstrap, arch, requirements) triple, given as
+# "bootstrap[,bootstrap...]:arch[,arch...][:requirements]", and builds
+# the test app of its bootstrap in a container of its own.
+TEST_APPS = {
+    "sdl2": ("testapp-sdl2-keyboard", "kivy"),
+    "webview": ("testapp-webview-flask", "flask"),
+    "service_only": ("testapp-service_only-nogui", "pyjnius"),
+}
+DEFAULT_ARCH = "armeabi-v7a"
+# (Both end up in the output folder names, "<bootstrap>-<arch>/")
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$")
+
+def parse_targets(specs):
+    # Returns the list of (bootstrap, arch, requirements) of the given
+    # --target values, or raises ValueError. requirements is None for
+    # the test app's default ones:
+    result = []
+    for spec in specs:
+        parts = spec.split(":", 2)
+        bootstraps = [b.strip() for b in parts[0].split(",") if b.strip()]
+        archs = [DEFAULT_ARCH]
+        if len(parts) > 1 and parts[1].strip():
+            archs = [a.strip() for a in parts[1].split(",") if a.strip()]
+        requirements = None
+        if len(parts) > 2 and parts[2].strip():
+            requirements = parts[2].strip()
+        if len(bootstraps) == 0:
+            raise ValueError("no bootstrap in target: '" + spec + "'")
+        for name in bootstraps + archs:
+            if NAME_PATTERN.match(name) is None:
+                raise ValueError("invalid bootstrap or arch name '" +
+                    name + "' in target: '" + spec + "'")
+        for bootstrap in bootstraps:
+            if bootstrap not in TEST_APPS:
+                raise ValueError("unknown bootstrap '" + bootstrap +
+                    "', choose from: " + ", ".join(sorted(TEST_APPS)))
+            for arch in archs:
+                target = (bootstrap, arch, requirements)
+                if target not in result:
+                    result.append(target)
+    return result
+
+def target_name(target):
+    (bootstrap, arch, requirements) = target
+    return bootstrap + "-" + arch
+
+def target_command(target):
+    # The command building the target's test app into ~/output, like
+    # the testbuild aliases do. (The default requirements pick the
+    # python of the environment through its $PIP.)
+    (bootstrap, arch, requirements) = target
+    (app_dir, app_requirements) = TEST_APPS[bootstrap]
+    if requirements is None:
+        requirements = app_requirements + ",python${PIP#pip}"
+    else:
+        requirements = shlex.quote(requirements.replace(" ", ""))
+    script = "cd ~/" + app_dir + " && p4a apk --arch=" + \
+        shlex.quote(arch) + " --name test --package com.example.test " + \
+        "--version 1 --bootstrap " + bootstrap + " --requirements=" + \
+        requirements + " --private . && " + \
+        "cp *.apk ~/output/"
+    return "bash -c " + shlex.quote(script)
+
+def split_cpus(count):
+    # Splits the CPUs we may use into count --cpuset-cpus values, so
+    # the parallel builds don't fight over the same cores. With more
+    # builds than CPUs, several builds share one.
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        cpus = list(range(os.cpu_count() or 1))
+    result = []
+    for i in range(count):
+        chunk = cpus[i * len(cpus) // count:(i + 1) * len(cpus) // count]
+        if len(chunk) == 0:
+            chunk = [cpus[i % len(cpus)]]
+        result.append(",".join([str(cpu) for cpu in chunk]))
+    return result
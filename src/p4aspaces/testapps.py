@@ -0,0 +1,270 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import contextlib
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+import zipfile
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from . import gitrefs
+from .settings import settings
+
+# The test apps (~/testapp-*) of the environments come from the same p4a
+# source which gets installed. They are taken from a shallow bare mirror
+# on the host (p4a-testapps in the temp dir, like the other caches),
+# which fetches only the commits needed, from the repository or its
+# "git_mirrors" entry. Archive urls which aren't github archives get
+# downloaded on the host once instead.
+#
+# The apps are put into the build context, and a stage of their own
+# (see shared_base.txt) adds them, so the layer is the same for all
+# environments with the same p4a source, and rebuilt only when it moved.
+P4A_REPO = "https://github.com/kivy/python-for-android"
+TESTAPPS = [
+    ("testapp_keyboard", "testapp-sdl2-keyboard"),
+    ("testapp_flask", "testapp-webview-flask"),
+    ("testapp_nogui", "testapp-service_only-nogui"),
+]
+CONTEXT_FOLDER = "testapps"
+GITHUB_ARCHIVE = re.compile(r"^(https://github\.com/[^/]+/[^/]+)/archive/" +
+    r"(?:refs/(?:heads|tags)/)?(.+?)(\.zip|\.tar\.gz|\.tgz)$")
+
+mirror_lock = threading.Lock()
+
+class TestAppsError(Exception):
+    pass
+
+class TestAppSource(object):
+    # Either a ref (commit, branch or tag) of a git repository, or an
+    # archive url, where key changes whenever the archive should be
+    # downloaded again:
+    def __init__(self, repo=None, ref=None, url=None, key=None):
+        self.repo = repo
+        self.ref = ref
+        self.url = url
+        self.key = key
+
+    def describe(self):
+        if self.url is not None:
+            return self.url + " (" + str(self.key) + ")"
+        return self.repo + " at " + self.ref
+
+def get_source(dl_target_p4a, commit=None, key=None, refresh=False,
+        cached_only=False):
+    # The TestAppSource for the p4a pip install target, which is pinned
+    # to the given commit if known. key is what identifies the download
+    # of targets which aren't (the p4a build uuid):
+    if commit is not None:
+        match = GITHUB_ARCHIVE.match(dl_target_p4a)
+        return TestAppSource(match.group(1) if match else P4A_REPO,
+            commit)
+    match = GITHUB_ARCHIVE.match(dl_target_p4a)
+    if match is not None:
+        (repo, ref) = (match.group(1), urllib.parse.unquote(
+            match.group(2)))
+        return TestAppSource(repo, gitrefs.resolve(repo, ref,
+            refresh=refresh, cached_only=cached_only) or ref)
+    if dl_target_p4a.startswith("git+"):
+        url = urllib.parse.urlparse(dl_target_p4a[len("git+"):])
+        (path, _, ref) = url.path.rpartition("@")
+        if len(path) == 0:
+            (path, ref) = (url.path, "HEAD")
+        repo = urllib.parse.urlunparse((url.scheme, url.netloc, path,
+            "", "", ""))
+        return TestAppSource(repo, gitrefs.resolve(repo, ref,
+            refresh=refresh, cached_only=cached_only) or ref)
+    if urllib.parse.urlparse(dl_target_p4a).scheme in ["http", "https"]:
+        return TestAppSource(url=dl_target_p4a, key=key)
+    match = re.match(r"^python-for-android *== *([^ ,;]+)$",
+        dl_target_p4a.strip())
+    if match is not None:
+        commit = gitrefs.resolve_version(P4A_REPO, match.group(1),
+            refresh=refresh, cached_only=cached_only)
+        if commit is not None:
+            return TestAppSource(P4A_REPO, commit)
+    # (Can't tell which source this is, e.g. a local folder)
+    return TestAppSource(P4A_REPO, gitrefs.resolve(P4A_REPO, "master",
+        refresh=refresh, cached_only=cached_only) or "master")
+
+def cache_dir():
+    return settings.get("testapps_dir",
+        default=os.path.join(tempfile.gettempdir(), "p4a-testapps"))
+
+@contextlib.contextmanager
+def locked_cache():
+    # Serializes access to the cache folder across threads and (through
+    # an advisory lock file) processes:
+    with mirror_lock:
+        os.makedirs(cache_dir(), exist_ok=True)
+        with open(os.path.join(cache_dir(), "lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def git(*args):
+    return subprocess.check_output(["git", "--git-dir",
+        os.path.join(cache_dir(), "mirror.git")] + list(args),
+        stdin=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        timeout=600).decode("utf-8", "replace").strip()
+
+def fetch_commit(repo, ref):
+    # Returns the commit of ref, fetched into the mirror unless it has
+    # it already. (Fetched commits get a ref, so they aren't pruned.)
+    mirror = os.path.join(cache_dir(), "mirror.git")
+    if not os.path.exists(os.path.join(mirror, "HEAD")):
+        subprocess.check_output(["git", "init", "-q", "--bare", mirror],
+            stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if gitrefs.is_commit(ref):
+        try:
+            git("cat-file", "-e", ref + "^{commit}")
+            return ref
+        except subprocess.CalledProcessError:
+            pass
+    git("fetch", "-q", "--depth", "1", "--no-tags",
+        gitrefs.get_mirror(repo), ref)
+    commit = git("rev-parse", "FETCH_HEAD")
+    git("update-ref", "refs/p4aspaces/" + commit, commit)
+    return commit
+
+def extract_git(source, folder):
+    commit = fetch_commit(source.repo, source.ref)
+    with tempfile.TemporaryFile() as f:
+        subprocess.check_call(["git", "--git-dir",
+            os.path.join(cache_dir(), "mirror.git"), "archive",
+            "--format=tar", commit, "testapps"], stdout=f,
+            stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        f.seek(0)
+        with tarfile.open(fileobj=f, mode="r") as tar:
+            extract_members(tar.getmembers(), lambda member: member.name,
+                lambda member: tar.extractfile(member), folder,
+                lambda member: member.isdir(),
+                lambda member: member.mode)
+
+def download_archive(source):
+    # The archive url downloaded into the cache, once per key:
+    digest = hashlib.sha256((source.url + "\n" +
+        str(source.key)).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(cache_dir(), "archives", digest + (".zip"
+        if urllib.parse.urlparse(source.url).path.endswith(".zip")
+        else ".tar.gz"))
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(source.url, timeout=60) as response:
+            with open(path + ".tmp", "wb") as f:
+                shutil.copyfileobj(response, f)
+        os.replace(path + ".tmp", path)
+    return path
+
+def extract_archive(source, folder):
+    # (The archive has one top folder, with testapps/ inside)
+    path = download_archive(source)
+    strip = lambda name: "/".join(name.split("/")[1:])
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            extract_members(archive.infolist(),
+                lambda info: strip(info.filename),
+                lambda info: archive.open(info), folder,
+                lambda info: info.filename.endswith("/"),
+                lambda info: (info.external_attr >> 16) & 0o777)
+    else:
+        with tarfile.open(path, mode="r") as tar:
+            extract_members(tar.getmembers(),
+                lambda member: strip(member.name),
+                lambda member: tar.extractfile(member), folder,
+                lambda member: member.isdir(),
+                lambda member: member.mode)
+
+def extract_members(members, name_of, open_member, folder, is_dir,
+        mode_of):
+    # Writes the files of the test apps from an archive to
+    # folder/<target name>/, writable for every user (the container runs
+    # as whoever launches it):
+    names = dict(TESTAPPS)
+    found = set()
+    for member in members:
+        parts = name_of(member).strip("/").split("/")
+        if len(parts) < 2 or parts[0] != "testapps" or \
+                parts[1] not in names or ".." in parts:
+            continue
+        found.add(parts[1])
+        path = os.path.join(folder, names[parts[1]], *parts[2:])
+        if is_dir(member):
+            os.makedirs(path, exist_ok=True)
+            continue
+        stream = open_member(member)
+        if stream is None:  # (links & other special files)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with stream, open(path, "wb") as f:
+            shutil.copyfileobj(stream, f)
+        os.chmod(path, 0o777 if mode_of(member) & 0o111 else 0o666)
+    missing = [name for name in names if name not in found]
+    if len(missing) > 0:
+        raise TestAppsError("no " + ", ".join(missing) + " in the " +
+            "p4a source")
+    for (dirpath, dirnames, filenames) in os.walk(folder):
+        os.chmod(dirpath, 0o777)
+
+def default_provider(source, folder):
+    with locked_cache():
+        if source.url is not None:
+            extract_archive(source, folder)
+        else:
+            extract_git(source, folder)
+
+_provider = default_provider
+
+def set_provider(provider):
+    # provider(source, folder) writes the test apps of the TestAppSource
+    # into folder (e.g. to not need the network in tests):
+    global _provider
+    _provider = provider
+
+def prepare(source, context_dir):
+    # Puts the test apps into the build context folder:
+    folder = os.path.join(context_dir, CONTEXT_FOLDER)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    try:
+        _provider(source, folder)
+    except subprocess.CalledProcessError as e:
+        raise TestAppsError((e.stderr or b"").decode("utf-8",
+            "replace").strip() or str(e))
+    except (OSError, tarfile.TarError, zipfile.BadZipFile,
+            subprocess.SubprocessError) as e:
+        raise TestAppsError(str(e))
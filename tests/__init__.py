@@ -0,0 +1,66 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+
+# Tests of the modules which can be driven without a docker daemon,
+# using p4aspaces.dockerapi_fake where they talk to docker. Settings go
+# to a throwaway HOME. Run from the repository root with:
+#
+#     python -m unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+class TempHome(object):
+    # Points HOME (and with it the settings folder) at a fresh folder:
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="p4aspaces-test-")
+        self.old_home = os.environ.get("HOME")
+        os.environ["HOME"] = self.path
+
+    def close(self):
+        if self.old_home is None:
+            del os.environ["HOME"]
+        else:
+            os.environ["HOME"] = self.old_home
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class FakeDocker(object):
+    # A fake docker daemon in folder, which DOCKER_HOST points to:
+    def __init__(self, folder):
+        from p4aspaces.dockerapi_fake import FakeDockerServer
+        self.server = FakeDockerServer(os.path.join(folder, "docker.sock"))
+        self.server.start()
+        self.state = self.server.state
+        self.old_host = os.environ.get("DOCKER_HOST")
+        os.environ["DOCKER_HOST"] = self.server.url
+
+    def close(self):
+        if self.old_host is None:
+            del os.environ["DOCKER_HOST"]
+        else:
+            os.environ["DOCKER_HOST"] = self.old_host
+        self.server.stop()
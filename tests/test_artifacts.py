@@ -0,0 +1,96 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import hashlib
+import json
+import os
+import unittest
+
+from tests import TempHome
+from p4aspaces import artifacts
+from p4aspaces.settings import settings
+
+class CollectTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.output_dir = os.path.join(self.home.path, "output")
+        for (path, data) in [("app-debug.apk", b"apk"),
+                ("bin/app-release.aab", b"aab"),
+                ("build.log", b"log"), ("notes.txt", b"txt")]:
+            full_path = os.path.join(self.output_dir, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        self.home.close()
+
+    def test_patterns(self):
+        self.assertEqual(artifacts.get_patterns(),
+            artifacts.DEFAULT_PATTERNS)
+        self.assertEqual(artifacts.find_artifacts(self.output_dir),
+            ["app-debug.apk", "build.log", "bin/app-release.aab"])
+        settings.set("artifact_patterns", ["bin/*", "*.txt"])
+        self.assertEqual(artifacts.find_artifacts(self.output_dir),
+            ["notes.txt", "bin/app-release.aab"])
+
+    def test_collect_into_directory(self):
+        target = os.path.join(self.home.path, "results") + os.path.sep
+        entries = artifacts.collect(self.output_dir, target,
+            info={"environment": "test"})
+        self.assertEqual([entry["path"] for entry in entries],
+            ["app-debug.apk", "build.log", "bin/app-release.aab"])
+        self.assertTrue(os.path.exists(os.path.join(target, "bin",
+            "app-release.aab")))
+        self.assertFalse(os.path.exists(os.path.join(target,
+            "notes.txt")))
+        # (Moved, not copied)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir,
+            "app-debug.apk")))
+        with open(os.path.join(target, artifacts.MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["environment"], "test")
+        self.assertEqual(manifest["artifacts"], entries)
+        self.assertEqual(entries[0]["size"], 3)
+        self.assertEqual(entries[0]["sha256"],
+            hashlib.sha256(b"apk").hexdigest())
+
+    def test_collect_into_file(self):
+        target = os.path.join(self.home.path, "app.apk")
+        entries = artifacts.collect(self.output_dir, target)
+        self.assertEqual([entry["path"] for entry in entries], ["app.apk"])
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), b"apk")
+
+    def test_move_file_fallbacks(self):
+        source = os.path.join(self.output_dir, "build.log")
+        target = os.path.join(self.home.path, "copy.log")
+        self.assertIn(artifacts.copy_file_range(source, target),
+            ["reflink", "copy_file_range"])
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), b"log")
+        # (An existing target is replaced)
+        self.assertEqual(artifacts.move_file(source, target), "rename")
+        self.assertFalse(os.path.exists(source))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import unittest
+
+from tests import FakeDocker, TempHome
+from p4aspaces import bundle, dockerapi
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.docker = FakeDocker(self.home.path)
+        context_dir = os.path.join(self.home.path, "context")
+        os.mkdir(context_dir)
+        with open(os.path.join(context_dir, "Dockerfile"), "w") as f:
+            f.write("FROM scratch\n")
+        client = dockerapi.get_client()
+        for tag in ["p4atestenv-a:1", "p4atestenv-a:2", "p4atestenv-b:1"]:
+            client.build(context_dir, tag)
+        self.path = os.path.join(self.home.path, "envs.p4abundle")
+        self.metadata = bundle.export_bundle(["a", "b"], self.path,
+            compression="gzip")
+
+    def tearDown(self):
+        dockerapi.get_client().close()
+        self.docker.close()
+        self.home.close()
+
+    def keep_only(self, tag):
+        # Like another machine, which has only this image:
+        state = self.docker.state
+        image = state.images[tag]
+        state.images = {tag: image}
+        state.layers = dict([(diff_id, data) for (diff_id, data)
+            in state.layers.items() if diff_id in image["RootFS"]["Layers"]])
+        state.loaded_layers = []
+
+    def test_export_lists_layers(self):
+        self.assertEqual(sorted(self.metadata["images"]), ["p4atestenv-a:1",
+            "p4atestenv-a:2", "p4atestenv-b:1"])
+        self.assertEqual(self.metadata["environments"], ["a", "b"])
+        for layers in self.metadata["images"].values():
+            self.assertEqual(len(layers), 2)
+
+    def test_import_skips_present_layers(self):
+        self.keep_only("p4atestenv-a:1")
+        self.assertFalse(bundle.containerd_image_store())
+        stats = bundle.import_bundle(self.path)
+        self.assertEqual(stats["images"], 3)
+        self.assertEqual(stats["already_present"], 1)
+        # Neither the base layer shared by all images nor the own one of
+        # a:1 is sent again:
+        self.assertEqual(stats["skipped_layers"], 2)
+        self.assertEqual(len(self.docker.state.loaded_layers), 2)
+        self.assertEqual(sorted(self.docker.state.images), ["p4atestenv-a:1",
+            "p4atestenv-a:2", "p4atestenv-b:1"])
+
+    def test_import_loads_all_layers_with_containerd(self):
+        self.keep_only("p4atestenv-a:1")
+        self.docker.state.containerd_store = True
+        self.assertTrue(bundle.containerd_image_store())
+        stats = bundle.import_bundle(self.path)
+        self.assertEqual(stats["skipped_layers"], 0)
+        self.assertEqual(len(self.docker.state.loaded_layers), 2)
+        self.assertEqual(sorted(self.docker.state.images), ["p4atestenv-a:1",
+            "p4atestenv-a:2", "p4atestenv-b:1"])
+
+    def test_import_of_present_images_loads_nothing(self):
+        stats = bundle.import_bundle(self.path)
+        self.assertEqual(stats["already_present"], 3)
+        self.assertEqual(self.docker.state.loaded_layers, [])
+
+if __name__ == "__main__":
+    unittest.main()
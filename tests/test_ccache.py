@@ -0,0 +1,89 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import unittest
+
+from tests import TempHome
+from p4aspaces import ccache
+from p4aspaces.settings import settings
+
+class CcacheTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.root = os.path.join(self.home.path, "ccache")
+        settings.set("ccache_dir", self.root)
+        self.write("contents/a/1.o", 100, 10)
+        self.write("contents/b/2.o", 100, 20)
+        self.write("contents/cache.debug.txt", 1000, 5)
+        self.write("contents/ccache.conf", 10, 5)
+        self.write("pip-build-dir/pkg/setup.py", 1000, 1)
+        self.write("ns/ndk-r17c/contents/c/3.o", 100, 30)
+        self.write("ns/ndk-r17c/pip-build-dir/x", 1000, 1)
+
+    def tearDown(self):
+        self.home.close()
+
+    def write(self, path, size, last_use):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(path, (last_use, last_use))
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.root, path))
+
+    def test_stats_count_only_cached_objects(self):
+        self.assertEqual(ccache.stats(), {"shared": (2, 200),
+            "ndk-r17c": (1, 100)})
+
+    def test_prune_evicts_least_recently_used_objects(self):
+        self.assertEqual(ccache.prune(max_size="150"), (2, 200))
+        self.assertFalse(self.exists("contents/a/1.o"))
+        self.assertFalse(self.exists("contents/b/2.o"))
+        self.assertTrue(self.exists("ns/ndk-r17c/contents/c/3.o"))
+        self.assertTrue(self.exists("pip-build-dir/pkg/setup.py"))
+        self.assertTrue(self.exists("contents/cache.debug.txt"))
+
+    def test_clear_namespace(self):
+        ccache.clear("ndk-r17c")
+        self.assertFalse(self.exists("ns/ndk-r17c/contents/c"))
+        self.assertTrue(self.exists("ns/ndk-r17c/pip-build-dir/x"))
+        self.assertTrue(self.exists("contents/a/1.o"))
+
+    def test_clear_all(self):
+        ccache.clear()
+        self.assertEqual(ccache.stats(), dict())
+        self.assertTrue(self.exists("pip-build-dir/pkg/setup.py"))
+        self.assertTrue(self.exists("ns/ndk-r17c/pip-build-dir/x"))
+        self.assertTrue(self.exists("contents/ccache.conf"))
+        self.assertTrue(self.exists("contents/cache.debug.txt"))
+
+    def test_clear_unknown_namespace(self):
+        for name in ["../..", "nope"]:
+            with self.assertRaises(ValueError):
+                ccache.clear(name)
+        self.assertTrue(self.exists("contents/a/1.o"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import tempfile
+import time
+import unittest
+
+from tests import FakeDocker, TempHome
+from p4aspaces import cleanup, dockerapi
+from p4aspaces.settings import settings
+
+class CollectTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.docker = FakeDocker(self.home.path)
+        # (So the temp folders of real launches are left alone)
+        self.old_tempdir = tempfile.tempdir
+        tempfile.tempdir = os.path.join(self.home.path, "tmp")
+        os.mkdir(tempfile.tempdir)
+        now = time.time()
+        self.add_image("p4atestenv-a:1", 100, now - 40 * 86400, now - 10)
+        self.add_image("p4atestenv-a:2", 100, now - 30 * 86400,
+            now - 3 * 86400)
+        self.add_image("p4atestenv-b:1", 100, now - 20 * 86400,
+            now - 2 * 86400)
+        self.add_image("p4atestenv-c:1", 100, now - 10 * 86400, None)
+        self.add_image("other:1", 1000, now - 50 * 86400, None)
+        settings.set("image_usage", dict(settings.get("image_usage",
+            type=dict), **{"p4atestenv-gone:1": now - 86400}))
+
+    def tearDown(self):
+        dockerapi.get_client().close()
+        tempfile.tempdir = self.old_tempdir
+        self.docker.close()
+        self.home.close()
+
+    def add_image(self, tag, size, created, last_used):
+        self.docker.state.images[tag] = {"Id": "sha256:" + tag,
+            "RepoTags": [tag], "Size": size, "Created": int(created),
+            "RootFS": {"Layers": []}}
+        if last_used is not None:
+            usage = settings.get("image_usage", type=dict)
+            usage[tag] = last_used
+            settings.set("image_usage", usage)
+
+    def add_container(self, name, image):
+        self.docker.state.containers[name] = {"Id": name, "Name": name,
+            "Image": image, "Labels": dict(), "State": "running"}
+
+    def test_least_recently_used_first(self):
+        # a:2 was launched before b:1, and c:1 (never launched) counts
+        # by its creation time:
+        result = cleanup.collect(budget=150)
+        self.assertEqual(result["images"], ["sha256:p4atestenv-c:1",
+            "sha256:p4atestenv-a:2", "sha256:p4atestenv-b:1"])
+        self.assertEqual(result["freed"], 300)
+        self.assertEqual(sorted(self.docker.state.images),
+            ["other:1", "p4atestenv-a:1"])
+
+    def test_images_in_use_are_kept(self):
+        self.add_container("user", "p4atestenv-c:1")
+        result = cleanup.collect(budget=250)
+        self.assertEqual(result["images"], ["sha256:p4atestenv-a:2",
+            "sha256:p4atestenv-b:1"])
+        self.assertIn("p4atestenv-c:1", self.docker.state.images)
+
+    def test_dry_run(self):
+        result = cleanup.collect(budget=0, dry_run=True)
+        self.assertEqual(len(result["images"]), 4)
+        self.assertEqual(len(self.docker.state.images), 5)
+        self.assertIn("p4atestenv-gone:1",
+            settings.get("image_usage", type=dict))
+
+    def test_usage_of_removed_images_is_dropped(self):
+        # (Evicts c:1 and a:2, and p4atestenv-gone:1 doesn't exist)
+        cleanup.collect(budget=250)
+        self.assertEqual(sorted(settings.get("image_usage", type=dict)),
+            ["p4atestenv-a:1", "p4atestenv-b:1"])
+        del self.docker.state.images["p4atestenv-b:1"]
+        cleanup.collect()
+        self.assertEqual(sorted(settings.get("image_usage", type=dict)),
+            ["p4atestenv-a:1"])
+
+if __name__ == "__main__":
+    unittest.main()
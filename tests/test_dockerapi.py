@@ -0,0 +1,141 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import unittest
+
+from tests import TempHome
+from p4aspaces import dockerapi
+from p4aspaces.dockerapi_fake import FakeDockerServer
+
+class DockerClientTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.server = FakeDockerServer(os.path.join(self.home.path,
+            "docker.sock"))
+        self.server.start()
+        self.client = dockerapi.DockerClient(self.server.url)
+        self.context_dir = os.path.join(self.home.path, "context")
+        os.mkdir(self.context_dir)
+        with open(os.path.join(self.context_dir, "Dockerfile"), "w") as f:
+            f.write("FROM scratch\n")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.home.close()
+
+    def create(self, name, logs=None):
+        self.client.build(self.context_dir, "p4atestenv-test:1")
+        cid = self.client.create_container("p4atestenv-test:1",
+            name=name, cmd=["echo", "hello"])
+        if logs is not None:
+            self.server.state.containers[cid]["Logs"] = logs
+        return cid
+
+    def test_follow_logs_joins_frames(self):
+        self.create("logs")
+        output = []
+        self.client.follow_logs("logs", output.append)
+        self.assertEqual("".join(output), "ran echo hello\n")
+
+    def test_follow_logs_demultiplexes_streams(self):
+        # Frames of both streams, one larger than a single read, and
+        # one which isn't valid utf-8 on its own:
+        large = "x" * 200000 + "\n"
+        self.create("logs", logs=[(1, "out\n"), (2, "err\n"),
+            (1, large), (2, "")])
+        output = []
+        self.client.follow_logs("logs", output.append)
+        self.assertEqual(output, ["out\n", "err\n", large, ""])
+
+    def test_follow_logs_stops_at_end_of_stream(self):
+        self.create("empty", logs=[])
+        output = []
+        self.client.follow_logs("empty", output.append)
+        self.assertEqual(output, [])
+        # The connection is still usable afterwards:
+        self.assertEqual(self.client.wait("empty"), 0)
+
+    def test_keepalive_connection_is_reused(self):
+        for i in range(5):
+            self.client.info()
+        self.assertEqual(self.server.state.connections, 1)
+
+    def test_dropped_keepalive_connection_is_retried(self):
+        # Every request after the first finds its connection closed:
+        self.server.state.drop_keepalive = True
+        for i in range(3):
+            self.assertEqual(self.client.info()["NCPU"], 64)
+        self.assertEqual(self.server.state.connections, 3)
+        self.assertEqual(len(self.server.state.requests), 3)
+
+    def test_errors_raise_docker_api_error(self):
+        with self.assertRaises(dockerapi.DockerAPIError) as context:
+            self.client.inspect_image("p4atestenv-missing:1")
+        self.assertEqual(context.exception.status, 404)
+        # (And don't break the connection:)
+        self.client.info()
+        self.assertEqual(self.server.state.connections, 1)
+
+    def test_build(self):
+        output = []
+        self.assertTrue(self.client.build(self.context_dir,
+            "p4atestenv-test:1", labels={"p4aspaces.test": "1"},
+            on_output=output.append))
+        self.assertIn("Successfully tagged p4atestenv-test:1\n", output)
+        image = self.client.inspect_image("p4atestenv-test:1")
+        self.assertEqual(image["Labels"], {"p4aspaces.test": "1"})
+        self.assertTrue(self.client.image_exists("p4atestenv-test:1"))
+
+    def test_failed_build(self):
+        self.server.state.build_error = "no space left on device"
+        output = []
+        self.assertFalse(self.client.build(self.context_dir,
+            "p4atestenv-test:1", on_output=output.append))
+        self.assertIn("no space left on device\n", output)
+        self.assertFalse(self.client.image_exists("p4atestenv-test:1"))
+
+    def test_run(self):
+        self.client.build(self.context_dir, "p4atestenv-test:1")
+        output = []
+        self.assertEqual(self.client.run("p4atestenv-test:1",
+            name="run", cmd=["true"], on_output=output.append), 0)
+        self.assertEqual("".join(output), "ran true\n")
+
+class JsonStreamTest(unittest.TestCase):
+    def test_objects_split_across_reads(self):
+        class Response(object):
+            def __init__(self, chunks):
+                self.chunks = list(chunks)
+
+            def read(self, size):
+                return self.chunks.pop(0) if len(self.chunks) > 0 else b""
+        data = b'{"stream": "a"}{"stream":\r\n "b"}\n{"error": "c"}'
+        for size in [1, 5, len(data)]:
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEqual(list(dockerapi.iter_json_stream(
+                Response(chunks))), [{"stream": "a"}, {"stream": "b"},
+                {"error": "c"}])
+
+if __name__ == "__main__":
+    unittest.main()
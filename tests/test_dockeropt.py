@@ -0,0 +1,126 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import contextlib
+import io
+import unittest
+
+from tests import TempHome
+from p4aspaces import buildenv, dockeropt, gitrefs
+from p4aspaces.main import main
+from p4aspaces.settings import settings
+
+class OptimizeTest(unittest.TestCase):
+    def test_merges_runs_and_apt_updates(self):
+        (text, report) = dockeropt.optimize("FROM ubuntu:18.04\n" +
+            "RUN apt update && apt install -y git\n" +
+            "# More tools:\n" +
+            "RUN apt update && apt install -y zip\n" +
+            "ENV A=1\n" +
+            "RUN mkdir /a\n")
+        self.assertEqual(text, "FROM ubuntu:18.04\n" +
+            "# More tools:\n" +
+            "RUN (apt update && apt install -y git) \\\n" +
+            "    && (apt install -y zip) \\\n" +
+            "    && (rm -rf /var/lib/apt/lists/*)\n" +
+            "ENV A=1\n" +
+            "RUN mkdir /a\n")
+        self.assertEqual((report["layers_before"], report["layers_after"]),
+            (3, 2))
+        self.assertEqual(report["apt_updates_removed"], 1)
+
+    def test_keep_layer_runs_stay_separate(self):
+        (text, report) = dockeropt.optimize("FROM ubuntu:18.04\n" +
+            "RUN mkdir /a\n" +
+            dockeropt.KEEP_LAYER_COMMENT + "\n" +
+            "RUN wget https://example.com/big.zip\n" +
+            "RUN mkdir /b\n" +
+            "RUN mkdir /c\n")
+        self.assertEqual(text, "FROM ubuntu:18.04\n" +
+            "RUN mkdir /a\n" +
+            "RUN wget https://example.com/big.zip\n" +
+            "RUN (mkdir /b) \\\n" +
+            "    && (mkdir /c)\n")
+        self.assertEqual(report["layers_after"], 3)
+
+    def test_exec_form_is_not_merged(self):
+        text = "FROM ubuntu:18.04\nRUN mkdir /a\nRUN [\"mkdir\", \"/b\"]\n"
+        self.assertEqual(dockeropt.optimize(text)[0], text)
+
+class EnvironmentLayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        gitrefs.set_resolver(lambda repo, name: "a" * 40)
+        gitrefs.set_release_resolver(lambda package: "2019.7.8")
+
+    def tearDown(self):
+        gitrefs.set_resolver(gitrefs.ls_remote_resolver)
+        gitrefs.set_release_resolver(gitrefs.pypi_release_resolver)
+        self.home.close()
+
+    def print_dockerfile(self, args):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), \
+                contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit) as context:
+                main(["print-dockerfile"] + args)
+        self.assertEqual(context.exception.code, 0)
+        return output.getvalue()
+
+    def test_disabled_by_default(self):
+        self.assertFalse(dockeropt.enabled())
+        # (Stores the refetch uuid, so every print renders the same)
+        buildenv.get_environment("p4a-py3-api28ndk21").resolve_targets()
+        raw = self.print_dockerfile(["--raw", "p4a-py3-api28ndk21"])
+        self.assertEqual(self.print_dockerfile(["p4a-py3-api28ndk21"]), raw)
+        self.assertIn(dockeropt.KEEP_LAYER_COMMENT, raw)
+        settings.set("optimize_dockerfile", True)
+        self.assertTrue(dockeropt.enabled())
+        self.assertNotEqual(self.print_dockerfile(["p4a-py3-api28ndk21"]),
+            raw)
+        self.assertEqual(self.print_dockerfile(["--raw",
+            "p4a-py3-api28ndk21"]), raw)
+
+    def test_download_steps_keep_their_layers(self):
+        for env in buildenv.get_environments():
+            with self.subTest(env=env.name):
+                raw = dockeropt.parse(env.get_docker_file())
+                (text, report) = dockeropt.optimize(env.get_docker_file())
+                optimized = [item_text for (keyword, item_text)
+                    in dockeropt.parse(text) if keyword == "RUN"]
+                kept = [raw[i + 1][1] for i in range(len(raw) - 1)
+                    if raw[i][1].strip() == dockeropt.KEEP_LAYER_COMMENT]
+                self.assertGreater(len(kept), 0)
+                for item_text in kept:
+                    if "apt" in item_text:
+                        # (Gets the apt lists cleanup appended)
+                        self.assertEqual(len([run for run in optimized
+                            if run.startswith("RUN (" +
+                            dockeropt.split_run(item_text)[1])]), 1)
+                    else:
+                        self.assertIn(item_text, optimized)
+                self.assertNotIn(dockeropt.KEEP_LAYER_COMMENT, text)
+                self.assertLess(report["layers_after"],
+                    report["layers_before"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import os
+import re
+import shlex
+import subprocess
+import sys
+import unittest
+
+from tests import TempHome
+from p4aspaces import buildenv, gitrefs
+
+def join_lines(docker_file):
+    # The instructions of a Dockerfile, with continuation lines joined:
+    return docker_file.replace("\\\n", "").splitlines()
+
+def declared_env(instructions):
+    # The ENV values of the last stage before the cmdline.py step:
+    result = dict()
+    for line in instructions:
+        if line.startswith("FROM "):
+            result = dict()
+        elif line.startswith("ENV "):
+            for item in shlex.split(line[len("ENV "):]):
+                (key, _, value) = item.partition("=")
+                result[key] = value
+        elif "> /tmp/cmdline.py" in line:
+            return result
+    raise AssertionError("no cmdline.py step found")
+
+def cmdline_script(instructions):
+    # The python script the cmdline.py step writes, as "echo -e" in a
+    # single quoted shell string produces it:
+    for line in instructions:
+        match = re.search(r"echo -e '(.*)' > /tmp/cmdline\.py", line)
+        if match is not None:
+            text = match.group(1).replace("'\"'\"'", "'")
+            return re.sub(r"\\(.)", lambda m: {"n": "\n", "t": "\t",
+                "\\": "\\"}.get(m.group(1), m.group(0)), text)
+    raise AssertionError("no cmdline.py step found")
+
+class EnvironmentDockerfileTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        gitrefs.set_resolver(lambda repo, name: "a" * 40)
+        gitrefs.set_release_resolver(lambda package: "2019.7.8")
+
+    def tearDown(self):
+        gitrefs.set_resolver(gitrefs.ls_remote_resolver)
+        gitrefs.set_release_resolver(gitrefs.pypi_release_resolver)
+        self.home.close()
+
+    def test_cmdline_runs_with_declared_env(self):
+        envs = buildenv.get_environments()
+        self.assertGreater(len(envs), 0)
+        for env in envs:
+            with self.subTest(env=env.name):
+                instructions = join_lines(env.get_docker_file())
+                script = cmdline_script(instructions)
+                # Run it with the image's folders moved into ours:
+                root = os.path.join(self.home.path, env.name)
+                for folder in ["usr/local/bin", "tmp", "home/userhome"]:
+                    os.makedirs(os.path.join(root, folder))
+                script = re.sub(r"(/usr/local/bin/|/tmp/|/home/userhome)",
+                    lambda match: root + match.group(1), script)
+                result = subprocess.run([sys.executable, "-c", script],
+                    env=declared_env(instructions),
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                self.assertEqual(result.returncode, 0,
+                    result.stdout.decode("utf-8", "replace"))
+                with open(os.path.join(root, "tmp",
+                        "p4aspaces-env.sh")) as f:
+                    self.assertIn("export ANDROIDNDK=", f.read())
+                self.assertTrue(os.path.exists(os.path.join(root,
+                    "usr/local/bin/testbuild")))
+
+    def test_buildkit_variant_needs_no_frontend_image(self):
+        for env in buildenv.get_environments():
+            with self.subTest(env=env.name):
+                docker_file = env.get_docker_file(buildkit=True)
+                self.assertIn("--mount=type=cache", docker_file)
+                self.assertNotIn("# syntax=", docker_file)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import contextlib
+import io
+import os
+import time
+import unittest
+
+from tests import TempHome
+from p4aspaces import gitrefs
+from p4aspaces.main import main
+from p4aspaces.settings import settings
+
+REPO = "https://github.com/kivy/python-for-android"
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.calls = []
+        self.commits = {"master": "a" * 40, "v2019.07.08": "b" * 40}
+        def resolver(repo, name):
+            self.calls.append((repo, name))
+            return self.commits.get(name)
+        gitrefs.set_resolver(resolver)
+
+    def tearDown(self):
+        gitrefs.set_resolver(gitrefs.ls_remote_resolver)
+        gitrefs.set_release_resolver(gitrefs.pypi_release_resolver)
+        self.home.close()
+
+    def test_resolve_uses_resolver(self):
+        self.assertEqual(gitrefs.resolve(REPO, "master"), "a" * 40)
+        self.assertEqual(self.calls, [(REPO, "master")])
+
+    def test_commits_are_not_looked_up(self):
+        self.assertEqual(gitrefs.resolve(REPO, "c" * 40), "c" * 40)
+        self.assertEqual(self.calls, [])
+
+    def test_result_is_cached(self):
+        gitrefs.resolve(REPO, "master")
+        self.commits["master"] = "d" * 40
+        self.assertEqual(gitrefs.resolve(REPO, "master"), "a" * 40)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(gitrefs.resolve(REPO, "master", refresh=True),
+            "d" * 40)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_expired_result_is_looked_up_again(self):
+        gitrefs.resolve(REPO, "master")
+        with settings.transaction() as store:
+            store["resolved_refs"][REPO + "#master"]["time"] = \
+                time.time() - gitrefs.DEFAULT_CACHE_TTL - 1
+        self.commits["master"] = "d" * 40
+        self.assertEqual(gitrefs.resolve(REPO, "master"), "d" * 40)
+
+    def test_offline_keeps_cached_result(self):
+        gitrefs.resolve(REPO, "master")
+        def offline(repo, name):
+            raise OSError("network is unreachable")
+        gitrefs.set_resolver(offline)
+        self.assertEqual(gitrefs.resolve(REPO, "master", refresh=True),
+            "a" * 40)
+        self.assertIsNone(gitrefs.resolve(REPO, "develop"))
+
+    def test_failures_are_cached_briefly(self):
+        def offline(repo, name):
+            self.calls.append((repo, name))
+            raise OSError("network is unreachable")
+        gitrefs.set_resolver(offline)
+        self.assertIsNone(gitrefs.resolve(REPO, "master"))
+        self.assertIsNone(gitrefs.resolve(REPO, "master"))
+        self.assertEqual(len(self.calls), 1)
+        with settings.transaction() as store:
+            store["resolved_refs"][REPO + "#master"]["failed"] = \
+                time.time() - gitrefs.DEFAULT_FAILURE_TTL - 1
+        self.assertIsNone(gitrefs.resolve(REPO, "master"))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failure_keeps_last_known_commit(self):
+        gitrefs.resolve(REPO, "master")
+        with settings.transaction() as store:
+            store["resolved_refs"][REPO + "#master"]["time"] = 0
+        gitrefs.set_resolver(lambda repo, name: None)
+        self.assertEqual(gitrefs.resolve(REPO, "master"), "a" * 40)
+        self.assertEqual(gitrefs.resolve(REPO, "master"), "a" * 40)
+
+    def test_cached_only(self):
+        self.assertIsNone(gitrefs.resolve(REPO, "master",
+            cached_only=True))
+        self.assertEqual(self.calls, [])
+        gitrefs.resolve(REPO, "master")
+        with settings.transaction() as store:
+            store["resolved_refs"][REPO + "#master"]["time"] = 0
+        self.assertEqual(gitrefs.resolve(REPO, "master",
+            cached_only=True), "a" * 40)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_print_dockerfile_stays_offline(self):
+        def resolver(*args):
+            raise AssertionError("looked up " + repr(args))
+        gitrefs.set_resolver(resolver)
+        gitrefs.set_release_resolver(resolver)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with self.assertRaises(SystemExit) as context:
+                main(["print-dockerfile", "p4a-py3-api28ndk21"])
+        self.assertEqual(context.exception.code, 0)
+        self.assertIn("archive/master.zip", output.getvalue())
+        self.assertFalse(os.path.exists(settings.settings_file()))
+
+    def test_unknown_name(self):
+        self.assertIsNone(gitrefs.resolve(REPO, "no-such-branch"))
+
+    def test_resolve_version_tries_release_tags(self):
+        self.assertEqual(gitrefs.resolve_version(REPO, "2019.7.8"),
+            "b" * 40)
+        self.assertEqual(self.calls[0], (REPO, "v2019.07.08"))
+
+    def test_release_tags(self):
+        self.assertEqual(gitrefs.release_tags("2019.7.8"),
+            ["v2019.07.08", "v2019.7.8", "2019.7.8"])
+        self.assertEqual(gitrefs.release_tags("0.7.0rc1"),
+            ["v0.7.0rc1", "0.7.0rc1"])
+
+if __name__ == "__main__":
+    unittest.main()
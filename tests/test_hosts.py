@@ -0,0 +1,132 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import contextlib
+import io
+import os
+import unittest
+
+from tests import TempHome
+from p4aspaces import dockerapi, hosts
+from p4aspaces.dockerapi_fake import FakeDockerServer
+from p4aspaces.settings import settings
+
+class ChooseHostTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.servers = []
+        for i in range(3):
+            server = FakeDockerServer(os.path.join(self.home.path,
+                "docker" + str(i) + ".sock"))
+            server.start()
+            self.servers.append(server)
+        self.urls = [server.url for server in self.servers]
+        settings.set("docker_hosts", self.urls)
+        self.image = "p4atestenv-p4a-py3-api28ndk21:abc"
+
+    def tearDown(self):
+        hosts._pending.clear()
+        for url in self.urls:
+            client = dockerapi.get_client(url)
+            if client is not None:
+                client.close()
+        for server in self.servers:
+            server.stop()
+        self.home.close()
+
+    def add_running(self, index, name):
+        self.servers[index].state.containers[name] = {"Id": name,
+            "Name": name, "Image": self.image, "Labels": dict(),
+            "State": "running"}
+
+    def add_image(self, index):
+        self.servers[index].state.images[self.image] = {"Id": "sha256:1",
+            "RepoTags": [self.image], "RootFS": {"Layers": []}}
+
+    def test_no_hosts_means_default(self):
+        settings.set("docker_hosts", [])
+        self.assertIsNone(hosts.choose_host(None, self.image, "c1"))
+
+    def test_explicit_host(self):
+        self.assertEqual(hosts.choose_host(self.urls[2], self.image,
+            "c1"), self.urls[2])
+
+    def test_least_loaded_host(self):
+        self.add_running(0, "p4atestenv-a")
+        self.add_running(1, "p4atestenv-b")
+        self.assertEqual(hosts.choose_host("auto", self.image, "c1"),
+            self.urls[2])
+
+    def test_other_containers_dont_count(self):
+        self.add_running(0, "unrelated")
+        self.add_running(1, "p4atestenv-b")
+        self.add_running(2, "p4atestenv-c")
+        self.assertEqual(hosts.choose_host("auto", self.image, "c1"),
+            self.urls[0])
+
+    def test_pending_launches_spread(self):
+        chosen = [hosts.choose_host("auto", self.image, "c" + str(i))
+            for i in range(6)]
+        self.assertEqual(sorted(chosen), sorted(self.urls * 2))
+        # Released launches don't count anymore:
+        for (i, host) in enumerate(chosen[:3]):
+            hosts.release(host, "c" + str(i))
+        self.assertEqual(hosts.choose_host("auto", self.image, "c6"),
+            chosen[0])
+
+    def test_image_affinity(self):
+        self.add_image(1)
+        self.add_running(1, "p4atestenv-a")
+        self.assertEqual(hosts.choose_host("auto", self.image, "c1"),
+            self.urls[1])
+        # ... up to AFFINITY_BONUS more containers:
+        for i in range(hosts.AFFINITY_BONUS):
+            self.add_running(1, "p4atestenv-b" + str(i))
+        self.assertNotEqual(hosts.choose_host("auto", self.image, "c2"),
+            self.urls[1])
+
+    def test_unreachable_host_is_skipped(self):
+        self.servers[0].stop()
+        self.add_running(1, "p4atestenv-a")
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.assertEqual(hosts.choose_host("auto", self.image, "c1"),
+                self.urls[2])
+        self.assertIn("not reachable", stderr.getvalue())
+
+    def test_no_reachable_host(self):
+        settings.set("docker_hosts", [self.servers[0].url + ".missing"])
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                hosts.choose_host("auto", self.image, "c1")
+
+class CacheVolumesTest(unittest.TestCase):
+    def test_volumes_per_user(self):
+        volumes = hosts.cache_volumes("/x/ccache/p4a-py3-api28ndk21", 1000)
+        self.assertEqual([volume.partition(":")[0] for volume in volumes],
+            ["p4aspaces-cache-ccache-p4a-py3-api28ndk21-1000",
+            "p4aspaces-cache-gradle-1000", "p4aspaces-cache-m2-1000"])
+        self.assertEqual(set(volumes) & set(hosts.cache_volumes(
+            "/x/ccache/p4a-py3-api28ndk21", 1001)), set())
+
+if __name__ == "__main__":
+    unittest.main()
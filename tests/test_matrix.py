@@ -0,0 +1,53 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import contextlib
+import io
+import sys
+import unittest
+
+import tests
+from p4aspaces.actions.matrix import run_parallel
+
+class RunParallelTest(unittest.TestCase):
+    def run_jobs(self, funcs):
+        with contextlib.redirect_stderr(io.StringIO()):
+            return dict([(result["name"], result["exit_code"])
+                for result in run_parallel(list(funcs.items()),
+                max_workers=2)])
+
+    def test_exit_codes(self):
+        def raises():
+            raise RuntimeError("broken")
+        def exits():
+            sys.exit(3)
+        def exits_without_code():
+            sys.exit()
+        self.assertEqual(self.run_jobs({"ok": lambda: 0,
+            "failed": lambda: 2, "none": lambda: None,
+            "raises": raises, "exits": exits,
+            "exits_without_code": exits_without_code}),
+            {"ok": 0, "failed": 2, "none": 1, "raises": 1, "exits": 3,
+            "exits_without_code": 1})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import unittest
+
+from tests import FakeDocker, TempHome
+from p4aspaces import dockerapi, resources
+from p4aspaces.settings import settings
+
+GB = 1024 ** 3
+
+class LimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        # (Reports 64 cores and 256G of memory)
+        self.docker = FakeDocker(self.home.path)
+
+    def tearDown(self):
+        dockerapi.get_client().close()
+        self.docker.close()
+        self.home.close()
+
+    def add_running(self, count):
+        for i in range(count):
+            name = resources.CONTAINER_PREFIX + str(i)
+            self.docker.state.containers[name] = {"Id": name,
+                "Name": name, "Image": "p4atestenv-a:1",
+                "Labels": dict(), "State": "running"}
+
+    def test_profiles(self):
+        self.assertEqual(resources.get_profile(), "auto")
+        self.assertEqual(resources.get_profile(" Small "), "small")
+        settings.set("resource_profile", "none")
+        self.assertIsNone(resources.get_limits())
+        self.assertEqual(resources.get_limits("16:32G"), (16.0, 32 * GB))
+        for profile in ["big", "0:4G", "4:", "x:4G"]:
+            with self.assertRaises(ValueError):
+                resources.get_profile(profile)
+
+    def test_auto_divides_the_host(self):
+        self.assertEqual(resources.get_limits("auto"), (64.0, 192 * GB))
+        self.assertEqual(resources.get_limits("auto", concurrency=4),
+            (16.0, 48 * GB))
+        # Launches running already count as well:
+        self.add_running(3)
+        self.assertEqual(resources.get_limits("auto"), (16.0, 48 * GB))
+        self.assertEqual(resources.get_limits("small"), (2, 4 * GB))
+
+    def test_host_resources_are_remembered(self):
+        resources.get_limits("auto")
+        self.assertIn(("GET", "info"), self.docker.state.requests)
+        requests = len(self.docker.state.requests)
+        self.assertEqual(resources.host_resources(), (64, 256 * GB))
+        self.assertNotIn(("GET", "info"),
+            self.docker.state.requests[requests:])
+
+    def test_container_arguments(self):
+        self.assertEqual(resources.run_args(None), [])
+        self.assertEqual(resources.update_args(None), [])
+        self.assertEqual(resources.environment(None), [])
+        self.assertEqual(resources.run_args((2.5, 4 * GB)),
+            ["--cpus", "2.5", "--memory", str(4 * GB)])
+        self.assertEqual(resources.update_args((16.0, 4 * GB)),
+            ["--cpus", "16", "--memory", str(4 * GB),
+            "--memory-swap", str(8 * GB)])
+        # 1G of the 4G are the JVM heap, the rest fits 2 gradle workers:
+        self.assertEqual(resources.environment((16.0, 4 * GB)),
+            ["MAKEFLAGS=-j16", "P4AS_GRADLE_WORKERS=2",
+            "P4AS_JVM_HEAP=1024m"])
+        self.assertEqual(resources.environment((0.5, 1 * GB)),
+            ["MAKEFLAGS=-j1", "P4AS_GRADLE_WORKERS=1",
+            "P4AS_JVM_HEAP=512m"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import contextlib
+import http.client
+import io
+import json
+import os
+import threading
+import time
+import unittest
+
+from tests import FakeDocker, TempHome
+from p4aspaces import dockerapi, gitrefs, server, testapps
+from p4aspaces.settings import settings
+
+ENV = "p4a-py3-api28ndk21"
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.root = os.path.join(self.home.path, "workspaces")
+        os.makedirs(os.path.join(self.root, "app"))
+        self.jobs = server.JobQueue(folder=os.path.join(self.home.path,
+            "jobs"), default_user=1000, allowed_users=[1001],
+            workspace_roots=[self.root])
+
+    def tearDown(self):
+        self.jobs.stop()
+        self.home.close()
+
+    def test_submit(self):
+        job = self.jobs.submit({"env": ENV, "command": "testbuild",
+            "workspace": os.path.join(self.root, "app")})
+        self.assertEqual(job["state"], "queued")
+        self.assertEqual(job["user"], 1000)
+        self.assertEqual(job["workspace"], os.path.realpath(
+            os.path.join(self.root, "app")))
+        self.assertEqual([j["id"] for j in self.jobs.list()], [job["id"]])
+
+    def test_rejected_specs(self):
+        for spec in [[], {"env": "no-such-env"}, {"env": "../x"},
+                {"env": ENV, "unknown": 1}, {"env": ENV, "user": 0},
+                {"env": ENV, "user": True}, {"env": ENV, "workspace": "/"},
+                {"env": ENV, "workspace": os.path.join(self.root,
+                    "app", "..", "..")},
+                {"env": ENV, "buildozer_dir": "/no/such/folder"}]:
+            with self.assertRaises(server.JobError, msg=repr(spec)):
+                self.jobs.submit(spec)
+        self.assertEqual(self.jobs.list(), [])
+        self.assertEqual(self.jobs.submit({"env": ENV,
+            "user": 1001})["user"], 1001)
+
+    def test_cancel(self):
+        job = self.jobs.submit({"env": ENV})
+        self.assertEqual(self.jobs.cancel(job["id"])["state"], "cancelled")
+        self.assertEqual(len(self.jobs.pending), 0)
+        with self.assertRaises(server.JobError):
+            self.jobs.cancel(job["id"])
+        self.assertIsNone(self.jobs.cancel("no-such-job"))
+
+    def test_restart(self):
+        queued = self.jobs.submit({"env": ENV})
+        running = self.jobs.submit({"env": ENV})
+        self.jobs.jobs[running["id"]]["state"] = "running"
+        self.jobs.save(self.jobs.jobs[running["id"]])
+        jobs = server.JobQueue(folder=self.jobs.folder, default_user=1000)
+        self.assertEqual(list(jobs.pending), [queued["id"]])
+        self.assertEqual(jobs.get(running["id"])["state"], "failed")
+
+class JobRunTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.docker = FakeDocker(self.home.path)
+        settings.set("use_buildkit", False)
+        settings.set("ccache_dir", os.path.join(self.home.path, "ccache"))
+        gitrefs.set_resolver(lambda repo, name: "a" * 40)
+        gitrefs.set_release_resolver(lambda package: "2019.7.8")
+        testapps.set_provider(lambda source, folder: None)
+        self.jobs = server.JobQueue(folder=os.path.join(self.home.path,
+            "jobs"), max_running=2, default_user=os.getuid())
+
+    def tearDown(self):
+        self.jobs.stop()
+        testapps.set_provider(testapps.default_provider)
+        gitrefs.set_resolver(gitrefs.ls_remote_resolver)
+        gitrefs.set_release_resolver(gitrefs.pypi_release_resolver)
+        self.docker.close()
+        self.home.close()
+
+    def wait_finished(self, job_ids):
+        deadline = time.monotonic() + 60
+        with self.jobs.changed:
+            while any([self.jobs.jobs[job_id]["finished"] is None
+                       for job_id in job_ids]):
+                self.assertLess(time.monotonic(), deadline)
+                self.jobs.changed.wait(1)
+        return [self.jobs.get(job_id) for job_id in job_ids]
+
+    def test_jobs_run(self):
+        self.jobs.start()
+        ids = [self.jobs.submit({"env": ENV, "command": "echo " +
+            str(i)})["id"] for i in range(3)]
+        for job in self.wait_finished(ids):
+            self.assertEqual((job["state"], job["exit_code"]),
+                ("succeeded", 0))
+            with open(os.path.join(self.jobs.job_dir(job["id"]),
+                    "log.txt")) as f:
+                self.assertIn("ran echo", f.read())
+        # (The image got built once, for all of them)
+        self.assertEqual(len([r for r in self.docker.state.requests
+            if r == ("POST", "build")]), 1)
+
+    def test_failed_build(self):
+        self.docker.state.build_error = "no space left on device"
+        self.jobs.start()
+        with contextlib.redirect_stderr(io.StringIO()):
+            job = self.wait_finished([self.jobs.submit(
+                {"env": ENV})["id"]])[0]
+        self.assertEqual(job["state"], "failed")
+
+class JobServerTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+        self.jobs = server.JobQueue(folder=os.path.join(self.home.path,
+            "jobs"), default_user=1000)
+        self.socket_path = os.path.join(self.home.path, "serve.sock")
+        self.unix_server = server.UnixJobServer(self.socket_path, self.jobs)
+        self.tcp_server = server.JobServer(("127.0.0.1", 0), self.jobs,
+            "secret")
+        for httpd in [self.unix_server, self.tcp_server]:
+            threading.Thread(target=httpd.serve_forever,
+                daemon=True).start()
+
+    def tearDown(self):
+        for httpd in [self.unix_server, self.tcp_server]:
+            httpd.shutdown()
+            httpd.server_close()
+        self.home.close()
+
+    def request(self, connection, method, path, body=None, headers=None):
+        connection.request(method, path, body=(json.dumps(body)
+            if body is not None else None), headers=headers or dict())
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        return (response.status, json.loads(data.decode("utf-8")))
+
+    def unix_request(self, method, path, body=None):
+        return self.request(dockerapi.unix_http_connection(
+            self.socket_path), method, path, body)
+
+    def test_unix_socket(self):
+        self.assertEqual(oct(os.stat(self.socket_path).st_mode & 0o777),
+            "0o600")
+        (status, job) = self.unix_request("POST", "/jobs", {"env": ENV})
+        self.assertEqual(status, 201)
+        self.assertEqual(self.unix_request("GET", "/jobs/" + job["id"]),
+            (200, job))
+        self.assertEqual(self.unix_request("POST", "/jobs",
+            {"env": "nope"})[0], 400)
+        self.assertEqual(self.unix_request("GET", "/jobs/nope")[0], 404)
+        (status, job) = self.unix_request("POST",
+            "/jobs/" + job["id"] + "/cancel")
+        self.assertEqual((status, job["state"]), (200, "cancelled"))
+
+    def test_tcp_needs_token(self):
+        port = self.tcp_server.server_address[1]
+        for (headers, status) in [(None, 401),
+                ({"Authorization": "Bearer wrong"}, 401),
+                ({"Authorization": "Bearer secret"}, 200)]:
+            self.assertEqual(self.request(http.client.HTTPConnection(
+                "127.0.0.1", port), "GET", "/jobs",
+                headers=headers)[0], status)
+
+    def test_token_file(self):
+        token = server.get_token()
+        self.assertEqual(server.get_token(), token)
+        self.assertEqual(oct(os.stat(server.token_path()).st_mode & 0o777),
+            "0o600")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import json
+import multiprocessing
+import os
+import unittest
+
+from tests import TempHome
+from p4aspaces.settings import settings
+
+def add_to_counter(count):
+    for i in range(count):
+        with settings.transaction() as store:
+            store["counter"] = store.get("counter", 0) + 1
+
+class SettingsTest(unittest.TestCase):
+    def setUp(self):
+        self.home = TempHome()
+
+    def tearDown(self):
+        self.home.close()
+
+    def test_defaults(self):
+        self.assertEqual(settings.get("missing", type=dict), dict())
+        self.assertEqual(settings.get("missing", type=int), 0)
+        self.assertIsNone(settings.get("missing"))
+        self.assertEqual(settings.get("missing", default=5), 5)
+        self.assertFalse(os.path.exists(settings.settings_file()))
+
+    def test_set_and_get(self):
+        settings.set("a", {"b": [1, 2]})
+        self.assertEqual(settings.get("a"), {"b": [1, 2]})
+        # (Callers get their own copy of the cached values)
+        settings.get("a")["b"].append(3)
+        self.assertEqual(settings.get("a"), {"b": [1, 2]})
+        # (No temporary files are left behind)
+        self.assertEqual(sorted(os.listdir(settings.settings_folder())),
+            ["settings.json", "settings.json.lock"])
+
+    def test_external_changes_are_seen(self):
+        settings.set("a", 1)
+        self.assertEqual(settings.get("a"), 1)
+        with open(settings.settings_file() + ".new", "w") as f:
+            f.write(json.dumps({"a": 2, "other": True}))
+        os.replace(settings.settings_file() + ".new",
+            settings.settings_file())
+        self.assertEqual(settings.get("a"), 2)
+        os.remove(settings.settings_file())
+        self.assertIsNone(settings.get("a"))
+
+    def test_unchanged_transaction_does_not_write(self):
+        settings.set("a", 1)
+        mtime = os.stat(settings.settings_file()).st_mtime_ns
+        inode = os.stat(settings.settings_file()).st_ino
+        with settings.transaction() as store:
+            store["a"] = 1
+        self.assertEqual(os.stat(settings.settings_file()).st_mtime_ns,
+            mtime)
+        self.assertEqual(os.stat(settings.settings_file()).st_ino, inode)
+
+    def test_nested_transactions(self):
+        with settings.transaction() as store:
+            store["a"] = 1
+            settings.set("b", 2)
+            self.assertEqual(settings.get("a"), 1)
+        self.assertEqual(settings.get("b"), 2)
+        self.assertEqual(settings.get("a"), 1)
+
+    def test_concurrent_processes(self):
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=add_to_counter, args=(25,))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(settings.get("counter"), 100)
+
+if __name__ == "__main__":
+    unittest.main()
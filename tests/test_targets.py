@@ -0,0 +1,51 @@
+'''
+Copyright (c) 2018-2019 p4a-build-spaces team and others, see AUTHORS.md
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+'''
+
+import unittest
+
+import tests
+from p4aspaces import targets
+
+class ParseTargetsTest(unittest.TestCase):
+    def test_combinations(self):
+        self.assertEqual(targets.parse_targets(
+            ["sdl2,webview:arm64-v8a,x86_64", "sdl2:arm64-v8a:kivy"]), [
+            ("sdl2", "arm64-v8a", None), ("sdl2", "x86_64", None),
+            ("webview", "arm64-v8a", None), ("webview", "x86_64", None),
+            ("sdl2", "arm64-v8a", "kivy")])
+
+    def test_default_arch(self):
+        self.assertEqual(targets.parse_targets(["service_only"]),
+            [("service_only", targets.DEFAULT_ARCH, None)])
+
+    def test_unknown_bootstrap(self):
+        with self.assertRaises(ValueError):
+            targets.parse_targets(["qt:x86"])
+
+    def test_names_usable_as_folder_names(self):
+        for spec in ["sdl2:../../x", "sdl2:a/b", "sdl2:..", "sdl2:.x",
+                "sdl2:x y", "../sdl2:x86"]:
+            with self.assertRaises(ValueError):
+                targets.parse_targets([spec])
+
+if __name__ == "__main__":
+    unittest.main()